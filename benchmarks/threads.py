@@ -0,0 +1,94 @@
+"""
+How the throughput of one compiled schema, shared by many threads, scales with
+the number of threads.
+
+    python benchmarks/threads.py [--engine codegen] [--threads 1,2,4,8]
+
+On a regular CPython build the threads take turns holding the GIL, so the
+throughput stays about the same. On a free-threaded build it should grow with the
+number of threads, up to the number of cores.
+"""
+
+from __future__ import print_function
+
+import argparse
+import sys
+import threading
+from timeit import default_timer
+
+import sureberus
+from sureberus import schema as S
+from sureberus.compiler import ENGINES
+
+SCHEMA = S.Dict(
+    registry={
+        "point": S.Dict(fields={"x": S.Integer(), "y": S.Integer(default=0)}),
+        "shape": {
+            "anyof": [
+                S.Dict(fields={"kind": S.String(allowed=["circle"]), "r": S.Float()}),
+                S.Dict(fields={"kind": S.String(allowed=["line"]), "to": "point"}),
+            ]
+        },
+    },
+    fields={
+        "id": S.Integer(min=0),
+        "name": S.String(regex="[a-z]+", maxlength=20),
+        "shapes": S.List(elements="shape"),
+        "tags": S.List(elements=S.String(), default_setter="list"),
+    },
+)
+
+VALUE = {
+    "id": 1,
+    "name": "drawing",
+    "shapes": [{"kind": "circle", "r": 1.5}, {"kind": "line", "to": {"x": 3}}] * 5,
+}
+
+
+def run(compiled, threads, per_thread):
+    barrier = threading.Barrier(threads + 1)
+
+    def work():
+        barrier.wait()
+        for _ in range(per_thread):
+            compiled.normalize(VALUE)
+
+    workers = [threading.Thread(target=work) for _ in range(threads)]
+    for worker in workers:
+        worker.start()
+    barrier.wait()
+    start = default_timer()
+    for worker in workers:
+        worker.join()
+    return threads * per_thread / (default_timer() - start)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--engine", default="interpreter", choices=ENGINES)
+    parser.add_argument("--threads", default="1,2,4,8")
+    parser.add_argument("--per-thread", type=int, default=2000)
+    args = parser.parse_args(argv)
+
+    is_gil_enabled = getattr(sys, "_is_gil_enabled", lambda: True)
+    print(
+        "Python {}, GIL {}".format(
+            sys.version.split()[0], "enabled" if is_gil_enabled() else "disabled"
+        )
+    )
+    compiled = sureberus.compile_schema(SCHEMA, engine=args.engine)
+    run(compiled, 1, args.per_thread // 10)  # warm up
+    baseline = None
+    for threads in [int(n) for n in args.threads.split(",")]:
+        throughput = run(compiled, threads, args.per_thread)
+        if baseline is None:
+            baseline = throughput / threads
+        print(
+            "{:3} threads: {:9.0f} values/s ({:.2f}x of linear scaling)".format(
+                threads, throughput, throughput / (baseline * threads)
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
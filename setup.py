@@ -20,4 +20,5 @@ setuptools.setup(
     ],
     packages=["sureberus"],
     install_requires=["six", "attrs"],
+    entry_points={"console_scripts": ["sureberus = sureberus.cli:main"]},
 )
@@ -2,6 +2,7 @@ from __future__ import print_function
 
 from copy import deepcopy
 from inspect import getmembers
+import itertools
 import re
 import warnings
 
@@ -10,51 +11,209 @@ import six
 
 from . import errors as E
 from .constants import _marker
+from .scope import Scope, as_scope
+
+__all__ = [
+    "normalize_dict",
+    "normalize_schema",
+    "validate",
+    "is_valid",
+    "check_schema",
+    "compile_schema",
+    "CompiledSchema",
+    "normalize_many",
+    "normalize_jsonl",
+]
+
+
+class _Frame(object):
+    """
+    A key on the path to the value that is being normalized, linked to the frame of
+    its parent. The path is only turned into a tuple when it's needed, e.g. for an
+    error, so that going one level deeper into a value doesn't copy the path.
+    """
+
+    __slots__ = ("parent", "key", "_stack")
+
+    def __init__(self, parent, key):
+        self.parent = parent
+        self.key = key
+        self._stack = None
+
+    @property
+    def stack(self):
+        if self._stack is None:
+            keys = []
+            frame = self
+            while frame._stack is None:
+                keys.append(frame.key)
+                frame = frame.parent
+            self._stack = frame._stack + tuple(reversed(keys))
+        return self._stack
 
-__all__ = ["normalize_dict", "normalize_schema"]
 
+_ROOT_FRAME = _Frame(None, None)
+_ROOT_FRAME._stack = ()
 
-@attr.s(frozen=True)
+
+# The indices of the registries and the tags in `Context._scopes`
+_SCHEMAS, _DEFAULTS, _COERCES, _MODIFY_CONTEXTS, _VALIDATORS, _TAGS = range(6)
+
+# The modes of normalization, in `Context._mode`
+_NORMALIZE = "normalize"
+# Only check whether values are valid, without building the normalized values
+_VALIDATE = "validate"
+# Store normalized values in the containers of the value instead of in new ones
+_INPLACE = "inplace"
+
+_new = object.__new__
+_setattr = object.__setattr__
+
+
+@attr.s(frozen=True, slots=True, init=False)
 class Context(object):
+    """
+    Everything that affects how a value is normalized, other than the schema: where
+    in the document the value is, whether unknown fields are allowed, the
+    registries, and the tags.
+
+    A Context is immutable; its methods return new Contexts. They are created
+    for every field and list element, so the attributes are kept to a minimum,
+    and new ones are created without going through `__init__`.
+    """
+
     allow_unknown = attr.ib()
-    stack = attr.ib(factory=tuple)
-    schema_registry = attr.ib(factory=dict)
-    default_registry = attr.ib(factory=dict)
-    coerce_registry = attr.ib(factory=dict)
-    modify_context_registry = attr.ib(factory=dict)
-    validator_registry = attr.ib(factory=dict)
-    tags = attr.ib(factory=dict)
+    _frame = attr.ib(repr=False, cmp=False)
+    # The registries and tags are Scopes, so that adding to them doesn't copy them.
+    _scopes = attr.ib()
+    compiled = attr.ib(repr=False, cmp=False)
+    _mode = attr.ib(repr=False, cmp=False)
+
+    def __init__(
+        self,
+        allow_unknown,
+        stack=None,
+        schema_registry=None,
+        default_registry=None,
+        coerce_registry=None,
+        modify_context_registry=None,
+        validator_registry=None,
+        tags=None,
+        compiled=None,
+        frame=None,
+        scopes=None,
+        mode=_NORMALIZE,
+    ):
+        # `frame`, `scopes` and `mode` are the names attrs gives the private
+        # attributes, so that `attr.evolve` works on Contexts. The registries and
+        # `stack` that are passed take precedence over them.
+        if stack is not None:
+            frame = _ROOT_FRAME
+            for key in stack:
+                frame = _Frame(frame, key)
+        elif frame is None:
+            frame = _ROOT_FRAME
+        registries = (
+            schema_registry,
+            default_registry,
+            coerce_registry,
+            modify_context_registry,
+            validator_registry,
+            tags,
+        )
+        if scopes is None:
+            scopes = tuple(Scope() for _ in registries)
+        scopes = tuple(
+            scope if registry is None else as_scope(registry)
+            for registry, scope in zip(registries, scopes)
+        )
+        _setattr(self, "allow_unknown", allow_unknown)
+        _setattr(self, "_frame", frame)
+        _setattr(self, "_scopes", scopes)
+        _setattr(self, "compiled", compiled)
+        _setattr(self, "_mode", mode)
+
+    def _derive(self, allow_unknown, frame, scopes, compiled, mode):
+        ctx = _new(self.__class__)
+        _setattr(ctx, "allow_unknown", allow_unknown)
+        _setattr(ctx, "_frame", frame)
+        _setattr(ctx, "_scopes", scopes)
+        _setattr(ctx, "compiled", compiled)
+        _setattr(ctx, "_mode", mode)
+        return ctx
+
+    def _add_scope(self, index, mapping):
+        scopes = list(self._scopes)
+        scopes[index] = scopes[index].new_child(mapping)
+        return self._derive(
+            self.allow_unknown, self._frame, tuple(scopes), self.compiled, self._mode
+        )
+
+    @property
+    def schema_registry(self):
+        return self._scopes[_SCHEMAS]
+
+    @property
+    def default_registry(self):
+        return self._scopes[_DEFAULTS]
+
+    @property
+    def coerce_registry(self):
+        return self._scopes[_COERCES]
+
+    @property
+    def modify_context_registry(self):
+        return self._scopes[_MODIFY_CONTEXTS]
+
+    @property
+    def validator_registry(self):
+        return self._scopes[_VALIDATORS]
+
+    @property
+    def tags(self):
+        return self._scopes[_TAGS]
+
+    @property
+    def stack(self):
+        """The path to the current value, as a tuple of keys and indices."""
+        return self._frame.stack
 
     def push_stack(self, x):
-        return attr.evolve(self, stack=self.stack + (x,))
+        return self._derive(
+            self.allow_unknown,
+            _Frame(self._frame, x),
+            self._scopes,
+            self.compiled,
+            self._mode,
+        )
 
     def set_allow_unknown(self, x):
-        return attr.evolve(self, allow_unknown=x)
+        return self._derive(x, self._frame, self._scopes, self.compiled, self._mode)
+
+    def _with_compiled(self, compiled):
+        return self._derive(
+            self.allow_unknown, self._frame, self._scopes, compiled, self._mode
+        )
+
+    def _with_mode(self, mode):
+        return self._derive(
+            self.allow_unknown, self._frame, self._scopes, self.compiled, mode
+        )
 
     def register_schemas(self, registry):
-        reg = self.schema_registry.copy()
-        reg.update(registry)
-        return attr.evolve(self, schema_registry=reg)
+        return self._add_scope(_SCHEMAS, registry)
 
     def register_defaults(self, registry):
-        reg = self.default_registry.copy()
-        reg.update(registry)
-        return attr.evolve(self, default_registry=reg)
+        return self._add_scope(_DEFAULTS, registry)
 
     def register_coerces(self, registry):
-        reg = self.coerce_registry.copy()
-        reg.update(registry)
-        return attr.evolve(self, coerce_registry=reg)
+        return self._add_scope(_COERCES, registry)
 
     def register_validators(self, registry):
-        reg = self.validator_registry.copy()
-        reg.update(registry)
-        return attr.evolve(self, validator_registry=reg)
+        return self._add_scope(_VALIDATORS, registry)
 
     def register_modify_contexts(self, registry):
-        reg = self.modify_context_registry.copy()
-        reg.update(registry)
-        return attr.evolve(self, modify_context_registry=reg)
+        return self._add_scope(_MODIFY_CONTEXTS, registry)
 
     def resolve_default_setter(self, setter):
         return self._resolve_registered(setter, self.default_registry, "default")
@@ -72,41 +231,71 @@ class Context(object):
 
     def _resolve_registered(self, thing, registry, name):
         if isinstance(thing, six.string_types):
-            if thing in registry:
-                return registry[thing]
-            else:
+            function = registry.get(thing, _marker)
+            if function is _marker:
                 # this *shouldn't* take the stack; this error should be discovered
                 # when the schema is initially being parsed.
                 raise E.RegisteredFunctionNotFound(thing, name, self.stack)
+            return function
         else:
             return thing
 
     def find_schema(self, name):
-        return self.schema_registry[name]
+        return self._scopes[_SCHEMAS][name]
 
     def set_tag(self, tag, value):
-        tags = self.tags.copy()
-        tags[tag] = value
-        return attr.evolve(self, tags=tags)
+        return self._add_scope(_TAGS, {tag: value})
 
     def get_tag(self, tag, default=_marker):
-        if default is _marker and tag not in self.tags:
-            raise E.TagNotFound(tag, self.tags.keys(), self.stack)
-        return self.tags.get(tag, default)
+        value = self.tags.get(tag, default)
+        if value is _marker:
+            raise E.TagNotFound(tag, self.tags.flatten().keys(), self.stack)
+        return value
+
+
+class _StacklessContext(Context):
+    """
+    A Context that doesn't keep track of the path to the value being normalized,
+    for compiled schemas that never look at it. The path is only needed for errors,
+    so when one is raised, the value is normalized again with a regular Context.
+    """
+
+    __slots__ = ()
+
+    def push_stack(self, x):
+        return self
+
+
+# The built-in registered functions are defined at module level (rather than as
+# lambdas) so that they can be referenced by import path.
+def _default_list(_):
+    return []
+
+
+def _default_dict(_):
+    return {}
+
+
+def _default_set(_):
+    return set()
+
+
+def _coerce_to_list(x):
+    return [x] if not isinstance(x, list) else x
+
+
+def _coerce_to_set(x):
+    return {x} if not isinstance(x, set) else x
 
 
 INIT_CONTEXT = Context(
-    stack=(),
     allow_unknown=False,
     default_registry={
-        "list": lambda _: [],
-        "dict": lambda _: {},
-        "set": lambda _: set(),
-    },
-    coerce_registry={
-        "to_list": lambda x: [x] if not isinstance(x, list) else x,
-        "to_set": lambda x: {x} if not isinstance(x, set) else x,
+        "list": _default_list,
+        "dict": _default_dict,
+        "set": _default_set,
     },
+    coerce_registry={"to_list": _coerce_to_list, "to_set": _coerce_to_set},
 )
 
 
@@ -125,16 +314,72 @@ def normalize_dict(dict_schema, value, stack=(), allow_unknown=False):
     return _normalize_dict(dict_schema, value, ctx)
 
 
-def normalize_schema(schema, value, stack=(), allow_unknown=False):
+def normalize_schema(schema, value, stack=(), allow_unknown=False, inplace=False):
     """Normalize a value with a schema.
 
     This is the main entrypoint into sureberus. It will validate and normalize the given
-    value, returning a new value."""
+    value, returning a new value.
+
+    With `inplace=True`, the dicts and lists in the value are modified to hold the
+    normalized values instead of being copied, and the value itself is returned."""
     ctx = INIT_CONTEXT.set_allow_unknown(allow_unknown)
+    if inplace:
+        ctx = ctx._with_mode(_INPLACE)
     return _normalize_schema(schema, value, ctx)
 
 
-def _normalize_dict(dict_schema, value, ctx):
+def validate(schema, value, allow_unknown=False):
+    """Check that a value is valid according to a schema.
+
+    This raises the same error as `normalize_schema` would for an invalid value, but
+    the normalized value isn't built, which makes this faster."""
+    ctx = INIT_CONTEXT.set_allow_unknown(allow_unknown)._with_mode(_VALIDATE)
+    _normalize_schema(schema, value, ctx)
+
+
+def is_valid(schema, value, allow_unknown=False):
+    """Return whether `normalize_schema` would accept a value."""
+    try:
+        validate(schema, value, allow_unknown=allow_unknown)
+    except E.SureError:
+        return False
+    return True
+
+
+def _validate_dict(dict_schema, value, ctx, cache=None):
+    """
+    Do everything `_normalize_dict` does except for building the new dict. Returns
+    the new dict when it can't avoid building it, and otherwise None.
+    """
+    extra_keys = set(value.keys()) - set(dict_schema.keys())
+    if extra_keys and not ctx.allow_unknown:
+        raise E.UnknownFields(value, extra_keys, stack=ctx.stack)
+    for key, key_schema in dict_schema.items():
+        key_schema = _resolve_field_schema(key_schema, ctx, cache)
+        if "rename" in key_schema:
+            # Renamed fields can end up replacing other fields in the new dict, so
+            # we'd have to keep track of it anyway.
+            ctx = ctx._with_mode(_NORMALIZE)
+            return _normalize_dict(dict_schema, value, ctx, cache)
+        if key not in value:
+            field_value = _get_default(key, key_schema, value, ctx)
+            if field_value is _marker:
+                if key_schema.get("required", False):
+                    raise E.DictFieldNotFound(key, value=value, stack=ctx.stack)
+                continue
+        else:
+            field_value = value[key]
+        _normalize_schema(key_schema, field_value, ctx.push_stack(key))
+        excludes = key_schema.get("excludes", [])
+        if not isinstance(excludes, list):
+            excludes = [excludes]
+        for excluded_field in excludes:
+            if excluded_field in value:
+                raise E.DisallowedField(key, excluded_field, ctx.stack)
+    return None
+
+
+def _normalize_dict(dict_schema, value, ctx, cache=None):
     new_dict = {}
     extra_keys = set(value.keys()) - set(dict_schema.keys())
     if extra_keys:
@@ -144,17 +389,7 @@ def _normalize_dict(dict_schema, value, ctx):
         else:
             raise E.UnknownFields(value, extra_keys, stack=ctx.stack)
     for key, key_schema in dict_schema.items():
-        if isinstance(key_schema, str):
-            key_schema = ctx.find_schema(key_schema)
-        if "schema_ref" in key_schema:
-            # The key_schema might have a schema_ref that merges in defaults and
-            # renames and who knows what else!
-            # It's pretty ugly that we have to deal with this here,
-            # but then all of the `default`, `required`, `rename` etc directives are
-            # pretty hacky in general!
-            key_schema = key_schema.copy()
-            reffed_schema = ctx.find_schema(key_schema.pop("schema_ref"))
-            key_schema = _merge_schemas(reffed_schema, key_schema)
+        key_schema = _resolve_field_schema(key_schema, ctx, cache)
         new_key = key_schema.get("rename", key)
         if key not in value:
             replacement = _get_default(key, key_schema, value, ctx)
@@ -181,6 +416,80 @@ def _normalize_dict(dict_schema, value, ctx):
     return new_dict
 
 
+def _normalize_dict_inplace(dict_schema, value, ctx, cache=None):
+    """
+    Like `_normalize_dict`, but store the normalized fields in `value` instead of in
+    a new dict, and return `value`.
+    """
+    extra_keys = set(value.keys()) - set(dict_schema.keys())
+    if extra_keys and not ctx.allow_unknown:
+        raise E.UnknownFields(value, extra_keys, stack=ctx.stack)
+    fields = dict_schema.items()
+    for key_schema in dict_schema.values():
+        if isinstance(key_schema, str) or "schema_ref" in key_schema:
+            # The fields have to be looked at before any of them are normalized
+            fields = [
+                (key, _resolve_field_schema(key_schema, ctx, cache))
+                for key, key_schema in fields
+            ]
+            break
+    renames = setters = False
+    for key, key_schema in fields:
+        if "rename" in key_schema:
+            renames = True
+        if "default_setter" in key_schema:
+            setters = True
+    if renames or setters:
+        # Renamed fields can replace other fields, and `default_setter` functions
+        # are given the dict as it was given, so build a new dict and put its
+        # contents in the old one.
+        if setters:
+            # Nothing inside of the dict may be modified before they see it either
+            ctx = ctx._with_mode(_NORMALIZE)
+        new_dict = _normalize_dict(dict_schema, value, ctx, cache)
+        value.clear()
+        value.update(new_dict)
+        return value
+    defaulted = ()
+    for key, key_schema in fields:
+        if key not in value:
+            replacement = _get_default(key, key_schema, value, ctx)
+            if replacement is _marker:
+                if key_schema.get("required", False):
+                    raise E.DictFieldNotFound(key, value=value, stack=ctx.stack)
+                continue
+            value[key] = replacement
+            defaulted += (key,)
+        value[key] = _normalize_schema(key_schema, value[key], ctx.push_stack(key))
+        excludes = key_schema.get("excludes", [])
+        if not isinstance(excludes, list):
+            excludes = [excludes]
+        for excluded_field in excludes:
+            # Fields that were filled in with their default weren't in the dict
+            if excluded_field in value and excluded_field not in defaulted:
+                raise E.DisallowedField(key, excluded_field, ctx.stack)
+    return value
+
+
+def _resolve_field_schema(key_schema, ctx, cache=None):
+    if isinstance(key_schema, str):
+        key_schema = ctx.find_schema(key_schema)
+    if "schema_ref" in key_schema:
+        # The key_schema might have a schema_ref that merges in defaults and
+        # renames and who knows what else!
+        # It's pretty ugly that we have to deal with this here,
+        # but then all of the `default`, `required`, `rename` etc directives are
+        # pretty hacky in general!
+        reffed_schema = ctx.find_schema(key_schema["schema_ref"])
+        if cache is None:
+            key_schema = _merge_schema_ref(reffed_schema, key_schema)
+        else:
+            key_schema = cache.get(
+                (reffed_schema, key_schema), _merge_schema_ref, ctx
+            ).schema
+    return key_schema
+
+
 def _get_default(key, key_schema, doc, ctx):
     default = key_schema.get("default", _marker)
     if default is not _marker:
@@ -188,6 +497,9 @@ def _get_default(key, key_schema, doc, ctx):
 
     default_copy = key_schema.get("default_copy", _marker)
     if default_copy is not _marker:
+        if ctx._mode is _VALIDATE:
+            # Nothing modifies the default, so there's no need to copy it.
+            return default_copy
         return deepcopy(default_copy)
 
     default_setter = key_schema.get("default_setter", None)
@@ -219,19 +531,18 @@ TYPES_BY_PRECEDENCE = [
 ]
 TYPES = dict(TYPES_BY_PRECEDENCE)
 
-_directive_count = 0
+# Directives are applied in the order in which they're defined
+_directive_order = itertools.count()
 
 
 def directive(directive_name, short_circuit=False):
     def decorator(method):
-        global _directive_count
         method.sureberus_directive = {
             "directive": directive_name,
             "short_circuit": short_circuit,
-            "order": _directive_count,
+            "order": next(_directive_order),
             "method": method,
         }
-        _directive_count += 1
         return method
 
     return decorator
@@ -249,7 +560,81 @@ class _ShortCircuit(object):
 
 @attr.s
 class Normalizer(object):
+    """
+    Applies a single schema node to values.
+
+    The directives present in the schema are looked up and ordered once, when the
+    Normalizer is created, so that a Normalizer can be reused for many values.
+    """
+
     schema = attr.ib()
+    directives = attr.ib(init=False, repr=False, cmp=False)
+    _cache = attr.ib(init=False, repr=False, cmp=False)
+    _type_names = attr.ib(init=False, repr=False, cmp=False)
+    _checks = attr.ib(init=False, repr=False, cmp=False)
+    _branch_stats = attr.ib(init=False, repr=False, cmp=False)
+
+    def __attrs_post_init__(self):
+        unknown_directives = set(self.schema.keys()) - _KNOWN_DIRECTIVES
+        if unknown_directives:
+            raise E.UnknownSchemaDirectives(unknown_directives)
+        self._plan()
+
+    @classmethod
+    def _unchecked(cls, schema):
+        """
+        Create a Normalizer without checking for unknown directives, for schemas
+        that are already known to be valid.
+        """
+        normalizer = cls.__new__(cls)
+        normalizer.schema = schema
+        normalizer._plan()
+        return normalizer
+
+    def _plan(self):
+        directives = [_DIRECTIVES[name] for name in self.schema if name in _DIRECTIVES]
+        directives.sort(key=lambda d: d["order"])
+        self.directives = [
+            (directive["method"], self.schema[directive["directive"]])
+            for directive in directives
+        ]
+        self._cache = _NormalizerCache()
+        # The type name that `when_type_is` chooses, for each type of value
+        self._type_names = {}
+        self._checks = None
+        self._branch_stats = {}
+        # Whether, when validating, the values built by directives like `fields` or
+        # `elements` are used by a later directive, and so must be built.
+        names = [directive["directive"] for directive in directives]
+        building = [name in _BUILDING_DIRECTIVES for name in names]
+        self._uses_built_value = True in building and (
+            len(names) - building.index(True) > 1
+        )
+
+    def could_match(self, value):
+        """
+        Quickly check whether this schema could possibly accept a value. If this
+        returns False, normalizing the value is certain to raise a SureError.
+        """
+        if self._checks is None:
+            self._checks = _find_checks(self.schema)
+        if value is None and self.schema.get("nullable"):
+            return True
+        for check in self._checks:
+            if not check(value):
+                return False
+        return True
+
+    def normalize(self, value, ctx):
+        if ctx._mode is _VALIDATE and self._uses_built_value:
+            ctx = ctx._with_mode(_NORMALIZE)
+        for method, directive_value in self.directives:
+            result = method(self, value, directive_value, ctx)
+            if isinstance(result, _ShortCircuit):
+                return result.value
+            else:
+                value, ctx = result
+        return value
 
     @directive("debug")
     def handle_debug(self, value, directive_value, ctx):
@@ -297,10 +682,13 @@ class Normalizer(object):
 
     @directive("schema_ref")
     def handle_schema_ref(self, value, directive_value, ctx):
-        og_schema = self.schema.copy()
-        del og_schema["schema_ref"]
-        new_schema = _merge_schemas(ctx.find_schema(directive_value), og_schema)
-        return _ShortCircuit(_normalize_schema(new_schema, value, ctx))
+        normalizer = self._schema_ref_normalizer(directive_value, ctx)
+        return _ShortCircuit(normalizer.normalize(value, ctx))
+
+    def _schema_ref_normalizer(self, directive_value, ctx):
+        return self._cache.get(
+            (ctx.find_schema(directive_value), self.schema), _merge_schema_ref, ctx
+        )
 
     @directive("allow_unknown")
     def handle_allow_unknown(self, value, directive_value, ctx):
@@ -361,22 +749,31 @@ class Normalizer(object):
         """
         A directive that allows dynamically choosing a schema based on all SORTS of stuff.
         """
+        normalizer = self._chosen_normalizer(value, directive_value, ctx)
+        return _ShortCircuit(normalizer.normalize(value, ctx))
+
+    def _chosen_normalizer(self, value, directive_value, ctx):
+        """Find the Normalizer for the schema that `choose_schema` chooses."""
         # TODO: validate w/ a when_key_exists schema. Only one should be allowed.
         if "when_tag_is" in directive_value:
-            return self._handle_when_tag_is(value, directive_value["when_tag_is"], ctx)
+            return self._when_tag_is_normalizer(
+                value, directive_value["when_tag_is"], ctx
+            )
         elif "function" in directive_value:
             schema = directive_value["function"](value, ctx)
-            return _ShortCircuit(_normalize_schema(schema, value, ctx))
+            if isinstance(schema, str):
+                schema = ctx.find_schema(schema)
+            return _get_normalizer(schema, ctx)
         elif "when_key_is" in directive_value:
-            return self._handle_when_key_is(
+            return self._when_key_is_normalizer(
                 value, directive_value["when_key_is"], ctx, "choose_schema"
             )
         elif "when_key_exists" in directive_value:
-            return self._handle_when_key_exists(
+            return self._when_key_exists_normalizer(
                 value, directive_value["when_key_exists"], ctx, "choose_schema"
             )
         elif "when_type_is" in directive_value:
-            return self._handle_when_type_is(
+            return self._when_type_is_normalizer(
                 value, directive_value["when_type_is"], ctx
             )
         else:
@@ -384,13 +781,18 @@ class Normalizer(object):
                 msg="`choose_schema` must have `when_tag_is`, `function`, `when_key_is`, `when_key_exists`, or `when_type_is` directives inside."
             )
 
-    def _handle_when_type_is(self, value, choices, ctx):
-        # This could be more optimal.
-        result_type = None
-        for tyname, typeset in TYPES_BY_PRECEDENCE:
-            if isinstance(value, typeset) and tyname in choices:
-                result_type = tyname
-                break
+    def _when_type_is_normalizer(self, value, choices, ctx):
+        try:
+            result_type = self._type_names[type(value)]
+        except KeyError:
+            result_type = None
+            for tyname, typeset in TYPES_BY_PRECEDENCE:
+                if isinstance(value, typeset) and tyname in choices:
+                    result_type = tyname
+                    break
+            if len(self._type_names) >= _NORMALIZER_CACHE_SIZE:
+                self._type_names.clear()
+            self._type_names[type(value)] = result_type
 
         if result_type is None:
             raise E.NoTypeMatch(
@@ -401,12 +803,9 @@ class Normalizer(object):
         chosen_schema = choices[result_type]
         if isinstance(chosen_schema, str):
             chosen_schema = ctx.find_schema(chosen_schema)
-        og_schema = self.schema.copy()
-        del og_schema["choose_schema"]
-        new_schema = _merge_schemas(og_schema, chosen_schema)
-        return _ShortCircuit(_normalize_schema(new_schema, value, ctx))
+        return self._cache.get((choices, chosen_schema), self._merge_choice, ctx)
 
-    def _handle_when_tag_is(self, value, directive_value, ctx):
+    def _when_tag_is_normalizer(self, value, directive_value, ctx):
         choice_key = directive_value["tag"]
         chosen = ctx.get_tag(choice_key, directive_value.get("default_choice", _marker))
         if chosen not in directive_value["choices"]:
@@ -416,10 +815,12 @@ class Normalizer(object):
         subschema = directive_value["choices"][chosen]
         if isinstance(subschema, str):
             subschema = ctx.find_schema(subschema)
+        return self._cache.get((directive_value, subschema), self._merge_choice, ctx)
+
+    def _merge_choice(self, directive_value, subschema):
         og_schema = self.schema.copy()
         del og_schema["choose_schema"]
-        new_schema = _merge_schemas(og_schema, subschema)
-        return _ShortCircuit(_normalize_schema(new_schema, value, ctx))
+        return _merge_schemas(og_schema, subschema)
 
     @directive("when_key_is")
     def handle_when_key_is(self, value, directive_value, ctx):
@@ -427,12 +828,42 @@ class Normalizer(object):
             "The top-level `when_key_is` directive is deprecated. Please use `choose_schema`.",
             DeprecationWarning,
         )
-        return self._handle_when_key_is(value, directive_value, ctx, "when_key_is")
+        normalizer = self._when_key_is_normalizer(
+            value, directive_value, ctx, "when_key_is"
+        )
+        return _ShortCircuit(normalizer.normalize(value, ctx))
 
-    def _handle_when_key_is(self, value, directive_value, ctx, directive_name):
+    def _when_key_is_normalizer(self, value, directive_value, ctx, directive_name):
         # At this point, we *need* this thing to be a dict, so we can look up
         # keys. So let's make sure it's a dict.
         self.handle_type(value, "dict", ctx)
+        choice_key = directive_value["key"]
+        if choice_key not in value:
+            if "default_choice" in directive_value:
+                chosen_type = directive_value["default_choice"]
+            else:
+                raise E.DictFieldNotFound(choice_key, value, ctx.stack)
+        else:
+            chosen_type = value[choice_key]
+        if chosen_type not in directive_value["choices"]:
+            raise E.DisallowedValue(
+                chosen_type,
+                list(directive_value["choices"].keys()),
+                ctx.push_stack(choice_key).stack,
+            )
+        subschema = directive_value["choices"][chosen_type]
+        if isinstance(subschema, str):
+            subschema = ctx.find_schema(subschema)
+        # The merged schema for each choice is only created once per Normalizer, so
+        # choosing a schema costs little more than looking it up.
+        return self._cache.get(
+            (directive_value, subschema),
+            self._merge_key_is_choice,
+            ctx,
+            directive_name,
+        )
+
+    def _merge_key_is_choice(self, directive_name, directive_value, subschema):
         choice_key = directive_value["key"]
         new_schema = self.schema.copy()
         # Make sure that the new schema does not include the same `choose_schema`
@@ -450,20 +881,6 @@ class Normalizer(object):
             fields = new_schema.setdefault(fields_directive, {}).copy()
             fields[choice_key] = {"allowed": allowed_choices}
             new_schema[fields_directive] = fields
-        if choice_key not in value:
-            if "default_choice" in directive_value:
-                chosen_type = directive_value["default_choice"]
-            else:
-                raise E.DictFieldNotFound(choice_key, value, ctx.stack)
-        else:
-            chosen_type = value[choice_key]
-        if chosen_type not in directive_value["choices"]:
-            raise E.DisallowedValue(
-                chosen_type, allowed_choices, ctx.push_stack(choice_key).stack
-            )
-        subschema = directive_value["choices"][chosen_type]
-        if isinstance(subschema, str):
-            subschema = ctx.find_schema(subschema)
         subschema = subschema.copy()
         new_schema["fields"] = new_schema.pop(fields_directive, {}).copy()
         if "fields" in subschema:
@@ -471,7 +888,7 @@ class Normalizer(object):
         else:
             new_schema["fields"].update(subschema.pop("schema", {}))
         new_schema.update(subschema)
-        return _ShortCircuit(_normalize_schema(new_schema, value, ctx))
+        return new_schema
 
     @directive("when_key_exists")
     def handle_when_key_exists(self, value, directive_value, ctx):
@@ -479,30 +896,41 @@ class Normalizer(object):
             "The top-level `when_key_exists` directive is deprecated. Please use `choose_schema`.",
             DeprecationWarning,
         )
-        return self._handle_when_key_exists(
+        normalizer = self._when_key_exists_normalizer(
             value, directive_value, ctx, "when_key_exists"
         )
+        return _ShortCircuit(normalizer.normalize(value, ctx))
 
-    def _handle_when_key_exists(self, value, directive_value, ctx, directive_name):
+    def _when_key_exists_normalizer(self, value, directive_value, ctx, directive_name):
         self.handle_type(value, "dict", ctx)
-        chosen_type = None
-        possible_keys = list(directive_value.keys())
-        for key in possible_keys:
-            if key in value:
-                if chosen_type is not None:
-                    raise E.DisallowedField(chosen_type, key, ctx.stack)
-                chosen_type = key
-        if chosen_type is None:
-            raise E.ExpectedOneField(possible_keys, value, ctx.stack)
+        # Look through whichever of the two dicts is smaller.
+        if len(value) < len(directive_value):
+            present = [key for key in value if key in directive_value]
+        else:
+            present = [key for key in directive_value if key in value]
+        if len(present) > 1:
+            possible_keys = list(directive_value.keys())
+            present.sort(key=possible_keys.index)
+            raise E.DisallowedField(present[0], present[1], ctx.stack)
+        elif not present:
+            raise E.ExpectedOneField(list(directive_value.keys()), value, ctx.stack)
+        chosen_type = present[0]
+
+        subschema = directive_value[chosen_type]
+        if isinstance(subschema, str):
+            subschema = ctx.find_schema(subschema)
+        return self._cache.get(
+            (directive_value, subschema),
+            self._merge_key_exists_choice,
+            ctx,
+            directive_name,
+        )
 
+    def _merge_key_exists_choice(self, directive_name, directive_value, subschema):
         new_schema = self.schema.copy()
         # Make sure that the new schema does not include the same `choose_schema`
         # or `when_key_is` directive, to avoid infinite recursion
         del new_schema[directive_name]
-
-        subschema = directive_value[chosen_type]
-        if isinstance(subschema, str):
-            subschema = ctx.find_schema(subschema)
         subschema = subschema.copy()
         # this is some shenanigans to support both "fields" and "schema"
         if "schema" in new_schema:
@@ -516,15 +944,21 @@ class Normalizer(object):
         else:
             new_schema["fields"].update(subschema.pop("schema", {}))
         new_schema.update(subschema)
-        return _ShortCircuit(_normalize_schema(new_schema, value, ctx))
+        return new_schema
 
     @directive("oneof")
     def handle_oneof(self, value, directive_value, ctx):
-        return _ShortCircuit(_normalize_multi(self.schema, value, "oneof", ctx))
+        return _ShortCircuit(
+            _normalize_multi(self.schema, value, "oneof", ctx, self._cache)
+        )
 
     @directive("anyof")
     def handle_anyof(self, value, _directive_value, ctx):
-        return _ShortCircuit(_normalize_multi(self.schema, value, "anyof", ctx))
+        return _ShortCircuit(
+            _normalize_multi(
+                self.schema, value, "anyof", ctx, self._cache, self._branch_stats
+            )
+        )
 
     @directive("allowed")
     def handle_allowed(self, value, directive_value, ctx):
@@ -582,6 +1016,14 @@ class Normalizer(object):
 
     @directive("keyschema")
     def handle_keyschema(self, value, directive_value, ctx):
+        # Directives never modify the value they're given, since `anyof` and `oneof`
+        # pass the same value to each of their rules.
+        if ctx._mode is _VALIDATE:
+            for k in value:
+                _normalize_schema(directive_value, k, ctx.push_stack(k))
+            return (value, ctx)
+        if ctx._mode is not _INPLACE:
+            value = value.copy()
         for k in list(value.keys()):
             new_key = _normalize_schema(directive_value, k, ctx.push_stack(k))
             value[new_key] = value.pop(k)
@@ -589,12 +1031,41 @@ class Normalizer(object):
 
     @directive("valueschema")
     def handle_valueschema(self, value, directive_value, ctx):
+        if ctx._mode is _VALIDATE:
+            for k, v in value.items():
+                _normalize_schema(directive_value, v, ctx.push_stack(k))
+            return (value, ctx)
+        if ctx._mode is _INPLACE:
+            for k, v in value.items():
+                value[k] = _normalize_schema(directive_value, v, ctx.push_stack(k))
+            return (value, ctx)
+        result = {}
         for k, v in value.items():
-            value[k] = _normalize_schema(directive_value, v, ctx.push_stack(k))
-        return (value, ctx)
+            result[k] = _normalize_schema(directive_value, v, ctx.push_stack(k))
+        return (result, ctx)
 
     @directive("elements")
     def handle_elements(self, value, directive_value, ctx):
+        compiled = ctx.compiled
+        if (
+            compiled is not None
+            and compiled.elements_workers
+            and isinstance(value, list)
+            and len(value) >= compiled.elements_threshold
+        ):
+            result = compiled._normalize_elements(directive_value, value, ctx)
+            if result is not _marker:
+                return (result, ctx)
+        if ctx._mode is _VALIDATE:
+            for idx, element in enumerate(value):
+                _normalize_schema(directive_value, element, ctx.push_stack(idx))
+            return (value, ctx)
+        if ctx._mode is _INPLACE and isinstance(value, list):
+            for idx, element in enumerate(value):
+                value[idx] = _normalize_schema(
+                    directive_value, element, ctx.push_stack(idx)
+                )
+            return (value, ctx)
         result = [
             _normalize_schema(directive_value, element, ctx.push_stack(idx))
             for idx, element in enumerate(value)
@@ -603,7 +1074,13 @@ class Normalizer(object):
 
     @directive("fields")
     def handle_fields(self, value, directive_value, ctx):
-        return (_normalize_dict(directive_value, value, ctx), ctx)
+        if ctx._mode is _VALIDATE:
+            new_dict = _validate_dict(directive_value, value, ctx, self._cache)
+            return (value if new_dict is None else new_dict, ctx)
+        if ctx._mode is _INPLACE:
+            value = _normalize_dict_inplace(directive_value, value, ctx, self._cache)
+            return (value, ctx)
+        return (_normalize_dict(directive_value, value, ctx, self._cache), ctx)
 
     @directive("schema")
     def handle_schema(self, value, directive_value, ctx):
@@ -629,7 +1106,7 @@ class Normalizer(object):
         validate only after all other normalization has been done.
         The only exception is `coerce_post`.
         """
-        field = ctx.stack[-1] if len(ctx.stack) else None
+        field = ctx._frame.key
 
         def error(f, m):
             raise E.CustomValidatorError(f, m, stack=ctx.stack)
@@ -692,64 +1169,410 @@ def _merge_schemas(schema1, schema2):
     return new_schema
 
 
+def _merge_schema_ref(reffed_schema, schema):
+    """Merge a schema that has a `schema_ref` with the schema it refers to."""
+    og_schema = schema.copy()
+    del og_schema["schema_ref"]
+    return _merge_schemas(reffed_schema, og_schema)
+
+
+# The maximum number of entries in a _NormalizerCache. This only matters when new
+# schemas keep being created at runtime, e.g. by `modify_context`.
+_NORMALIZER_CACHE_SIZE = 256
+
+
+class _NormalizerCache(object):
+    """
+    Normalizers for the schemas that a Normalizer creates out of other schemas,
+    like the merge of a schema with the schema named by its `schema_ref`.
+
+    Entries are keyed by the identities of the schemas they're made from, so if a
+    name refers to a different schema (say, because a nested `registry` directive
+    shadows it), a new entry is made. The cache holds on to those schemas, so that
+    their ids can't be reused by other objects.
+    """
+
+    def __init__(self):
+        self._entries = {}
+
+    def get(self, schemas, make, ctx, *args):
+        """
+        Get the Normalizer for the schema made by `make(*args + schemas)`. The
+        `args` must be hashable.
+        """
+        key = args + tuple(id(schema) for schema in schemas)
+        entry = self._entries.get(key)
+        if entry is None:
+            if len(self._entries) >= _NORMALIZER_CACHE_SIZE:
+                self._entries.clear()
+            entry = (schemas, _get_normalizer(make(*(args + schemas)), ctx))
+            self._entries[key] = entry
+        return entry[1]
+
+
 def _normalize_schema(schema, value, ctx):
     if isinstance(schema, str):
         schema = ctx.find_schema(schema)
-    normalizer = Normalizer(schema)
-    directives = _get_directives(normalizer)
-    known_directives = set(directive["directive"] for directive in directives)
-    # These are handled outside of the directive machinery
-    known_directives.update(
-        {"excludes", "required", "default", "default_copy", "default_setter", "rename"}
-    )
-    unknown_directives = set(schema.keys()) - known_directives
-    if unknown_directives:
-        raise E.UnknownSchemaDirectives(unknown_directives)
-    for directive in directives:
-        if directive["directive"] in schema:
-            directive_value = schema[directive["directive"]]
-            result = directive["method"](normalizer, value, directive_value, ctx)
-            if isinstance(result, _ShortCircuit):
-                return result.value
-            else:
-                value, ctx = result
-    return value
+    return _get_normalizer(schema, ctx).normalize(value, ctx)
 
 
-def _get_directives(normalizer):
-    directives = []
-    for (name, value) in getmembers(normalizer):
+def _get_normalizer(schema, ctx):
+    """
+    Find the Normalizer for a schema, reusing the one prepared by `compile_schema`
+    if this schema is part of a compiled schema.
+    """
+    if ctx.compiled is not None:
+        normalizer = ctx.compiled._normalizers.get(id(schema))
+        if normalizer is not None:
+            return normalizer
+        if ctx.compiled._checked:
+            # Schemas that aren't part of the compiled schema itself are merged
+            # together from parts of it, which have all been checked already.
+            return Normalizer._unchecked(schema)
+    return Normalizer(schema)
+
+
+def _get_directives(cls):
+    directives = {}
+    for (name, value) in getmembers(cls):
         directive = getattr(value, "sureberus_directive", None)
         if directive:
-            directives.append(directive)
-    directives.sort(key=lambda d: d["order"])
+            directives[directive["directive"]] = directive
     return directives
 
 
-def _normalize_multi(schema, value, key, ctx):
-    clone = deepcopy(value)
-    results = []
-    errors = []
-    matched_schemas = []
+_DIRECTIVES = _get_directives(Normalizer)
+# The directives whose result isn't the normalized value when validating
+_BUILDING_DIRECTIVES = frozenset(
+    ["oneof", "anyof", "keyschema", "valueschema", "elements", "fields", "schema"]
+)
+_KNOWN_DIRECTIVES = frozenset(_DIRECTIVES).union(
+    # These are handled outside of the directive machinery
+    {"excludes", "required", "default", "default_copy", "default_setter", "rename"}
+)
+
+
+def _merge_rule(key, schema, subrule):
+    """Merge a schema with one of the rules of its `anyof` or `oneof`."""
+    new_schema = schema.copy()
+    del new_schema[key]
+    new_schema.update(subrule)
+    return new_schema
+
+
+def _normalize_multi(schema, value, key, ctx, cache=None, branch_stats=None):
+    if ctx._mode is _INPLACE:
+        # Every rule is given the same value, so none of them may modify it. The
+        # result of the rule that matched is put in its place instead.
+        result = _normalize_multi(
+            schema, value, key, ctx._with_mode(_NORMALIZE), cache, branch_stats
+        )
+        if result is value:
+            return value
+        elif type(result) is type(value) and isinstance(value, dict):
+            value.clear()
+            value.update(result)
+            return value
+        elif type(result) is type(value) and isinstance(value, list):
+            value[:] = result
+            return value
+        return result
+    normalizers = _multi_normalizers(schema, key, ctx, cache)
+    if (
+        branch_stats is not None
+        and ctx.compiled is not None
+        and ctx.compiled.adaptive_anyof
+    ):
+        result = _apply_rules_adaptively(
+            branch_stats, normalizers, value, ctx, ctx.compiled.adaptive_anyof
+        )
+        if result is not _marker:
+            return result
+    if len(normalizers) > 1:
+        # Only try the rules that could match the value at all. If that doesn't
+        # produce a result, all of the rules are tried, so that the error is the
+        # same as it would have been.
+        candidates = [n for n in normalizers if n.could_match(value)]
+        if len(candidates) < len(normalizers):
+            results, errors, matched_schemas = _apply_rules(
+                schema, candidates, value, key, ctx
+            )
+            if len(results) == 1:
+                return results[0]
+    results, errors, matched_schemas = _apply_rules(
+        schema, normalizers, value, key, ctx
+    )
+    if not results:
+        raise E.NoneMatched(value, errors, ctx.stack)
+    elif key == "oneof" and len(results) > 1:
+        raise E.MoreThanOneMatched(value, matched_schemas, ctx.stack)
+    else:
+        return results[0]
+
+
+def _multi_normalizers(schema, key, ctx, cache=None):
+    """Find the Normalizers for the rules of an `anyof` or `oneof`."""
+    normalizers = []
     for subrule in schema[key]:
         if isinstance(subrule, str):
             subrule = ctx.find_schema(subrule)
-        cloned_schema = schema.copy()
-        del cloned_schema[key]
-        cloned_schema.update(subrule)
+        if cache is None:
+            normalizer = _get_normalizer(_merge_rule(key, schema, subrule), ctx)
+        else:
+            normalizer = cache.get((schema, subrule), _merge_rule, ctx, key)
+        normalizers.append(normalizer)
+    return normalizers
+
+
+def _apply_rules(schema, normalizers, value, key, ctx):
+    # Every rule is given the same value without copying it, since nothing in
+    # sureberus modifies the values it is given (and neither may coerce functions
+    # and such).
+    results = []
+    errors = []
+    matched_schemas = []
+    for normalizer in normalizers:
         try:
-            subresult = _normalize_schema(cloned_schema, clone, ctx)
+            subresult = normalizer.normalize(value, ctx)
         except E.SureError as e:
             errors.append(e)
         else:
+            results.append(subresult)
             if key == "oneof":
-                results.append(subresult)
                 matched_schemas.append(schema[key])
             elif key == "anyof":
-                return subresult
-    if not results:
-        raise E.NoneMatched(clone, errors, ctx.stack)
-    elif key == "oneof" and len(results) > 1:
-        raise E.MoreThanOneMatched(clone, matched_schemas, ctx.stack)
+                break
+    return results, errors, matched_schemas
+
+
+def _apply_rules_adaptively(branch_stats, normalizers, value, ctx, mode):
+    """
+    Try the rules of an `anyof` in the order in which they're most likely to match,
+    returning the first result, or _marker if none of them matched.
+    """
+    key = tuple(id(normalizer) for normalizer in normalizers)
+    stats = branch_stats.get(key)
+    if stats is None:
+        if len(branch_stats) >= _NORMALIZER_CACHE_SIZE:
+            branch_stats.clear()
+        stats = branch_stats[key] = _BranchStats(normalizers, mode)
+    if not stats.enabled:
+        return _marker
+    if isinstance(value, dict):
+        shape = (dict, frozenset(value))
     else:
-        return results[0]
+        shape = type(value)
+    predicted = stats.shapes.get(shape)
+    order = stats.order
+    if predicted is not None:
+        order = (predicted,) + tuple(index for index in order if index != predicted)
+    for index in order:
+        normalizer = normalizers[index]
+        if not normalizer.could_match(value):
+            continue
+        try:
+            result = normalizer.normalize(value, ctx)
+        except E.SureError:
+            continue
+        stats.matched(index, shape)
+        return result
+    return _marker
+
+
+class _BranchStats(object):
+    """
+    Counts of how often each of the rules of an `anyof` matched, and which rule
+    matched the last value of each "shape": its type, and its keys for dicts.
+
+    Unless `mode` is "always", this only gets enabled when at most one of the rules
+    can match any value, so that the order in which they're tried doesn't matter.
+
+    When used from several threads at once, counts may be lost, but the rules are
+    always all tried.
+    """
+
+    def __init__(self, normalizers, mode):
+        # Keep the normalizers alive, since they're identified by their ids.
+        self.normalizers = normalizers
+        self.enabled = mode == "always" or _rules_exclusive(
+            [normalizer.schema for normalizer in normalizers]
+        )
+        self.counts = [0] * len(normalizers)
+        self.order = tuple(range(len(normalizers)))
+        self.shapes = {}
+
+    def matched(self, index, shape):
+        counts = self.counts
+        counts[index] += 1
+        if self.shapes.get(shape) != index:
+            if len(self.shapes) >= _NORMALIZER_CACHE_SIZE:
+                self.shapes.clear()
+            self.shapes[shape] = index
+        order = self.order
+        if order[0] == index:
+            return
+        position = order.index(index)
+        if counts[order[position - 1]] < counts[index]:
+            # Move the rule up past all of the ones that matched less often. A new
+            # tuple is created, so that other threads never see a partial order.
+            new_order = list(order)
+            del new_order[position]
+            while position > 0 and counts[new_order[position - 1]] < counts[index]:
+                position -= 1
+            new_order.insert(position, index)
+            self.order = tuple(new_order)
+
+
+def _rules_exclusive(schemas):
+    """Check whether no value could match more than one of these schemas."""
+    signatures = [_rule_signature(schema) for schema in schemas]
+    if None in signatures:
+        return False
+    for idx, signature in enumerate(signatures):
+        for other in signatures[idx + 1:]:
+            if not _signatures_exclusive(signature, other):
+                return False
+    return True
+
+
+def _rule_signature(schema):
+    """
+    Describe what a schema could accept for `_rules_exclusive`: whether it accepts
+    None, the values it allows, the Python types it accepts, and the values allowed
+    for its required fields. Returns None if nothing can be said about the schema.
+    """
+    if _OPAQUE_DIRECTIVES.intersection(schema):
+        return None
+    nullable = bool(schema.get("nullable"))
+    allowed = schema.get("allowed")
+    if not isinstance(allowed, (list, tuple)):
+        allowed = None
+    types = None
+    type_ = schema.get("type")
+    if type_ in TYPES:
+        types = TYPES[type_]
+        if not isinstance(types, tuple):
+            types = (types,)
+    fields = {}
+    fields_schema = schema.get("fields", schema.get("schema"))
+    if (
+        type_ == "dict"
+        and isinstance(fields_schema, dict)
+        and not _NON_DICT_DIRECTIVES.intersection(schema)
+    ):
+        for key, field_schema in fields_schema.items():
+            if (
+                isinstance(field_schema, dict)
+                and field_schema.get("required", False)
+                and isinstance(field_schema.get("allowed"), (list, tuple))
+                and not field_schema.get("nullable")
+                and not {"default", "default_copy", "default_setter", "schema_ref"}
+                .union(_OPAQUE_DIRECTIVES)
+                .intersection(field_schema)
+            ):
+                fields[key] = field_schema["allowed"]
+    return nullable, allowed, types, fields
+
+
+def _signatures_exclusive(signature1, signature2):
+    nullable1, allowed1, types1, fields1 = signature1
+    nullable2, allowed2, types2, fields2 = signature2
+    if nullable1 and nullable2:
+        return False
+    # If only one of them accepts None, the other one must not.
+    if nullable1 and not _rejects_none(allowed2, types2):
+        return False
+    if nullable2 and not _rejects_none(allowed1, types1):
+        return False
+    if allowed1 is not None and allowed2 is not None:
+        if not any(a == b for a in allowed1 for b in allowed2):
+            return True
+    if types1 is not None and types2 is not None:
+        if not any(
+            issubclass(t1, t2) or issubclass(t2, t1) for t1 in types1 for t2 in types2
+        ):
+            return True
+    for key in set(fields1).intersection(fields2):
+        if not any(a == b for a in fields1[key] for b in fields2[key]):
+            return True
+    return False
+
+
+def _rejects_none(allowed, types):
+    if allowed is not None and None not in allowed:
+        return True
+    return types is not None and not issubclass(type(None), types)
+
+
+# Directives which run before `allowed` and `type`, and which may change the value,
+# have side effects, or raise something other than a SureError. `could_match` can't
+# tell anything about schemas with these.
+_OPAQUE_DIRECTIVES = frozenset(
+    [
+        "debug",
+        "schema_ref",
+        "coerce",
+        "coerce_with_context",
+        "modify_context",
+        "set_tag",
+        "choose_schema",
+        "when_key_is",
+        "when_key_exists",
+        "oneof",
+        "anyof",
+    ]
+)
+
+# Directives which run between `type` and `fields`, and which may raise something
+# other than a SureError for a dict.
+_NON_DICT_DIRECTIVES = frozenset(["min", "max", "keyschema", "valueschema", "elements"])
+
+
+def _find_checks(schema):
+    """
+    Find the checks for `Normalizer.could_match`: functions which tell whether a value
+    passes a schema's `allowed` and `type` directives, and whether a dict has the
+    required fields of the schema and allowed values for them.
+    """
+    if _OPAQUE_DIRECTIVES.intersection(schema):
+        return []
+    checks = []
+    allowed = schema.get("allowed")
+    if allowed is not None:
+        if not isinstance(allowed, (list, tuple)):
+            # `in` could raise a TypeError for a set or dict
+            return []
+        checks.append(lambda value: value in allowed)
+    type_ = schema.get("type")
+    if type_ not in TYPES:
+        return checks
+    types = TYPES[type_]
+    checks.append(lambda value: isinstance(value, types))
+    if type_ != "dict" or _NON_DICT_DIRECTIVES.intersection(schema):
+        return checks
+    fields = schema.get("fields", schema.get("schema"))
+    if not isinstance(fields, dict):
+        return checks
+    for key, field_schema in fields.items():
+        if not isinstance(field_schema, dict) or "schema_ref" in field_schema:
+            continue
+        if not {"default", "default_copy", "default_setter"}.intersection(
+            field_schema
+        ):
+            if field_schema.get("required", False):
+                checks.append(lambda value, key=key: key in value)
+        field_allowed = field_schema.get("allowed")
+        if (
+            isinstance(field_allowed, (list, tuple))
+            and not field_schema.get("nullable")
+            and not _OPAQUE_DIRECTIVES.intersection(field_schema)
+        ):
+            checks.append(
+                lambda value, key=key, field_allowed=field_allowed: key not in value
+                or value[key] in field_allowed
+            )
+    return checks
+
+
+from .compiler import CompiledSchema, check_schema, compile_schema  # noqa: E402
+from .batch import normalize_jsonl, normalize_many  # noqa: E402
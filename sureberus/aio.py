@@ -0,0 +1,573 @@
+"""
+Normalizing values with schemas whose functions may be coroutine functions.
+
+    from sureberus.aio import normalize_schema_async
+
+    normalized = await normalize_schema_async(schema, value)
+
+The `coerce`, `coerce_with_context`, `coerce_post`, `coerce_post_with_context`,
+`validator` and `default_setter` functions of a schema may return awaitables, which
+are awaited. The fields of a dict, the elements of a list, the values and keys of a
+`valueschema`/`keyschema` dict and the rules of a `oneof` are normalized
+concurrently, while the directives of each schema are still applied one after the
+other.
+"""
+
+import asyncio
+from collections import deque
+import contextvars
+from functools import partial
+from inspect import isawaitable
+import warnings
+
+from . import (
+    INIT_CONTEXT,
+    _DIRECTIVES,
+    _ShortCircuit,
+    _get_default,
+    _get_normalizer,
+    _marker,
+    _multi_normalizers,
+    _normalize_schema as _normalize_schema_sync,
+    _resolve_field_schema,
+)
+from . import errors as E
+from .compiler import CompiledSchema, compile_schema
+
+__all__ = ["normalize_schema_async", "normalize_aiter"]
+
+
+async def normalize_schema_async(schema, value, allow_unknown=False):
+    """Normalize a value with a schema, like `normalize_schema`, awaiting any
+    awaitables returned by the functions in the schema."""
+    ctx = INIT_CONTEXT.set_allow_unknown(allow_unknown)
+    token = _synchronous_schemas.set({})
+    try:
+        return await _normalize_schema(schema, value, ctx)
+    finally:
+        _synchronous_schemas.reset(token)
+
+
+async def normalize_aiter(
+    schema, values, concurrency=8, ordered=True, executor=None, allow_unknown=False
+):
+    """
+    Normalize the values of an async iterable with a schema, which is compiled once
+    for all of them (unless it's already a CompiledSchema), yielding an
+    `(index, result)` pair for each value like `normalize_many`.
+
+    The values are normalized in `executor` (the event loop's default executor, if
+    it's None), so that the event loop isn't blocked. At most `concurrency` values
+    are read from `values` ahead of the results that have been yielded. With
+    `ordered=False`, results are yielded as soon as they're ready instead of in the
+    order of the values.
+    """
+    if concurrency < 1:
+        raise ValueError("concurrency must be at least 1")
+    if not isinstance(schema, CompiledSchema):
+        schema = compile_schema(schema)
+    loop = asyncio.get_running_loop()
+    # In order: a deque of `(index, future)`; otherwise a dict of future to index.
+    pending = deque() if ordered else {}
+    index = 0
+    try:
+        async for value in values:
+            if len(pending) >= concurrency:
+                for result in await _finished(pending):
+                    yield result
+            future = loop.run_in_executor(
+                executor, _normalize_value, schema, value, allow_unknown
+            )
+            if ordered:
+                pending.append((index, future))
+            else:
+                pending[future] = index
+            index += 1
+        while pending:
+            for result in await _finished(pending):
+                yield result
+    finally:
+        # If the results stop being iterated over, don't normalize the rest.
+        if ordered:
+            for index, future in pending:
+                future.cancel()
+        else:
+            for future in pending:
+                future.cancel()
+
+
+async def _finished(pending):
+    """Wait for at least one of the pending values to be normalized."""
+    if isinstance(pending, deque):
+        index, future = pending[0]
+        result = await future
+        pending.popleft()
+        return [(index, result)]
+    done, _ = await asyncio.wait(list(pending), return_when=asyncio.FIRST_COMPLETED)
+    results = [(pending.pop(future), future.result()) for future in done]
+    results.sort(key=lambda result: result[0])
+    return results
+
+
+def _normalize_value(compiled, value, allow_unknown):
+    try:
+        return compiled.normalize(value, allow_unknown=allow_unknown)
+    except E.SureError as e:
+        return e
+
+
+async def _normalize_schema(schema, value, ctx):
+    if isinstance(schema, str):
+        schema = ctx.find_schema(schema)
+    return await _normalize(_get_normalizer(schema, ctx), value, ctx)
+
+
+async def _normalize(normalizer, value, ctx):
+    if _is_synchronous(normalizer.schema):
+        return normalizer.normalize(value, ctx)
+    for method, directive_value in normalizer.directives:
+        handler = _HANDLERS.get(method)
+        if handler is None:
+            result = method(normalizer, value, directive_value, ctx)
+        else:
+            result = await handler(normalizer, value, directive_value, ctx)
+        if isinstance(result, _ShortCircuit):
+            return result.value
+        else:
+            value, ctx = result
+    return value
+
+
+# The directives that never call a function from the schema that could return an
+# awaitable, or normalize anything but the value itself.
+_SYNCHRONOUS_DIRECTIVES = frozenset(
+    [
+        "debug",
+        "metadata",
+        "registry",
+        "default_registry",
+        "coerce_registry",
+        "validator_registry",
+        "modify_context_registry",
+        "allow_unknown",
+        "nullable",
+        "modify_context",
+        "set_tag",
+        "allowed",
+        "type",
+        "maxlength",
+        "minlength",
+        "min",
+        "max",
+        "regex",
+        # These are handled by the dict that the field is in
+        "required",
+        "excludes",
+        "rename",
+        "default",
+        "default_copy",
+    ]
+)
+
+
+# What `_is_synchronous` found out about each schema during the current call to
+# `normalize_schema_async`, as `{id(schema): (schema, synchronous)}`. The schemas
+# are kept so that their ids can't be reused by other objects.
+_synchronous_schemas = contextvars.ContextVar("_synchronous_schemas", default=None)
+
+
+def _is_synchronous(schema):
+    """
+    Check whether normalizing a value with a schema is certain not to call any
+    function that could return an awaitable, so that the regular `Normalizer` can
+    be used for it.
+    """
+    found = _synchronous_schemas.get()
+    if found is None:
+        return _check_synchronous(schema)
+    entry = found.get(id(schema))
+    if entry is None:
+        entry = found[id(schema)] = (schema, _check_synchronous(schema))
+    return entry[1]
+
+
+def _check_synchronous(schema):
+    if not isinstance(schema, dict):
+        return False
+    for directive, directive_value in schema.items():
+        if directive in ("keyschema", "valueschema", "elements"):
+            if not _is_synchronous(directive_value):
+                return False
+        elif directive == "fields":
+            for field_schema in directive_value.values():
+                if not _is_synchronous(field_schema):
+                    return False
+        elif directive not in _SYNCHRONOUS_DIRECTIVES:
+            return False
+    return True
+
+
+# How many jobs `_gather` runs concurrently, so that the elements of a big list
+# don't all have a coroutine at once
+_GATHER_BATCH_SIZE = 256
+
+
+async def _gather(jobs):
+    """
+    Run `jobs`, which are `(asynchronous, function, args)` tuples, and return their
+    results in order. The coroutine functions are called first and then awaited
+    concurrently, in batches. As when they're run one after the other, the
+    exception raised by the first failing job is raised.
+    """
+    results = []
+    for start in range(0, len(jobs), _GATHER_BATCH_SIZE):
+        end = start + _GATHER_BATCH_SIZE
+        results.extend(await _gather_batch(jobs[start:end]))
+    return results
+
+
+async def _gather_batch(jobs):
+    outcomes = []
+    pending = []
+    for asynchronous, function, args in jobs:
+        if asynchronous:
+            pending.append(len(outcomes))
+            outcomes.append(function(*args))
+        else:
+            try:
+                outcomes.append((True, function(*args)))
+            except Exception as e:
+                outcomes.append((False, e))
+                # The jobs after this one don't need to be run
+                break
+    if len(pending) == 1:
+        outcomes[pending[0]] = await _outcome(outcomes[pending[0]])
+    elif pending:
+        results = await asyncio.gather(
+            *[_outcome(outcomes[index]) for index in pending]
+        )
+        for index, result in zip(pending, results):
+            outcomes[index] = result
+    results = []
+    for ok, result in outcomes:
+        if not ok:
+            raise result
+        results.append(result)
+    return results
+
+
+async def _outcome(awaitable):
+    try:
+        return (True, await awaitable)
+    except Exception as e:
+        return (False, e)
+
+
+_HANDLERS = {}
+
+
+def _handles(name, handler):
+    _HANDLERS[_DIRECTIVES[name]["method"]] = handler
+
+
+async def _handle_schema_ref(normalizer, value, directive_value, ctx):
+    chosen = normalizer._schema_ref_normalizer(directive_value, ctx)
+    return _ShortCircuit(await _normalize(chosen, value, ctx))
+
+
+_handles("schema_ref", _handle_schema_ref)
+
+
+async def _handle_coerce(
+    normalizer, value, directive_value, ctx, directive, with_context
+):
+    try:
+        coerce = ctx.resolve_coerce(directive_value)
+        result = coerce(value, ctx) if with_context else coerce(value)
+        if isawaitable(result):
+            result = await result
+    except E.SureError:
+        raise
+    except Exception as e:
+        raise E.CoerceUnexpectedError(directive, value, e, ctx.stack)
+    return (result, ctx)
+
+
+_handles("coerce", partial(_handle_coerce, directive="coerce", with_context=False))
+_handles(
+    "coerce_with_context",
+    partial(_handle_coerce, directive="coerce_with_context", with_context=True),
+)
+_handles(
+    "coerce_post", partial(_handle_coerce, directive="coerce_post", with_context=False)
+)
+_handles(
+    "coerce_post_with_context",
+    partial(_handle_coerce, directive="coerce_post_with_context", with_context=True),
+)
+
+
+async def _handle_validator(normalizer, value, directive_value, ctx):
+    field = ctx._frame.key
+
+    def error(f, m):
+        raise E.CustomValidatorError(f, m, stack=ctx.stack)
+
+    try:
+        result = ctx.resolve_validator(directive_value)(field, value, error)
+        if isawaitable(result):
+            await result
+    except E.SureError:
+        raise
+    except Exception as e:
+        raise E.ValidatorUnexpectedError(field, value, e, ctx.stack)
+    return (value, ctx)
+
+
+_handles("validator", _handle_validator)
+
+
+async def _handle_choose_schema(normalizer, value, directive_value, ctx):
+    chosen = normalizer._chosen_normalizer(value, directive_value, ctx)
+    return _ShortCircuit(await _normalize(chosen, value, ctx))
+
+
+_handles("choose_schema", _handle_choose_schema)
+
+
+async def _handle_when_key_is(normalizer, value, directive_value, ctx):
+    warnings.warn(
+        "The top-level `when_key_is` directive is deprecated. "
+        "Please use `choose_schema`.",
+        DeprecationWarning,
+    )
+    chosen = normalizer._when_key_is_normalizer(
+        value, directive_value, ctx, "when_key_is"
+    )
+    return _ShortCircuit(await _normalize(chosen, value, ctx))
+
+
+_handles("when_key_is", _handle_when_key_is)
+
+
+async def _handle_when_key_exists(normalizer, value, directive_value, ctx):
+    warnings.warn(
+        "The top-level `when_key_exists` directive is deprecated. "
+        "Please use `choose_schema`.",
+        DeprecationWarning,
+    )
+    chosen = normalizer._when_key_exists_normalizer(
+        value, directive_value, ctx, "when_key_exists"
+    )
+    return _ShortCircuit(await _normalize(chosen, value, ctx))
+
+
+_handles("when_key_exists", _handle_when_key_exists)
+
+
+async def _handle_multi(normalizer, value, directive_value, ctx, key):
+    schema = normalizer.schema
+    normalizers = _multi_normalizers(schema, key, ctx, normalizer._cache)
+    if len(normalizers) > 1:
+        # Only try the rules that could match the value at all, as
+        # `_normalize_multi` does.
+        candidates = [n for n in normalizers if n.could_match(value)]
+        if len(candidates) < len(normalizers):
+            results, errors = await _apply_rules(candidates, value, key, ctx)
+            if len(results) == 1:
+                return _ShortCircuit(results[0])
+    results, errors = await _apply_rules(normalizers, value, key, ctx)
+    if not results:
+        raise E.NoneMatched(value, errors, ctx.stack)
+    elif key == "oneof" and len(results) > 1:
+        raise E.MoreThanOneMatched(value, [schema[key]] * len(results), ctx.stack)
+    return _ShortCircuit(results[0])
+
+
+async def _apply_rules(normalizers, value, key, ctx):
+    if key == "oneof":
+        # Every rule is tried anyway
+        outcomes = await asyncio.gather(
+            *[
+                _outcome(_normalize(normalizer, value, ctx))
+                for normalizer in normalizers
+            ]
+        )
+    else:
+        outcomes = []
+        for normalizer in normalizers:
+            outcome = await _outcome(_normalize(normalizer, value, ctx))
+            outcomes.append(outcome)
+            if outcome[0]:
+                break
+    results = []
+    errors = []
+    for ok, result in outcomes:
+        if ok:
+            results.append(result)
+        elif isinstance(result, E.SureError):
+            errors.append(result)
+        else:
+            raise result
+    return results, errors
+
+
+_handles("oneof", partial(_handle_multi, key="oneof"))
+_handles("anyof", partial(_handle_multi, key="anyof"))
+
+
+async def _handle_keyschema(normalizer, value, directive_value, ctx):
+    keys = list(value.keys())
+    new_keys = await _gather(
+        [
+            (True, _normalize_schema, (directive_value, k, ctx.push_stack(k)))
+            for k in keys
+        ]
+    )
+    value = value.copy()
+    for k, new_key in zip(keys, new_keys):
+        value[new_key] = value.pop(k)
+    return (value, ctx)
+
+
+_handles("keyschema", _handle_keyschema)
+
+
+async def _handle_valueschema(normalizer, value, directive_value, ctx):
+    keys = list(value.keys())
+    results = await _gather(
+        [
+            (True, _normalize_schema, (directive_value, value[k], ctx.push_stack(k)))
+            for k in keys
+        ]
+    )
+    return (dict(zip(keys, results)), ctx)
+
+
+_handles("valueschema", _handle_valueschema)
+
+
+async def _handle_elements(normalizer, value, directive_value, ctx):
+    results = await _gather(
+        [
+            (True, _normalize_schema, (directive_value, element, ctx.push_stack(idx)))
+            for idx, element in enumerate(value)
+        ]
+    )
+    return (results, ctx)
+
+
+_handles("elements", _handle_elements)
+
+
+async def _handle_fields(normalizer, value, directive_value, ctx):
+    return (await _normalize_dict(directive_value, value, ctx, normalizer._cache), ctx)
+
+
+_handles("fields", _handle_fields)
+
+
+async def _handle_schema(normalizer, value, directive_value, ctx):
+    # See `Normalizer.handle_schema`
+    if isinstance(value, list):
+        return await _handle_elements(normalizer, value, directive_value, ctx)
+    elif isinstance(value, dict):
+        return await _handle_fields(normalizer, value, directive_value, ctx)
+    return (value, ctx)
+
+
+_handles("schema", _handle_schema)
+
+
+async def _normalize_dict(dict_schema, value, ctx, cache=None):
+    """
+    Like `_normalize_dict`, but the fields are normalized concurrently. When a field
+    is renamed, it could replace another field, so then they're normalized one
+    after the other instead.
+    """
+    new_dict = {}
+    extra_keys = set(value.keys()) - set(dict_schema.keys())
+    if extra_keys:
+        if ctx.allow_unknown:
+            for k in extra_keys:
+                new_dict[k] = value[k]
+        else:
+            raise E.UnknownFields(value, extra_keys, stack=ctx.stack)
+    fields = [
+        (key, _resolve_field_schema(key_schema, ctx, cache))
+        for key, key_schema in dict_schema.items()
+    ]
+    if any("rename" in key_schema for key, key_schema in fields):
+        for key, key_schema in fields:
+            new_key = key_schema.get("rename", key)
+            if key not in value:
+                replacement = await _get_default_async(key, key_schema, value, ctx)
+                if replacement is not _marker:
+                    new_dict[new_key] = replacement
+                elif key_schema.get("required", False):
+                    raise E.DictFieldNotFound(key, value=value, stack=ctx.stack)
+            else:
+                new_dict[new_key] = value[key]
+            if new_key in new_dict:
+                new_dict[new_key] = await _normalize_schema(
+                    key_schema, new_dict[new_key], ctx.push_stack(key)
+                )
+                _check_excludes(key, key_schema, value, ctx)
+        return new_dict
+    jobs = []
+    for key, key_schema in fields:
+        if _is_synchronous(key_schema):
+            jobs.append((False, _normalize_field_sync, (key, key_schema, value, ctx)))
+        else:
+            jobs.append((True, _normalize_field, (key, key_schema, value, ctx)))
+    for (key, key_schema), result in zip(fields, await _gather(jobs)):
+        if result is not _marker:
+            new_dict[key] = result
+    return new_dict
+
+
+async def _normalize_field(key, key_schema, doc, ctx):
+    if key not in doc:
+        value = await _get_default_async(key, key_schema, doc, ctx)
+        if value is _marker:
+            if key_schema.get("required", False):
+                raise E.DictFieldNotFound(key, value=doc, stack=ctx.stack)
+            return _marker
+    else:
+        value = doc[key]
+    value = await _normalize_schema(key_schema, value, ctx.push_stack(key))
+    _check_excludes(key, key_schema, doc, ctx)
+    return value
+
+
+def _normalize_field_sync(key, key_schema, doc, ctx):
+    if key not in doc:
+        value = _get_default(key, key_schema, doc, ctx)
+        if value is _marker:
+            if key_schema.get("required", False):
+                raise E.DictFieldNotFound(key, value=doc, stack=ctx.stack)
+            return _marker
+    else:
+        value = doc[key]
+    value = _normalize_schema_sync(key_schema, value, ctx.push_stack(key))
+    _check_excludes(key, key_schema, doc, ctx)
+    return value
+
+
+async def _get_default_async(key, key_schema, doc, ctx):
+    default = _get_default(key, key_schema, doc, ctx)
+    if isawaitable(default):
+        try:
+            default = await default
+        except Exception as e:
+            raise E.DefaultSetterUnexpectedError(key, doc, e, ctx.stack)
+    return default
+
+
+def _check_excludes(key, key_schema, doc, ctx):
+    excludes = key_schema.get("excludes", [])
+    if not isinstance(excludes, list):
+        excludes = [excludes]
+    for excluded_field in excludes:
+        if excluded_field in doc:
+            raise E.DisallowedField(key, excluded_field, ctx.stack)
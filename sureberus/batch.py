@@ -0,0 +1,376 @@
+"""
+Normalizing many values with the same schema.
+"""
+
+from __future__ import absolute_import
+
+from collections import deque
+from itertools import islice
+import json
+import mmap
+import multiprocessing
+import os
+import random
+from timeit import default_timer
+
+import attr
+
+from . import errors as E
+from .compiler import CompiledSchema, compile_schema
+
+# Chunks of values sent to worker processes are sized so that normalizing one takes
+# about this many seconds, which is long enough that sending it is cheap in
+# comparison, and short enough that the workers are kept evenly busy.
+_CHUNK_SECONDS = 0.05
+_MAX_CHUNK_SIZE = 10000
+# How many chunks per worker are sent ahead of the results that are being yielded
+_CHUNKS_PER_WORKER = 2
+
+
+def normalize_many(
+    schema, values, allow_unknown=False, inplace=False, workers=None, durations=None
+):
+    """
+    Normalize each of an iterable of values with a schema, which is compiled once
+    for all of them (unless it's already a CompiledSchema).
+
+    Returns a `BatchResults`, which lazily yields an `(index, result)` pair for each
+    value, where `result` is either the normalized value or the `SureError` that
+    normalizing it raised. An invalid value doesn't stop the rest from being
+    normalized.
+
+    With `workers`, the values are normalized in that many worker processes.
+
+    With `durations`, a `DurationSample`, how long normalizing each value takes is
+    recorded in it.
+    """
+    if not isinstance(schema, CompiledSchema):
+        schema = compile_schema(schema)
+    return BatchResults(
+        schema,
+        values,
+        allow_unknown=allow_unknown,
+        inplace=inplace,
+        workers=workers,
+        durations=durations,
+    )
+
+
+@attr.s
+class BatchSummary(object):
+    """
+    How many values have been normalized so far, and how many of them raised each
+    type of `SureError`.
+    """
+
+    total = attr.ib(default=0)
+    error_counts = attr.ib(default=attr.Factory(dict))
+    durations = attr.ib(default=None)
+
+    @property
+    def invalid(self):
+        return sum(self.error_counts.values())
+
+    @property
+    def valid(self):
+        return self.total - self.invalid
+
+
+class DurationSample(object):
+    """
+    A sample of how long normalizing each of a batch of values took, in seconds.
+    At most `size` durations are kept, chosen uniformly at random from all of the
+    ones that are added.
+    """
+
+    def __init__(self, size=10000):
+        self.size = size
+        self.count = 0
+        self._durations = []
+
+    def add(self, duration):
+        self.count += 1
+        if len(self._durations) < self.size:
+            self._durations.append(duration)
+        else:
+            index = random.randrange(self.count)
+            if index < self.size:
+                self._durations[index] = duration
+
+    def percentile(self, percent):
+        """The duration that `percent` percent of the sampled durations are within."""
+        if not self._durations:
+            return None
+        durations = sorted(self._durations)
+        return durations[min(len(durations) - 1, int(len(durations) * percent / 100.0))]
+
+
+class BatchResults(object):
+    """
+    An iterator of the results of `normalize_many`. Its `summary` is updated as the
+    values are normalized.
+    """
+
+    def __init__(
+        self,
+        compiled,
+        values,
+        allow_unknown=False,
+        inplace=False,
+        workers=None,
+        durations=None,
+    ):
+        self.summary = BatchSummary(durations=durations)
+        if workers is None or workers == 1:
+            results = self._normalize(compiled, values, allow_unknown, inplace)
+        else:
+            results = self._normalize_in_pool(
+                compiled, values, allow_unknown, inplace, workers
+            )
+        self._results = results
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self._results)
+
+    next = __next__  # Python 2
+
+    def _normalize(self, compiled, values, allow_unknown, inplace):
+        summary = self.summary
+        error_counts = summary.error_counts
+        durations = summary.durations
+        normalize = compiled.normalize
+        for index, value in enumerate(values):
+            if durations is not None:
+                start = default_timer()
+            try:
+                result = normalize(value, allow_unknown=allow_unknown, inplace=inplace)
+            except E.SureError as e:
+                result = e
+                error_counts[type(e)] = error_counts.get(type(e), 0) + 1
+            if durations is not None:
+                durations.add(default_timer() - start)
+            summary.total += 1
+            yield (index, result)
+
+    def _normalize_in_pool(self, compiled, values, allow_unknown, inplace, workers):
+        summary = self.summary
+        error_counts = summary.error_counts
+        durations = summary.durations
+        timed = durations is not None
+        # The schema is sent to each worker once, rather than with every chunk.
+        pool = multiprocessing.Pool(workers, _init_worker, (compiled,))
+        try:
+            values = iter(values)
+            chunk_size = 1
+            index = 0
+            pending = deque()
+            while True:
+                while len(pending) < workers * _CHUNKS_PER_WORKER:
+                    chunk = list(islice(values, chunk_size))
+                    if not chunk:
+                        break
+                    pending.append(
+                        (
+                            index,
+                            pool.apply_async(
+                                _normalize_chunk,
+                                (chunk, allow_unknown, inplace, timed),
+                            ),
+                        )
+                    )
+                    index += len(chunk)
+                if not pending:
+                    break
+                start, async_result = pending.popleft()
+                results, errors, elapsed, chunk_durations = async_result.get()
+                chunk_size = _next_chunk_size(len(results), elapsed)
+                if timed:
+                    for duration in chunk_durations:
+                        durations.add(duration)
+                for offset, result in enumerate(results):
+                    if offset in errors:
+                        error_counts[type(result)] = (
+                            error_counts.get(type(result), 0) + 1
+                        )
+                    summary.total += 1
+                    yield (start + offset, result)
+        finally:
+            pool.terminate()
+
+
+def normalize_jsonl(
+    schema,
+    path,
+    allow_unknown=False,
+    workers=None,
+    durations=None,
+    valid_path=None,
+    invalid_path=None,
+):
+    """
+    Normalize each line of a JSON Lines file at `path` with a schema, like
+    `normalize_many`. The file is memory-mapped and read one line at a time, so it
+    doesn't have to fit in memory.
+
+    Returns a `JSONLinesResults`, which lazily yields a `(line_number, result)`
+    pair for each line that isn't blank, where `result` is either the normalized
+    value or the error that decoding or normalizing the line raised.
+
+    With `valid_path`, the normalized values are written to that file as JSON
+    Lines. With `invalid_path`, the lines that are invalid are copied to that file
+    as they are.
+    """
+    if not isinstance(schema, CompiledSchema):
+        schema = compile_schema(schema)
+    return JSONLinesResults(
+        schema,
+        path,
+        allow_unknown=allow_unknown,
+        workers=workers,
+        durations=durations,
+        valid_path=valid_path,
+        invalid_path=invalid_path,
+    )
+
+
+class JSONLinesResults(BatchResults):
+    """
+    An iterator of the results of `normalize_jsonl`. Lines that aren't valid JSON
+    are counted in its `summary` by the type of their `ValueError`.
+    """
+
+    def __init__(
+        self,
+        compiled,
+        path,
+        allow_unknown=False,
+        workers=None,
+        durations=None,
+        valid_path=None,
+        invalid_path=None,
+    ):
+        # The lines whose results haven't been yielded yet, as
+        # `(line_number, line, decode_error)`.
+        lines = deque()
+        BatchResults.__init__(
+            self,
+            compiled,
+            _decode_lines(path, lines),
+            allow_unknown=allow_unknown,
+            workers=workers,
+            durations=durations,
+        )
+        self._results = self._number(self._results, lines, valid_path, invalid_path)
+
+    def _number(self, results, lines, valid_path, invalid_path):
+        summary = self.summary
+        error_counts = summary.error_counts
+        valid_file = open(valid_path, "w") if valid_path is not None else None
+        invalid_file = open(invalid_path, "wb") if invalid_path is not None else None
+        try:
+            for _, result in results:
+                line_number, line, error = lines.popleft()
+                # Lines that couldn't be decoded are yielded in order with the
+                # results of the lines around them.
+                while error is not None:
+                    error_counts[type(error)] = error_counts.get(type(error), 0) + 1
+                    summary.total += 1
+                    _write_line(invalid_file, line)
+                    yield (line_number, error)
+                    line_number, line, error = lines.popleft()
+                if isinstance(result, Exception):
+                    _write_line(invalid_file, line)
+                elif valid_file is not None:
+                    valid_file.write(json.dumps(result) + "\n")
+                yield (line_number, result)
+            for line_number, line, error in lines:
+                error_counts[type(error)] = error_counts.get(type(error), 0) + 1
+                summary.total += 1
+                _write_line(invalid_file, line)
+                yield (line_number, error)
+        finally:
+            if valid_file is not None:
+                valid_file.close()
+            if invalid_file is not None:
+                invalid_file.close()
+
+
+def _decode_lines(path, lines):
+    """
+    Yield the values decoded from the lines of a JSON Lines file, recording each
+    line in `lines`.
+    """
+    with open(path, "rb") as f:
+        # Empty files can't be memory-mapped.
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            readline = mapped.readline
+            line_number = 0
+            while True:
+                line = readline()
+                if not line:
+                    break
+                line_number += 1
+                if line.isspace():
+                    continue
+                try:
+                    value = json.loads(line.decode("utf-8"))
+                except ValueError as e:
+                    lines.append((line_number, line, e))
+                    continue
+                lines.append((line_number, line, None))
+                yield value
+        finally:
+            mapped.close()
+
+
+def _write_line(f, line):
+    if f is not None:
+        f.write(line if line.endswith(b"\n") else line + b"\n")
+
+
+def _next_chunk_size(size, elapsed):
+    if elapsed <= 0:
+        return min(size * 2, _MAX_CHUNK_SIZE)
+    return max(1, min(int(size * _CHUNK_SECONDS / elapsed), _MAX_CHUNK_SIZE))
+
+
+# The schema that a worker process normalizes values with
+_worker_schema = None
+
+
+def _init_worker(compiled):
+    global _worker_schema
+    _worker_schema = compiled
+
+
+def _normalize_chunk(values, allow_unknown, inplace, timed):
+    """
+    Normalize a chunk of values in a worker process. Returns the results, the
+    indices of the results that are errors, how long it took, and (if `timed`) how
+    long each value took.
+    """
+    start = default_timer()
+    normalize = _worker_schema.normalize
+    results = []
+    errors = set()
+    durations = [] if timed else None
+    for value in values:
+        if timed:
+            value_start = default_timer()
+        try:
+            results.append(
+                normalize(value, allow_unknown=allow_unknown, inplace=inplace)
+            )
+        except E.SureError as e:
+            # Fields of errors that aren't plain data come back as Unpicklables.
+            errors.add(len(results))
+            results.append(e)
+        if timed:
+            durations.append(default_timer() - value_start)
+    return results, errors, default_timer() - start, durations
@@ -0,0 +1,225 @@
+"""
+The `sureberus` command line tool.
+
+    python -m sureberus compile schema.yaml -o myschema_validator.py
+    python -m sureberus validate schema.yaml documents.jsonl -o normalized.jsonl
+"""
+
+from __future__ import absolute_import, print_function
+
+import argparse
+import json
+import sys
+from timeit import default_timer
+
+import six
+
+from .batch import DurationSample, normalize_jsonl, normalize_many
+from .codegen import generate_module, resolve_import_path
+from .compiler import ENGINES, compile_schema
+
+# Registries of functions. A schema loaded from a file can't contain functions, so
+# instead the values of these registries are import paths, like "mymodule:myfunc".
+FUNCTION_REGISTRIES = (
+    "coerce_registry",
+    "default_registry",
+    "validator_registry",
+    "modify_context_registry",
+)
+
+
+def load_schema(path):
+    """
+    Load a schema from a YAML or JSON file, importing the functions referenced in
+    its function registries.
+    """
+    with open(path) as f:
+        text = f.read()
+    if path.endswith(".json"):
+        schema = json.loads(text)
+    else:
+        try:
+            import yaml
+        except ImportError:
+            raise SystemExit("PyYAML must be installed to load YAML schemas")
+        schema = yaml.safe_load(text)
+    _resolve_function_registries(schema)
+    return schema
+
+
+def _resolve_function_registries(obj):
+    if isinstance(obj, dict):
+        for key, value in obj.items():
+            if key in FUNCTION_REGISTRIES and isinstance(value, dict):
+                for name, function in value.items():
+                    if isinstance(function, six.string_types) and ":" in function:
+                        value[name] = resolve_import_path(function)
+            else:
+                _resolve_function_registries(value)
+    elif isinstance(obj, list):
+        for item in obj:
+            _resolve_function_registries(item)
+
+
+def compile_command(args):
+    schema = load_schema(args.schema)
+    source = generate_module(schema, description="the schema in {}".format(args.schema))
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(source)
+    else:
+        sys.stdout.write(source)
+
+
+def validate_command(args):
+    compiled = compile_schema(load_schema(args.schema), engine=args.engine)
+    durations = DurationSample()
+    output = open(args.output, "w") if args.output else None
+    report = open(args.errors, "w") if args.errors else sys.stderr
+    total = 0
+    error_counts = {}
+    start = default_timer()
+    try:
+        for path in args.inputs:
+            for line_number, result in _normalize_input(
+                compiled, path, args, durations
+            ):
+                total += 1
+                if output is not None and not isinstance(result, Exception):
+                    try:
+                        line = json.dumps(result)
+                    except (TypeError, ValueError) as e:
+                        # The document can't be written, e.g. a `coerce` made a
+                        # set in it, so it's reported like an invalid one.
+                        result = e
+                if isinstance(result, Exception):
+                    name = type(result).__name__
+                    error_counts[name] = error_counts.get(name, 0) + 1
+                    report.write(
+                        json.dumps(
+                            {
+                                "file": path,
+                                "line": line_number,
+                                "error": name,
+                                "message": str(result),
+                            }
+                        )
+                        + "\n"
+                    )
+                elif output is not None:
+                    output.write(line + "\n")
+    finally:
+        if output is not None:
+            output.close()
+        if report is not sys.stderr:
+            report.close()
+    elapsed = default_timer() - start
+    _print_stats(total, error_counts, elapsed, durations)
+    return 1 if error_counts else 0
+
+
+def _normalize_input(compiled, path, args, durations):
+    """
+    Normalize the documents in a JSON file (which is one document) or a JSON Lines
+    file, yielding `(line_number, result)` pairs.
+    """
+    if not path.endswith(".json"):
+        return normalize_jsonl(
+            compiled,
+            path,
+            allow_unknown=args.allow_unknown,
+            workers=args.workers,
+            durations=durations,
+        )
+    with open(path) as f:
+        try:
+            document = json.load(f)
+        except ValueError as e:
+            return [(None, e)]
+    batch = normalize_many(
+        compiled, [document], allow_unknown=args.allow_unknown, durations=durations
+    )
+    return [(None, result) for _, result in batch]
+
+
+def _print_stats(total, error_counts, elapsed, durations):
+    print(
+        "{} documents ({} valid, {} invalid) in {:.2f}s: {:.0f} documents/s".format(
+            total,
+            total - sum(error_counts.values()),
+            sum(error_counts.values()),
+            elapsed,
+            total / elapsed if elapsed > 0 else 0,
+        )
+    )
+    if durations.count:
+        print(
+            "Normalizing each document took: p50 {:.1f}us, p99 {:.1f}us".format(
+                durations.percentile(50) * 1e6, durations.percentile(99) * 1e6
+            )
+        )
+    for name, count in sorted(error_counts.items()):
+        print("{}: {}".format(name, count))
+
+
+def make_parser():
+    parser = argparse.ArgumentParser(
+        prog="sureberus", description="Validate and normalize documents."
+    )
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+
+    compile_parser = subparsers.add_parser(
+        "compile", help="Generate a Python module that normalizes values with a schema."
+    )
+    compile_parser.add_argument("schema", help="A YAML or JSON schema file.")
+    compile_parser.add_argument(
+        "-o", "--output", help="Where to write the module (default: standard output)."
+    )
+    compile_parser.set_defaults(function=compile_command)
+
+    validate_parser = subparsers.add_parser(
+        "validate",
+        help="Normalize JSON or JSON Lines documents with a schema, reporting the "
+        "invalid ones and how long normalizing took.",
+    )
+    validate_parser.add_argument("schema", help="A YAML or JSON schema file.")
+    validate_parser.add_argument(
+        "inputs",
+        nargs="+",
+        help="JSON files, each of which is one document, or JSON Lines files.",
+    )
+    validate_parser.add_argument(
+        "-o", "--output", help="Where to write the normalized documents as JSON Lines."
+    )
+    validate_parser.add_argument(
+        "-e",
+        "--errors",
+        help="Where to write a JSON Lines report of the invalid documents "
+        "(default: standard error).",
+    )
+    validate_parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        help="How many worker processes to normalize JSON Lines files in.",
+    )
+    validate_parser.add_argument(
+        "--engine", default="interpreter", choices=ENGINES, help="See compile_schema."
+    )
+    validate_parser.add_argument(
+        "--allow-unknown",
+        action="store_true",
+        help="Allow fields that aren't in the schema.",
+    )
+    validate_parser.set_defaults(function=validate_command)
+    return parser
+
+
+def main(argv=None):
+    """
+    Run a command. Returns the exit status, which is 1 if `validate` found invalid
+    documents.
+    """
+    args = make_parser().parse_args(argv)
+    return args.function(args)
@@ -0,0 +1,822 @@
+"""
+Generate specialized Python source code for a schema.
+
+Every schema node becomes a Python function `(value, ctx) -> value`. Common
+directives like `type`, `min`/`max`, `allowed`, `regex`, `coerce`, `elements` and
+`fields` are turned into inline code, with string references to registered schemas
+and functions resolved while generating. Everything else -- e.g. `choose_schema`,
+`anyof`, `modify_context` -- calls into the regular directive handlers, so the
+generated code always behaves exactly like `Normalizer`.
+"""
+
+from copy import deepcopy
+import importlib
+import itertools
+import linecache
+import re
+import threading
+
+import six
+
+from . import (
+    INIT_CONTEXT,
+    Normalizer,
+    TYPES,
+    _DIRECTIVES,
+    _ShortCircuit,
+    _get_default,
+    _marker,
+    _merge_schemas,
+    _normalize_dict,
+    _normalize_schema,
+)
+from . import errors as E
+
+# These are all of the keys of a schema that only matter when the schema is used
+# for a field in a dict. A schema with nothing else in it never changes a value.
+_FIELD_ONLY_KEYS = frozenset(
+    [
+        "metadata",
+        "required",
+        "default",
+        "default_copy",
+        "default_setter",
+        "rename",
+        "excludes",
+    ]
+)
+
+# Directives whose presence makes us hand the whole schema node to the interpreter.
+# `modify_context` can change the registries in arbitrary ways, which means we can't
+# resolve references ahead of time, and `debug` wants to print the schema.
+_INTERPRETED_DIRECTIVES = frozenset(["modify_context", "debug"])
+
+_REGISTRIES = [
+    ("registry", "schema_registry", "register_schemas"),
+    ("default_registry", "default_registry", "register_defaults"),
+    ("coerce_registry", "coerce_registry", "register_coerces"),
+    ("validator_registry", "validator_registry", "register_validators"),
+    ("modify_context_registry", "modify_context_registry", "register_modify_contexts"),
+]
+
+# A limit on how many registries can be layered on top of each other while
+# generating code, before we give up and leave the rest to the interpreter.
+_MAX_REGISTRY_DEPTH = 32
+
+_RUNTIME = {
+    "_E": E,
+    "_SureError": E.SureError,
+    "_ShortCircuit": _ShortCircuit,
+    "_deepcopy": deepcopy,
+    "_get_default": _get_default,
+    "_marker": _marker,
+    "_normalize_dict": _normalize_dict,
+    "_normalize_schema": _normalize_schema,
+}
+
+# Constants of these types are written into generated code as literals.
+_LITERAL_TYPES = (type(None), bool, float, six.text_type, six.binary_type) + tuple(
+    six.integer_types
+)
+_INFINITIES = (float("inf"), float("-inf"))
+
+_generated_count = itertools.count(1)
+_generated_count_lock = threading.Lock()
+
+
+def generate(schema):
+    """
+    Generate code for a schema, returning a tuple of `(source, namespace, name)`:
+    the source code, the globals it must be executed with, and the name of the
+    function that normalizes values with the root of the schema.
+    """
+    generator = _Generator()
+    name = generator.function_for(schema, _Env.initial())
+    generator.generate_pending()
+    return generator.source(), generator.namespace(), name
+
+
+def generate_module(schema, description="a schema"):
+    """
+    Generate the source code of a Python module which normalizes values with a
+    schema, through a function `normalize(value, allow_unknown=False)`.
+
+    Functions used in the schema are imported by the module, so they must be
+    importable by their `__module__` and `__qualname__`. Everything else in the
+    schema must be plain data.
+    """
+    generator = _Generator()
+    name = generator.function_for(schema, _Env.initial())
+    generator.generate_pending()
+    return _ModuleWriter(generator).write(description, generator.constant(schema), name)
+
+
+def compile_function(schema):
+    """Generate code for a schema and return the function for its root."""
+    source, namespace, name = generate(schema)
+    with _generated_count_lock:
+        filename = "<sureberus generated {}>".format(next(_generated_count))
+    # Registering the source with linecache lets tracebacks show generated code.
+    linecache.cache[filename] = (len(source), None, source.splitlines(True), filename)
+    six.exec_(compile(source, filename, "exec"), namespace)
+    return namespace[name]
+
+
+class _Env(object):
+    """
+    The registries that are in effect at some point in a schema.
+
+    Registries are kept as chains of mappings instead of being merged together, so
+    that the same combination of registries always has the same `key`.
+    """
+
+    def __init__(self, chains):
+        self.chains = chains
+        self.key = tuple(
+            tuple(id(m) for m in chains[kind]) for kind, _, _ in _REGISTRIES
+        )
+
+    @classmethod
+    def initial(cls):
+        return cls(
+            {
+                kind: (getattr(INIT_CONTEXT, attribute),)
+                for kind, attribute, _ in _REGISTRIES
+            }
+        )
+
+    def push(self, kind, mapping):
+        chain = tuple(m for m in self.chains[kind] if m is not mapping) + (mapping,)
+        chains = self.chains.copy()
+        chains[kind] = chain
+        return _Env(chains)
+
+    def too_deep(self):
+        return any(len(chain) > _MAX_REGISTRY_DEPTH for chain in self.chains.values())
+
+    def lookup(self, kind, name):
+        for mapping in reversed(self.chains[kind]):
+            if name in mapping:
+                return mapping[name]
+        return _marker
+
+    def resolve_schema(self, schema):
+        if isinstance(schema, str):
+            return self.lookup("registry", schema)
+        return schema
+
+    def resolve_function(self, kind, thing):
+        if isinstance(thing, six.string_types):
+            return self.lookup(kind, thing)
+        return thing
+
+
+class _Writer(object):
+    def __init__(self):
+        self.lines = []
+        self.indentation = 1
+
+    def __call__(self, line):
+        self.lines.append("    " * self.indentation + line)
+
+    def indent(self):
+        self.indentation += 1
+
+    def dedent(self):
+        self.indentation -= 1
+
+
+class _Generator(object):
+    def __init__(self):
+        self._constants = {}
+        self._constant_ids = {}
+        self._sources = {}
+        self._functions = {}
+        self._pending = []
+        self._bodies = []
+        self._merged = {}
+        self._normalizers = {}
+
+    def source(self):
+        return "\n\n".join(self._bodies) + "\n"
+
+    def namespace(self):
+        namespace = dict(_RUNTIME)
+        namespace.update(self._constants)
+        return namespace
+
+    def constant(self, obj, source=None, dependencies=()):
+        """
+        Make an object available to the generated code, returning its name.
+
+        `source` is an expression that recreates the object when generating a
+        module, for objects that can't be written out as literals. `dependencies`
+        are the names of other constants used in `source`.
+        """
+        if type(obj) in _LITERAL_TYPES and obj == obj and obj not in _INFINITIES:
+            return repr(obj)
+        name = self._constant_ids.get(id(obj))
+        if name is None:
+            name = "_k{}".format(len(self._constants))
+            self._constants[name] = obj
+            self._constant_ids[id(obj)] = name
+            if source is not None:
+                self._sources[name] = (source, dependencies)
+        return name
+
+    def _normalizer(self, schema):
+        if id(schema) not in self._normalizers:
+            self._normalizers[id(schema)] = Normalizer(schema)
+        return self._normalizers[id(schema)]
+
+    def normalizer(self, schema):
+        """Make a Normalizer for a schema available to the generated code."""
+        schema_name = self.constant(schema)
+        return self.constant(
+            self._normalizer(schema),
+            source="_Normalizer({})".format(schema_name),
+            dependencies=[schema_name],
+        )
+
+    def merge(self, schema1, schema2):
+        # Merging is memoized so that recursive references always produce the very
+        # same merged schema, and therefore the same generated function.
+        key = (id(schema1), id(schema2))
+        if key not in self._merged:
+            self._merged[key] = (schema1, schema2, _merge_schemas(schema1, schema2))
+        return self._merged[key][2]
+
+    def function_for(self, schema, env):
+        key = (id(schema), env.key)
+        if key not in self._functions:
+            name = "_n{}".format(len(self._functions))
+            self._functions[key] = name
+            self.constant(schema)
+            self._pending.append((name, schema, env))
+        return self._functions[key]
+
+    def generate_pending(self):
+        while self._pending:
+            name, schema, env = self._pending.pop()
+            w = _Writer()
+            self.generate_body(w, schema, env)
+            self._bodies.append(
+                "def {}(value, ctx):\n{}".format(name, "\n".join(w.lines))
+            )
+
+    def generate_body(self, w, schema, env):
+        if _INTERPRETED_DIRECTIVES.intersection(schema) or env.too_deep():
+            w("return {}.normalize(value, ctx)".format(self.normalizer(schema)))
+            return
+        for method, directive_value in self._normalizer(schema).directives:
+            name = method.sureberus_directive["directive"]
+            emitter = getattr(self, "emit_" + name, None)
+            handled = False
+            if emitter is not None:
+                handled = emitter(w, schema, directive_value, env)
+            if handled is True:
+                continue
+            elif isinstance(handled, _Env):
+                env = handled
+            elif handled == "return":
+                return
+            else:
+                self.emit_handler(w, name, schema, directive_value)
+        w("return value")
+
+    def emit_handler(self, w, name, schema, directive_value):
+        """Call the interpreter's handler for a directive."""
+        normalizer = self.normalizer(schema)
+        handler = self.constant(
+            _DIRECTIVES[name]["method"],
+            source="_DIRECTIVES[{!r}]['method']".format(name),
+        )
+        w(
+            "result = {}({}, value, {}, ctx)".format(
+                handler, normalizer, self.constant(directive_value)
+            )
+        )
+        w("if result.__class__ is _ShortCircuit:")
+        w("    return result.value")
+        w("value, ctx = result")
+
+    def child_call(self, schema, env, value_expr, ctx_expr):
+        """
+        Return an expression that normalizes `value_expr` with a (resolved) schema,
+        or None if the schema never changes anything.
+        """
+        if not (set(schema) - _FIELD_ONLY_KEYS):
+            return None
+        return "{}({}, {})".format(self.function_for(schema, env), value_expr, ctx_expr)
+
+    def emit_metadata(self, w, schema, directive_value, env):
+        return True
+
+    def _emit_registry(kind):
+        def emit(self, w, schema, directive_value, env):
+            method = [m for k, _, m in _REGISTRIES if k == kind][0]
+            w("ctx = ctx.{}({})".format(method, self.constant(directive_value)))
+            return env.push(kind, directive_value)
+
+        return emit
+
+    emit_registry = _emit_registry("registry")
+    emit_default_registry = _emit_registry("default_registry")
+    emit_coerce_registry = _emit_registry("coerce_registry")
+    emit_validator_registry = _emit_registry("validator_registry")
+    emit_modify_context_registry = _emit_registry("modify_context_registry")
+    del _emit_registry
+
+    def emit_schema_ref(self, w, schema, directive_value, env):
+        referenced = env.resolve_schema(directive_value)
+        if referenced is _marker:
+            return False
+        og_schema = schema.copy()
+        del og_schema["schema_ref"]
+        # Merging an equal copy of the schema every time would lose memoization
+        og_schema = self._merged.setdefault(
+            ("without-ref", id(schema)), (schema, None, og_schema)
+        )[2]
+        new_schema = self.merge(referenced, og_schema)
+        w("return {}(value, ctx)".format(self.function_for(new_schema, env)))
+        return "return"
+
+    def emit_allow_unknown(self, w, schema, directive_value, env):
+        w("ctx = ctx.set_allow_unknown({})".format(self.constant(directive_value)))
+        return True
+
+    def _emit_coerce(self, w, directive_value, env, directive, with_context):
+        coerce = env.resolve_function("coerce_registry", directive_value)
+        if coerce is _marker:
+            return False
+        w("try:")
+        w(
+            "    value = {}(value{})".format(
+                self.constant(coerce), ", ctx" if with_context else ""
+            )
+        )
+        w("except _SureError:")
+        w("    raise")
+        w("except Exception as e:")
+        w(
+            "    raise _E.CoerceUnexpectedError({!r}, value, e, ctx.stack)".format(
+                directive
+            )
+        )
+        return True
+
+    def emit_coerce(self, w, schema, directive_value, env):
+        return self._emit_coerce(w, directive_value, env, "coerce", False)
+
+    def emit_coerce_with_context(self, w, schema, directive_value, env):
+        return self._emit_coerce(w, directive_value, env, "coerce_with_context", True)
+
+    def emit_coerce_post(self, w, schema, directive_value, env):
+        return self._emit_coerce(w, directive_value, env, "coerce_post", False)
+
+    def emit_coerce_post_with_context(self, w, schema, directive_value, env):
+        return self._emit_coerce(
+            w, directive_value, env, "coerce_post_with_context", True
+        )
+
+    def emit_nullable(self, w, schema, directive_value, env):
+        if directive_value:
+            w("if value is None:")
+            w("    return value")
+        return True
+
+    def emit_allowed(self, w, schema, directive_value, env):
+        allowed = self.constant(directive_value)
+        w("if value not in {}:".format(allowed))
+        w("    raise _E.DisallowedValue(value, {}, ctx.stack)".format(allowed))
+        return True
+
+    def emit_type(self, w, schema, directive_value, env):
+        if not isinstance(directive_value, six.string_types) or (
+            directive_value not in TYPES
+        ):
+            return False
+        types = self.constant(
+            TYPES[directive_value], source="_TYPES[{!r}]".format(directive_value)
+        )
+        w("if not isinstance(value, {}):".format(types))
+        w(
+            "    raise _E.BadType(value, {}, ctx.stack)".format(
+                self.constant(directive_value)
+            )
+        )
+        return True
+
+    def emit_maxlength(self, w, schema, directive_value, env):
+        length = self.constant(directive_value)
+        w("if len(value) > {}:".format(length))
+        w("    raise _E.MaxLengthExceeded(value, {}, ctx.stack)".format(length))
+        return True
+
+    def emit_minlength(self, w, schema, directive_value, env):
+        length = self.constant(directive_value)
+        w("if len(value) < {}:".format(length))
+        w("    raise _E.MinLengthNotReached(value, {}, ctx.stack)".format(length))
+        return True
+
+    def emit_min(self, w, schema, directive_value, env):
+        bound = self.constant(directive_value)
+        w("if value < {}:".format(bound))
+        w(
+            "    raise _E.OutOfBounds(value, {}, {}, ctx.stack)".format(
+                bound, self.constant(schema.get("max"))
+            )
+        )
+        return True
+
+    def emit_max(self, w, schema, directive_value, env):
+        bound = self.constant(directive_value)
+        w("if value > {}:".format(bound))
+        w(
+            "    raise _E.OutOfBounds(value, {}, {}, ctx.stack)".format(
+                self.constant(schema.get("min")), bound
+            )
+        )
+        return True
+
+    def emit_regex(self, w, schema, directive_value, env):
+        regex = directive_value
+        if not regex.endswith("$"):
+            regex += "$"
+        match = self.constant(
+            re.compile(regex).match, source="_re.compile({!r}).match".format(regex)
+        )
+        w("if isinstance(value, str) and not {}(value):".format(match))
+        w(
+            "    raise _E.RegexMismatch(value, {}, ctx.stack)".format(
+                self.constant(directive_value)
+            )
+        )
+        return True
+
+    def emit_validator(self, w, schema, directive_value, env):
+        validator = env.resolve_function("validator_registry", directive_value)
+        if validator is _marker:
+            return False
+        self.emit_handler(w, "validator", schema, validator)
+        return True
+
+    def emit_elements(self, w, schema, directive_value, env):
+        element_schema = env.resolve_schema(directive_value)
+        if element_schema is _marker:
+            return False
+        call = self.child_call(element_schema, env, "element", "ctx.push_stack(idx)")
+        if call is None:
+            w("value = [element for element in value]")
+        else:
+            w("value = [{} for idx, element in enumerate(value)]".format(call))
+        return True
+
+    def emit_fields(self, w, schema, directive_value, env):
+        fields = self._resolve_fields(directive_value, env)
+        if fields is None:
+            return False
+        self._emit_fields(w, fields, env)
+        return True
+
+    def emit_schema(self, w, schema, directive_value, env):
+        # The meaning of `schema` depends on the type of the value at runtime (see
+        # `Normalizer.handle_schema`), so we generate both interpretations unless the
+        # `type` directive rules one of them out.
+        element_schema = _marker
+        if schema.get("type") != "dict":
+            element_schema = env.resolve_schema(directive_value)
+            try:
+                Normalizer(element_schema)
+            except (E.SchemaError, AttributeError, TypeError):
+                element_schema = _marker
+        fields = None
+        if schema.get("type") != "list":
+            fields = self._resolve_fields(directive_value, env)
+        w("if isinstance(value, list):")
+        w.indent()
+        if element_schema is _marker:
+            self.emit_handler(w, "elements", schema, directive_value)
+        else:
+            self.emit_elements(w, schema, directive_value, env)
+        w.dedent()
+        w("elif isinstance(value, dict):")
+        w.indent()
+        if fields is None:
+            self.emit_handler(w, "fields", schema, directive_value)
+        else:
+            self._emit_fields(w, fields, env)
+        w.dedent()
+        return True
+
+    def _resolve_fields(self, fields_schema, env):
+        """
+        Resolve the schemas of a dict's fields the way `_normalize_dict` does,
+        returning a list of (key, schema) or None if this can't be done ahead of time.
+        """
+        if not isinstance(fields_schema, dict):
+            return None
+        fields = []
+        for key, key_schema in fields_schema.items():
+            key_schema = env.resolve_schema(key_schema)
+            if not isinstance(key_schema, dict):
+                return None
+            if "schema_ref" in key_schema:
+                reffed_schema = env.resolve_schema(key_schema["schema_ref"])
+                if not isinstance(reffed_schema, dict):
+                    return None
+                without_ref = key_schema.copy()
+                del without_ref["schema_ref"]
+                without_ref = self._merged.setdefault(
+                    ("without-ref", id(key_schema)), (key_schema, None, without_ref)
+                )[2]
+                key_schema = self.merge(reffed_schema, without_ref)
+            try:
+                Normalizer(key_schema)
+            except E.SchemaError:
+                return None
+            fields.append((key, key_schema))
+        return fields
+
+    def _emit_fields(self, w, fields, env):
+        keys = self.constant(frozenset(key for key, _ in fields))
+        w("new_dict = {}")
+        w("if not {}.issuperset(value.keys()):".format(keys))
+        w("    extra_keys = set(value.keys()) - {}".format(keys))
+        w("    if ctx.allow_unknown:")
+        w("        for k in extra_keys:")
+        w("            new_dict[k] = value[k]")
+        w("    else:")
+        w("        raise _E.UnknownFields(value, extra_keys, stack=ctx.stack)")
+        for key, key_schema in fields:
+            self._emit_field(w, key, key_schema, env)
+        w("value = new_dict")
+
+    def _emit_field(self, w, key, key_schema, env):
+        k = self.constant(key)
+        new_key = self.constant(key_schema.get("rename", key))
+        excludes = key_schema.get("excludes", [])
+        if not isinstance(excludes, list):
+            excludes = [excludes]
+
+        def normalize(source):
+            """Store the normalized value of `source` and check `excludes`."""
+            call = self.child_call(
+                key_schema, env, source, "ctx.push_stack({})".format(k)
+            )
+            if call is not None:
+                w("new_dict[{}] = {}".format(new_key, call))
+            elif source != "new_dict[{}]".format(new_key):
+                w("new_dict[{}] = {}".format(new_key, source))
+            for excluded_field in excludes:
+                w("if {} in value:".format(self.constant(excluded_field)))
+                w(
+                    "    raise _E.DisallowedField({}, {}, ctx.stack)".format(
+                        k, self.constant(excluded_field)
+                    )
+                )
+            return call is not None or excludes
+
+        w("if {} in value:".format(k))
+        w.indent()
+        normalize("value[{}]".format(k))
+        w.dedent()
+        w("else:")
+        w.indent()
+        if self._emit_default(w, key, key_schema, env):
+            normalize("new_dict[{}]".format(new_key))
+        elif key_schema.get("required", False):
+            w("raise _E.DictFieldNotFound({}, value=value, stack=ctx.stack)".format(k))
+        else:
+            # Bug-for-bug: a value that ended up under this field's name (because of
+            # `allow_unknown` or a `rename`) gets normalized with this field's schema.
+            w("if {} in new_dict:".format(new_key))
+            w.indent()
+            if not normalize("new_dict[{}]".format(new_key)):
+                w("pass")
+            w.dedent()
+        w.dedent()
+
+    def _emit_default(self, w, key, key_schema, env):
+        """
+        Emit code to store the default value of a field in `new_dict`. Returns False
+        if there is no default at all.
+        """
+        new_key = self.constant(key_schema.get("rename", key))
+        if "default" in key_schema:
+            w("new_dict[{}] = {}".format(new_key, self.constant(key_schema["default"])))
+            return True
+        if "default_copy" in key_schema:
+            w(
+                "new_dict[{}] = _deepcopy({})".format(
+                    new_key, self.constant(key_schema["default_copy"])
+                )
+            )
+            return True
+        if key_schema.get("default_setter") is None:
+            return False
+        default_setter = env.resolve_function(
+            "default_registry", key_schema["default_setter"]
+        )
+        if default_setter is _marker:
+            # This will raise the appropriate error at runtime
+            w(
+                "new_dict[{}] = _get_default({}, {}, value, ctx)".format(
+                    new_key, self.constant(key), self.constant(key_schema)
+                )
+            )
+            return True
+        w("try:")
+        w("    new_dict[{}] = {}(value)".format(new_key, self.constant(default_setter)))
+        w("except Exception as e:")
+        w(
+            "    raise _E.DefaultSetterUnexpectedError({}, value, e, ctx.stack)".format(
+                self.constant(key)
+            )
+        )
+        return True
+
+
+# The objects that `resolve_import_path` has returned, as
+# `{id(obj): (obj, path)}`. Some of them, like methods of builtin types, don't know
+# the path they can be imported from.
+_resolved_paths = {}
+
+
+def import_path(obj):
+    """
+    Find the import path of a function or class, as a "module:qualified.name"
+    string. Raises ValueError if the object can't be imported by that path.
+    """
+    resolved = _resolved_paths.get(id(obj))
+    if resolved is not None and resolved[0] is obj:
+        return resolved[1]
+    module = getattr(obj, "__module__", None)
+    qualname = getattr(obj, "__qualname__", getattr(obj, "__name__", None))
+    path = "{}:{}".format(module, qualname)
+    if not module or not qualname or module == "__main__" or "<" in qualname:
+        raise ValueError("{!r} can't be referenced by import path".format(obj))
+    try:
+        found = resolve_import_path(path)
+    except (ImportError, AttributeError):
+        found = None
+    if found is not obj:
+        raise ValueError("{!r} can't be referenced by import path".format(obj))
+    return path
+
+
+def resolve_import_path(path):
+    """Import the object referenced by a "module:qualified.name" string."""
+    module, _, qualname = path.partition(":")
+    obj = importlib.import_module(module)
+    for attribute in qualname.split("."):
+        obj = getattr(obj, attribute)
+    _resolved_paths[id(obj)] = (obj, path)
+    return obj
+
+
+_MODULE_TEMPLATE = '''\
+"""
+Normalizes values with {description}.
+
+This module was generated by sureberus, do not edit it.
+"""
+
+from copy import deepcopy as _deepcopy
+import re as _re
+
+from sureberus import (
+    INIT_CONTEXT as _INIT_CONTEXT,
+    Normalizer as _Normalizer,
+    TYPES as _TYPES,
+    _DIRECTIVES,
+    _ShortCircuit,
+    _get_default,
+    _marker,
+    _normalize_dict,
+    _normalize_schema,
+)
+from sureberus import errors as _E
+{imports}
+
+_SureError = _E.SureError
+
+{constants}
+
+
+{functions}
+
+
+SCHEMA = {schema}
+
+_CONTEXTS = {{
+    allow_unknown: _INIT_CONTEXT.set_allow_unknown(allow_unknown)
+    for allow_unknown in (False, True)
+}}
+
+
+def normalize(value, allow_unknown=False):
+    """Normalize a value with SCHEMA, like `sureberus.normalize_schema`."""
+    return {root}(value, _CONTEXTS[bool(allow_unknown)])
+'''
+
+
+class _ModuleWriter(object):
+    """Writes the constants used by generated code as Python source."""
+
+    def __init__(self, generator):
+        self.generator = generator
+        self.names = {id(obj): name for name, obj in generator._constants.items()}
+        self.constants = []
+        self.written = set()
+        self.imports = {}
+
+    def write(self, description, schema_name, root_name):
+        for name in self.generator._constants:
+            self.write_constant(name)
+        imports = [
+            "from {} import {} as {}".format(module, attribute, alias)
+            for (module, attribute), alias in sorted(self.imports.items())
+        ]
+        return _MODULE_TEMPLATE.format(
+            description=description,
+            imports="\n".join(imports),
+            constants="\n".join(self.constants),
+            functions="\n\n\n".join(self.generator._bodies),
+            schema=schema_name,
+            root=root_name,
+        )
+
+    def write_constant(self, name):
+        if name in self.written:
+            return
+        self.written.add(name)
+        if name in self.generator._sources:
+            source, dependencies = self.generator._sources[name]
+            for dependency in dependencies:
+                self.write_constant(dependency)
+        else:
+            source = self.literal(self.generator._constants[name], 0, top=True)
+        self.constants.append("{} = {}".format(name, source))
+
+    def literal(self, obj, indentation, top=False):
+        name = self.names.get(id(obj))
+        if name is not None and not top and type(obj) not in _LITERAL_TYPES:
+            self.write_constant(name)
+            return name
+        if obj is None or isinstance(obj, (bool, six.integer_types)):
+            return repr(obj)
+        elif isinstance(obj, float):
+            if obj != obj or obj in (float("inf"), float("-inf")):
+                return "float({!r})".format(repr(obj))
+            return repr(obj)
+        elif isinstance(obj, (six.text_type, six.binary_type)):
+            return repr(obj)
+        elif obj is type(None):
+            return "type(None)"
+        elif isinstance(obj, dict):
+            items = [
+                "{}: {}".format(
+                    self.literal(k, indentation + 1), self.literal(v, indentation + 1)
+                )
+                for k, v in obj.items()
+            ]
+            return self._container("{", items, "}", indentation)
+        elif isinstance(obj, list):
+            items = [self.literal(item, indentation + 1) for item in obj]
+            return self._container("[", items, "]", indentation)
+        elif isinstance(obj, tuple):
+            items = [self.literal(item, indentation + 1) for item in obj]
+            if len(items) == 1:
+                return "({},)".format(items[0])
+            return self._container("(", items, ")", indentation)
+        elif isinstance(obj, (set, frozenset)):
+            # Sorted so that the module doesn't depend on hash randomization
+            items = sorted(self.literal(item, indentation + 1) for item in obj)
+            if isinstance(obj, frozenset):
+                return "frozenset({})".format(
+                    self._container("[", items, "]", indentation)
+                )
+            if not items:
+                return "set()"
+            return self._container("{", items, "}", indentation)
+        elif callable(obj):
+            return self.import_(obj)
+        raise ValueError("{!r} can't be written into a generated module".format(obj))
+
+    def _container(self, start, items, end, indentation):
+        one_line = start + ", ".join(items) + end
+        if len(one_line) + 4 * indentation < 80 and "\n" not in one_line:
+            return one_line
+        inner = "    " * (indentation + 1)
+        lines = [start] + [inner + item + "," for item in items]
+        lines.append("    " * indentation + end)
+        return "\n".join(lines)
+
+    def import_(self, obj):
+        module, _, qualname = import_path(obj).partition(":")
+        attribute, _, rest = qualname.partition(".")
+        key = (module, attribute)
+        if key not in self.imports:
+            self.imports[key] = "_i{}".format(len(self.imports))
+        return self.imports[key] + ("." + rest if rest else "")
@@ -0,0 +1,726 @@
+"""
+Ahead-of-time preparation of schemas.
+
+`compile_schema` walks a schema once, creating a `Normalizer` for every schema node
+that can be reached from it. Normalizing a value with the resulting
+`CompiledSchema` then reuses those Normalizers instead of re-inspecting each schema
+node for every value.
+"""
+
+import multiprocessing
+import re
+import threading
+
+import attr
+import six
+
+from . import (
+    Context,
+    INIT_CONTEXT,
+    Normalizer,
+    TYPES,
+    _DIRECTIVES,
+    _KNOWN_DIRECTIVES,
+    _INPLACE,
+    _NORMALIZE,
+    _StacklessContext,
+    _VALIDATE,
+    _marker,
+    _normalize_schema,
+)
+from . import errors as E
+from .codegen import _Env, compile_function
+
+ENGINES = ("interpreter", "codegen")
+
+
+def compile_schema(
+    schema,
+    engine="interpreter",
+    check=True,
+    adaptive_anyof=False,
+    elements_workers=None,
+    elements_threshold=10000,
+):
+    """Prepare a schema for normalizing many values.
+
+    With `engine="codegen"`, Python source code specialized for the schema is
+    generated and executed; see `sureberus.codegen`.
+
+    Unless `check=False` is passed, the schema is checked with `check_schema`
+    first, and checks that have then already been done aren't repeated for every
+    value.
+
+    With `adaptive_anyof=True`, the rules of an `anyof` are tried in the order of
+    how often they have matched, and the rule that matched the last value of the
+    same type (and the same keys, for dicts) is tried first. This is only done
+    when at most one of the rules can match any value, so that the order can't
+    change the result. `adaptive_anyof="always"` reorders the rules of every
+    `anyof`, even though another rule than the first matching one in the schema
+    may then be used.
+
+    With `elements_workers`, the elements of lists with at least
+    `elements_threshold` elements are normalized in that many worker processes.
+    The processes are started when they're first needed, and stopped by the
+    CompiledSchema's `close` method.
+
+    The schema must not be mutated after it has been compiled.
+    """
+    return CompiledSchema(
+        schema,
+        engine=engine,
+        check=check,
+        adaptive_anyof=adaptive_anyof,
+        elements_workers=elements_workers,
+        elements_threshold=elements_threshold,
+    )
+
+
+def check_schema(schema):
+    """Check a schema for mistakes, without normalizing any value with it.
+
+    This finds unknown directives, malformed directives, and names of registered
+    schemas and functions that aren't registered, anywhere in the schema --
+    including the parts of it that are only used for some values. A `SchemaError`
+    is raised for the first problem found.
+
+    Names that are looked up below a `modify_context` directive, or in a schema
+    returned by a `choose_schema` `function`, can only be known at runtime, and
+    are not checked.
+    """
+    _Checker().check(schema, _Env.initial(), ())
+
+
+@attr.s
+class CompiledSchema(object):
+    schema = attr.ib()
+    engine = attr.ib(default="interpreter")
+    check = attr.ib(default=True)
+    adaptive_anyof = attr.ib(default=False)
+    elements_workers = attr.ib(default=None)
+    elements_threshold = attr.ib(default=10000)
+    _nodes = attr.ib(init=False, repr=False, cmp=False)
+    _node_indices = attr.ib(init=False, repr=False, cmp=False)
+    _normalizers = attr.ib(init=False, repr=False, cmp=False)
+    _checked = attr.ib(init=False, repr=False, cmp=False)
+    _stackless_contexts = attr.ib(init=False, repr=False, cmp=False)
+    _contexts = attr.ib(init=False, repr=False, cmp=False)
+    _root = attr.ib(init=False, repr=False, cmp=False)
+    _pool = attr.ib(init=False, repr=False, cmp=False)
+    _pool_lock = attr.ib(init=False, repr=False, cmp=False)
+
+    def __attrs_post_init__(self):
+        if self.engine not in ENGINES:
+            raise ValueError(
+                "Unknown engine {!r}, must be one of {}".format(self.engine, ENGINES)
+            )
+        if self.adaptive_anyof not in (False, True, "always"):
+            raise ValueError(
+                "adaptive_anyof must be True, False or 'always', not {!r}".format(
+                    self.adaptive_anyof
+                )
+            )
+        if self.elements_workers and self.engine == "codegen":
+            raise ValueError("elements_workers can't be used with the codegen engine")
+        self._pool = None
+        self._pool_lock = threading.Lock()
+        self._checked = False
+        uses_context = True
+        if self.check:
+            checker = _Checker()
+            checker.check(self.schema, _Env.initial(), ())
+            # If nothing about the schema depends on runtime information, then any
+            # schema we see while normalizing is made out of parts that have been
+            # checked.
+            self._checked = not checker.dynamic
+            uses_context = checker.uses_context
+        # The nodes are found in the same order in an unpickled copy of the schema,
+        # so worker processes are told which node to use by its index.
+        self._nodes = list(_iter_schema_nodes(self.schema))
+        self._node_indices = {}
+        self._normalizers = {}
+        for index, node in enumerate(self._nodes):
+            self._node_indices[id(node)] = index
+            self._normalizers[id(node)] = Normalizer(node)
+        if self.engine == "codegen":
+            self._root = compile_function(self.schema)
+        else:
+            self._root = self._normalizers[id(self.schema)].normalize
+        self._contexts = {}
+        self._stackless_contexts = None
+        if self._checked and not uses_context:
+            self._stackless_contexts = {}
+        for allow_unknown in (False, True):
+            for mode in (_NORMALIZE, _VALIDATE, _INPLACE):
+                key = (allow_unknown, mode)
+                ctx = INIT_CONTEXT.set_allow_unknown(allow_unknown)
+                self._contexts[key] = ctx._with_compiled(self)._with_mode(mode)
+                # Nothing but errors needs to know where in a value we are. When
+                # normalizing in place, though, the value can't be normalized again
+                # after an error.
+                if self._stackless_contexts is not None and mode is not _INPLACE:
+                    self._stackless_contexts[key] = (
+                        _StacklessContext(
+                            allow_unknown,
+                            **{name: getattr(ctx, name) for name in _CONTEXT_SCOPES}
+                        )
+                        ._with_compiled(self)
+                        ._with_mode(mode)
+                    )
+
+    def __reduce__(self):
+        # Only the schema and the options are pickled, and the schema is compiled
+        # again when it's unpickled. The functions in the schema are pickled by
+        # reference, so they must be importable. Copies sent to worker processes
+        # don't start workers of their own.
+        return (
+            CompiledSchema,
+            (self.schema, self.engine, self.check, self.adaptive_anyof),
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """Stop the worker processes started for `elements_workers`, if any."""
+        with self._pool_lock:
+            if self._pool is not None:
+                self._pool.terminate()
+                self._pool.join()
+                self._pool = None
+
+    def normalize(self, value, allow_unknown=False, inplace=False):
+        """Normalize a value with this schema.
+
+        This returns the same value, or raises the same error, as
+        `normalize_schema(schema, value)`. When the schema never looks at the
+        Context, an invalid value is normalized a second time to find out where
+        the error is, so its `coerce`, `coerce_post` and `default_setter`
+        functions may be called twice."""
+        if inplace:
+            # The generated code always builds new values.
+            root = self._normalizers[id(self.schema)].normalize
+            return self._run(root, value, allow_unknown, _INPLACE)
+        return self._run(self._root, value, allow_unknown, _NORMALIZE)
+
+    def validate(self, value, allow_unknown=False):
+        """Check that a value is valid, like `sureberus.validate`."""
+        if self.engine == "codegen":
+            # The generated code always builds the normalized value.
+            self._run(self._root, value, allow_unknown, _NORMALIZE)
+        else:
+            self._run(self._root, value, allow_unknown, _VALIDATE)
+
+    def is_valid(self, value, allow_unknown=False):
+        """Return whether a value is valid, like `sureberus.is_valid`."""
+        try:
+            self.validate(value, allow_unknown=allow_unknown)
+        except E.SureError:
+            return False
+        return True
+
+    def _run(self, function, value, allow_unknown, mode):
+        key = (bool(allow_unknown), mode)
+        if self._stackless_contexts is not None and mode is not _INPLACE:
+            try:
+                return function(value, self._stackless_contexts[key])
+            except E.SureError:
+                # Do it again to find out where the error is
+                pass
+        return function(value, self._contexts[key])
+
+    def _normalize_elements(self, schema, value, ctx):
+        """
+        Normalize the elements of a list in the worker processes, in chunks. Returns
+        `_marker` if that can't be done.
+        """
+        if isinstance(schema, str):
+            schema = ctx.find_schema(schema)
+        node = self._node_indices.get(id(schema))
+        if node is None:
+            # Schemas made while normalizing can't be found by the workers
+            return _marker
+        with self._pool_lock:
+            if self._pool is None:
+                self._pool = multiprocessing.Pool(
+                    self.elements_workers, _init_worker, (self,)
+                )
+            pool = self._pool
+        state = _context_state(self, ctx)
+        chunk_size = -(-len(value) // (self.elements_workers * _CHUNKS_PER_WORKER))
+        chunks = []
+        for start in range(0, len(value), chunk_size):
+            end = start + chunk_size
+            chunk = value[start:end]
+            chunks.append(
+                (
+                    start,
+                    len(chunk),
+                    pool.apply_async(
+                        _normalize_elements_chunk, (node, chunk, start, state)
+                    ),
+                )
+            )
+        results = []
+        for start, size, async_result in chunks:
+            chunk_results, failed = async_result.get()
+            if failed is not None:
+                # Normalize the rest of the chunk here, so that the error is raised
+                # with the same stack as it would have been here.
+                for index in range(failed, start + size):
+                    chunk_results.append(
+                        _normalize_schema(schema, value[index], ctx.push_stack(index))
+                    )
+            results.extend(chunk_results)
+        if ctx._mode is _VALIDATE:
+            return value
+        elif ctx._mode is _INPLACE:
+            value[:] = results
+            return value
+        return results
+
+
+# How many chunks each worker gets of a list whose elements are normalized in
+# worker processes
+_CHUNKS_PER_WORKER = 4
+
+# The CompiledSchema that a worker process normalizes elements with
+_worker_schema = None
+
+
+def _init_worker(compiled):
+    global _worker_schema
+    _worker_schema = compiled
+
+
+@attr.s
+class _NodeRef(object):
+    """A schema node of a CompiledSchema, sent to a worker process by its index."""
+
+    index = attr.ib()
+
+
+# Modes are compared by identity, so the ones unpickled in worker processes are
+# replaced by these.
+_MODES = {mode: mode for mode in (_NORMALIZE, _VALIDATE, _INPLACE)}
+
+
+def _context_state(compiled, ctx):
+    """The parts of a Context that are sent to worker processes."""
+    scopes = dict((name, getattr(ctx, name).flatten()) for name in _CONTEXT_SCOPES)
+    # Registered schemas are usually nodes of the schema, and the workers should use
+    # their own Normalizers for them.
+    scopes["schema_registry"] = dict(
+        (name, _node_ref(compiled, schema))
+        for name, schema in scopes["schema_registry"].items()
+    )
+    return (
+        type(ctx) is _StacklessContext,
+        ctx.allow_unknown,
+        ctx.stack,
+        ctx._mode,
+        scopes,
+    )
+
+
+def _node_ref(compiled, schema):
+    index = compiled._node_indices.get(id(schema))
+    return schema if index is None else _NodeRef(index)
+
+
+def _context_from_state(compiled, state):
+    stackless, allow_unknown, stack, mode, scopes = state
+    scopes["schema_registry"] = dict(
+        (name, compiled._nodes[schema.index] if type(schema) is _NodeRef else schema)
+        for name, schema in scopes["schema_registry"].items()
+    )
+    ctx = (_StacklessContext if stackless else Context)(allow_unknown, **scopes)
+    ctx = ctx._with_compiled(compiled)._with_mode(_MODES[mode])
+    for key in stack:
+        ctx = ctx.push_stack(key)
+    return ctx
+
+
+def _normalize_elements_chunk(node, elements, start, state):
+    """
+    Normalize a chunk of the elements of a list in a worker process. Returns the
+    normalized elements, and the index of the first invalid element, if any.
+    """
+    compiled = _worker_schema
+    schema = compiled._nodes[node]
+    ctx = _context_from_state(compiled, state)
+    results = []
+    for index, element in enumerate(elements, start):
+        try:
+            result = _normalize_schema(schema, element, ctx.push_stack(index))
+        except E.SureError:
+            return results, index
+        if ctx._mode is not _VALIDATE:
+            results.append(result)
+    return results, None
+
+
+def _iter_schema_nodes(schema):
+    """
+    Find all of the schema nodes that will be applied directly to values.
+
+    Some parts of a schema, like the choices of a `choose_schema` or the rules in an
+    `anyof`, are only ever merged into another schema before being applied. Those
+    aren't yielded themselves, but the schemas nested inside them are.
+    """
+    seen = set()
+    to_visit = [(schema, True)]
+    while to_visit:
+        node, direct = to_visit.pop()
+        if not isinstance(node, dict) or (id(node), direct) in seen:
+            continue
+        seen.add((id(node), direct))
+        if direct:
+            yield node
+        for child, child_direct in _child_schemas(node):
+            to_visit.append((child, child_direct))
+
+
+def _child_schemas(schema):
+    for directive in ("elements", "keyschema", "valueschema"):
+        if directive in schema:
+            yield schema[directive], True
+    for name in (
+        "registry",
+        "fields",
+    ):
+        for child in schema.get(name, {}).values():
+            yield child, True
+    if "schema" in schema:
+        subschema = schema["schema"]
+        if _is_fields_map(schema.get("type"), subschema):
+            for child in subschema.values():
+                yield child, True
+        else:
+            yield subschema, True
+            if schema.get("type") is None and isinstance(subschema, dict):
+                # It might be a dict of fields whose names happen to be directives.
+                for child in subschema.values():
+                    if isinstance(child, dict) and _KNOWN_DIRECTIVES.issuperset(child):
+                        yield child, True
+    for directive in ("anyof", "oneof"):
+        for child in schema.get(directive, []):
+            yield child, False
+    choose_schema = schema.get("choose_schema", {})
+    for choice in ("when_tag_is", "when_key_is"):
+        if choice in choose_schema:
+            for child in choose_schema[choice]["choices"].values():
+                yield child, False
+    if "when_key_is" in schema:
+        for child in schema["when_key_is"]["choices"].values():
+            yield child, False
+    for choices in (
+        choose_schema.get("when_key_exists", {}),
+        choose_schema.get("when_type_is", {}),
+        schema.get("when_key_exists", {}),
+    ):
+        for child in choices.values():
+            yield child, False
+
+
+def _is_fields_map(type_, subschema):
+    """
+    Guess whether the value of a `schema` directive is a dict of fields or a schema
+    for list elements. At runtime this depends on the type of the value, so this
+    relies on the `type` directive, or failing that, on the keys of the subschema.
+    """
+    if type_ == "dict":
+        return True
+    elif type_ == "list" or not isinstance(subschema, dict):
+        return False
+    return not set(subschema).issubset(_KNOWN_DIRECTIVES)
+
+
+_FUNCTION_DIRECTIVES = {
+    "coerce": ("coerce_registry", "coerce"),
+    "coerce_with_context": ("coerce_registry", "coerce"),
+    "coerce_post": ("coerce_registry", "coerce"),
+    "coerce_post_with_context": ("coerce_registry", "coerce"),
+    "validator": ("validator_registry", "validator"),
+    "modify_context": ("modify_context_registry", "modify_context"),
+}
+
+# Directives that look at the Context for more than just registries.
+_CONTEXT_DIRECTIVES = frozenset(
+    [
+        "coerce_with_context",
+        "coerce_post_with_context",
+        "modify_context",
+        "set_tag",
+        "validator",
+    ]
+)
+
+_CONTEXT_SCOPES = (
+    "schema_registry",
+    "default_registry",
+    "coerce_registry",
+    "modify_context_registry",
+    "validator_registry",
+    "tags",
+)
+
+_CHOOSE_SCHEMA_KINDS = (
+    "when_tag_is",
+    "function",
+    "when_key_is",
+    "when_key_exists",
+    "when_type_is",
+)
+
+
+class _Checker(object):
+    """
+    Walks a schema for `check_schema`, keeping track of the registries that are in
+    effect the same way `Context` does at runtime. An `env` of None means that the
+    registries can't be known ahead of time.
+    """
+
+    def __init__(self):
+        self.seen = set()
+        # Set when some part of the schema can only be known at runtime.
+        self.dynamic = False
+        # Set when something other than errors looks at the Context: at where in
+        # the value we are, or at the tags.
+        self.uses_context = False
+
+    def resolve(self, schema, env, path):
+        if isinstance(schema, six.string_types):
+            if env is None:
+                return _marker
+            resolved = env.resolve_schema(schema)
+            if resolved is _marker:
+                raise E.SchemaNotFound(schema, path)
+            schema = resolved
+        if not isinstance(schema, dict):
+            raise E.InvalidDirective("Expected a schema, got {!r}".format(schema), path)
+        return schema
+
+    def check_function(self, kind, name, env, path):
+        registry, registry_name = _FUNCTION_DIRECTIVES[kind]
+        if env is not None and env.resolve_function(registry, name) is _marker:
+            raise E.UnregisteredFunction(name, registry_name, path)
+
+    def check(self, schema, env, path):
+        schema = self.resolve(schema, env, path)
+        if schema is _marker:
+            return
+        key = (id(schema), env.key if env is not None else None)
+        if key in self.seen:
+            return
+        self.seen.add(key)
+        unknown_directives = set(schema) - _KNOWN_DIRECTIVES
+        if unknown_directives:
+            raise E.UnknownSchemaDirectives(unknown_directives)
+        if env is not None and env.too_deep():
+            self.dynamic = True
+            env = None
+        if _CONTEXT_DIRECTIVES.intersection(schema):
+            self.uses_context = True
+        names = [name for name in schema if name in _DIRECTIVES]
+        names.sort(key=lambda name: _DIRECTIVES[name]["order"])
+        for name in names:
+            env = getattr(self, "check_" + name, _check_nothing)(
+                schema, schema[name], env, path + (name,)
+            )
+
+    def _check_registry(kind):
+        def check(self, schema, directive_value, env, path):
+            if not isinstance(directive_value, dict):
+                raise E.InvalidDirective("`{}` must be a dict".format(kind), path)
+            if env is None:
+                return None
+            return env.push(kind, directive_value)
+
+        return check
+
+    check_registry = _check_registry("registry")
+    check_default_registry = _check_registry("default_registry")
+    check_coerce_registry = _check_registry("coerce_registry")
+    check_validator_registry = _check_registry("validator_registry")
+    check_modify_context_registry = _check_registry("modify_context_registry")
+    del _check_registry
+
+    def _check_function(kind):
+        def check(self, schema, directive_value, env, path):
+            self.check_function(kind, directive_value, env, path)
+            return env
+
+        return check
+
+    check_coerce = _check_function("coerce")
+    check_coerce_with_context = _check_function("coerce_with_context")
+    check_coerce_post = _check_function("coerce_post")
+    check_coerce_post_with_context = _check_function("coerce_post_with_context")
+    check_validator = _check_function("validator")
+    del _check_function
+
+    def check_modify_context(self, schema, directive_value, env, path):
+        self.check_function("modify_context", directive_value, env, path)
+        # From here on, the registries can be anything.
+        self.dynamic = True
+        return None
+
+    def check_schema_ref(self, schema, directive_value, env, path):
+        if not isinstance(directive_value, six.string_types):
+            raise E.InvalidDirective("`schema_ref` must be a string", path)
+        self.check(directive_value, env, path)
+        return env
+
+    def check_type(self, schema, directive_value, env, path):
+        try:
+            known = directive_value in TYPES
+        except TypeError:
+            known = False
+        if not known:
+            raise E.InvalidDirective(
+                "Unknown type {!r}, must be one of {}".format(
+                    directive_value, sorted(TYPES)
+                ),
+                path,
+            )
+        return env
+
+    def check_regex(self, schema, directive_value, env, path):
+        try:
+            re.compile(directive_value)
+        except (re.error, TypeError) as e:
+            raise E.InvalidDirective("Invalid regex: {}".format(e), path)
+        return env
+
+    def check_set_tag(self, schema, directive_value, env, path):
+        if not isinstance(directive_value, list):
+            directive_value = [directive_value]
+        for dv in directive_value:
+            if isinstance(dv, dict) and "key" not in dv and "value" not in dv:
+                raise E.InvalidDirective("`set_tag` must have `key` or `value`", path)
+        return env
+
+    def check_choose_schema(self, schema, directive_value, env, path):
+        for kind in _CHOOSE_SCHEMA_KINDS:
+            if kind in directive_value:
+                break
+        else:
+            raise E.InvalidDirective(
+                "`choose_schema` must have one of {}".format(
+                    ", ".join("`{}`".format(k) for k in _CHOOSE_SCHEMA_KINDS)
+                ),
+                path,
+            )
+        choices = directive_value[kind]
+        path = path + (kind,)
+        if kind == "function":
+            # We can't know what this will return.
+            self.dynamic = True
+            return env
+        if kind == "when_tag_is":
+            self.uses_context = True
+        if kind in ("when_tag_is", "when_key_is"):
+            return self.check_choices(choices, env, path)
+        elif kind == "when_type_is":
+            for type_ in choices:
+                self.check_type(schema, type_, env, path)
+        return self.check_choices({"choices": choices}, env, path, ())
+
+    def check_choices(self, directive_value, env, path, choices_path=("choices",)):
+        choices = directive_value.get("choices")
+        if not isinstance(choices, dict):
+            raise E.InvalidDirective("Expected a dict of choices", path)
+        for choice, subschema in choices.items():
+            self.check(subschema, env, path + choices_path + (choice,))
+        return env
+
+    def check_when_key_is(self, schema, directive_value, env, path):
+        return self.check_choices(directive_value, env, path)
+
+    def check_when_key_exists(self, schema, directive_value, env, path):
+        return self.check_choices({"choices": directive_value}, env, path, ())
+
+    def _check_multi(kind):
+        def check(self, schema, directive_value, env, path):
+            if not isinstance(directive_value, list):
+                raise E.InvalidDirective("`{}` must be a list".format(kind), path)
+            for idx, subschema in enumerate(directive_value):
+                self.check(subschema, env, path + (idx,))
+            return env
+
+        return check
+
+    check_anyof = _check_multi("anyof")
+    check_oneof = _check_multi("oneof")
+    del _check_multi
+
+    def _check_subschema(self, schema, directive_value, env, path):
+        self.check(directive_value, env, path)
+        return env
+
+    check_elements = _check_subschema
+    check_keyschema = _check_subschema
+    check_valueschema = _check_subschema
+
+    def check_fields(self, schema, directive_value, env, path):
+        if not isinstance(directive_value, dict):
+            raise E.InvalidDirective("`fields` must be a dict", path)
+        for key, key_schema in directive_value.items():
+            key_path = path + (key,)
+            key_schema = self.resolve(key_schema, env, key_path)
+            if key_schema is _marker:
+                continue
+            # Defaults are set using the registries of the dict, not of the field.
+            field_schemas = [key_schema]
+            if isinstance(key_schema.get("schema_ref"), six.string_types):
+                field_schemas.append(
+                    self.resolve(key_schema["schema_ref"], env, key_path)
+                )
+            for field_schema in field_schemas:
+                if field_schema is _marker or env is None:
+                    continue
+                setter = field_schema.get("default_setter")
+                if (
+                    setter is not None
+                    and env.resolve_function("default_registry", setter) is _marker
+                ):
+                    raise E.UnregisteredFunction(
+                        setter, "default", key_path + ("default_setter",)
+                    )
+            self.check(key_schema, env, key_path)
+        return env
+
+    def check_schema(self, schema, directive_value, env, path):
+        type_ = schema.get("type")
+        if type_ is not None or not isinstance(directive_value, dict):
+            if _is_fields_map(type_, directive_value):
+                return self.check_fields(schema, directive_value, env, path)
+            return self._check_subschema(schema, directive_value, env, path)
+        # Without a `type`, the value could be a list or a dict at runtime, so
+        # `schema` is only invalid if it's invalid both as a dict of fields and as a
+        # schema for list elements.
+        readings = [self.check_fields, self._check_subschema]
+        if not _is_fields_map(type_, directive_value):
+            readings.reverse()
+        errors = []
+        for reading in readings:
+            state = (set(self.seen), self.dynamic, self.uses_context)
+            try:
+                reading(schema, directive_value, env, path)
+            except E.SchemaError as e:
+                self.seen, self.dynamic, self.uses_context = state
+                errors.append(e)
+        if len(errors) == len(readings):
+            raise errors[0]
+        if errors:
+            # The invalid reading has to be found out about at runtime.
+            self.dynamic = True
+        return env
+
+
+def _check_nothing(schema, directive_value, env, path):
+    return env
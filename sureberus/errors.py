@@ -1,4 +1,5 @@
 import attr
+import six
 
 
 class SchemaError(Exception):
@@ -18,17 +19,22 @@ class SimpleSchemaError(SchemaError):
 class SureError(Exception):
 
     def __reduce__(self):
-        # This is a workaround for a super obscure problem that make errors unpickleable
-        # in certain situations, when value, or parts of the schema, are unpickleable.
-        #
-        # First of all, why do we care about pickling exceptions? Because the python
-        # unittest code wants to pickle and unpickle exceptions when tests are run in
+        # Errors are pickled when they're sent back from the worker processes of
+        # `normalize_many`, and by the python unittest code when tests are run in
         # parallel.
         #
-        # So this is just a quick'n'dirty workaround to just serialize SureErrors as
-        # plain Exceptions with string messages. Printing an exception will be
-        # identical, but you will lose rich type info & individual fields.
-        return Exception, (str(self),)
+        # The value, or parts of the schema, in an error can be unpicklable,
+        # though. Finding out by trying to pickle them would be slow, so the fields
+        # that aren't made of plain data are replaced by `Unpicklable`s, which have
+        # the same repr and str. Printing the error will be identical, and it keeps
+        # its type and the rest of its fields.
+        if attr.has(type(self)):
+            args = _picklable(attr.astuple(self, recurse=False))
+            state = None
+        else:
+            args = _picklable(self.args)
+            state = dict(zip(self.__dict__, _picklable(self.__dict__.values())))
+        return _unpickle_error, (type(self), args, state, str(self))
 
     def __str__(self):
         stack = "root"
@@ -172,9 +178,7 @@ class DefaultSetterUnexpectedError(SureError):
 
     def format_fields(self):
         fields = self.__dict__.copy()
-        fields["exception"] = "{}: {}".format(
-            type(self.exception).__name__, self.exception
-        )
+        fields["exception"] = _describe_exception(self.exception)
         return fields
 
 
@@ -188,9 +192,7 @@ class ValidatorUnexpectedError(SureError):
 
     def format_fields(self):
         fields = self.__dict__.copy()
-        fields["exception"] = "{}: {}".format(
-            type(self.exception).__name__, self.exception
-        )
+        fields["exception"] = _describe_exception(self.exception)
         return fields
 
 
@@ -204,9 +206,7 @@ class CoerceUnexpectedError(SureError):
 
     def format_fields(self):
         fields = self.__dict__.copy()
-        fields["exception"] = "{}: {}".format(
-            type(self.exception).__name__, self.exception
-        )
+        fields["exception"] = _describe_exception(self.exception)
         return fields
 
 
@@ -230,3 +230,124 @@ class RegisteredFunctionNotFound(SureError):
     setter = attr.ib()
     registry_name = attr.ib()
     stack = attr.ib()
+
+
+class SchemaCheckError(SchemaError):
+    """A problem found in a schema by `check_schema`, at `path` in the schema."""
+
+    def format_fields(self):
+        fields = self.__dict__.copy()
+        fields["path"] = "root" + "".join("[{!r}]".format(el) for el in self.path)
+        return fields
+
+
+@attr.s
+class InvalidDirective(SchemaCheckError):
+    fmt = "{msg} (at {path})"
+    msg = attr.ib()
+    path = attr.ib()
+
+
+@attr.s
+class SchemaNotFound(SchemaCheckError):
+    fmt = (
+        "There is no registered schema named {name!r} (at {path}). "
+        "See the `registry` directive."
+    )
+    name = attr.ib()
+    path = attr.ib()
+
+
+@attr.s
+class UnregisteredFunction(SchemaCheckError):
+    fmt = (
+        "There is no registered {registry_name} function named {name!r} "
+        "(at {path}). See the `{registry_name}_registry` directive."
+    )
+    name = attr.ib()
+    registry_name = attr.ib()
+    path = attr.ib()
+
+
+def _unpickle_error(cls, args, state, message):
+    """Rebuild an error pickled by `SureError.__reduce__`."""
+    try:
+        error = cls(*args)
+    except Exception:
+        # Subclasses whose constructor doesn't take their args can't be rebuilt,
+        # so they're unpickled as plain Exceptions with the same message.
+        return Exception(message)
+    if state:
+        error.__dict__.update(state)
+    return error
+
+
+def _describe_exception(exception):
+    if isinstance(exception, Unpicklable):
+        return exception.description
+    return "{}: {}".format(type(exception).__name__, exception)
+
+
+class Unpicklable(object):
+    """
+    Stands in for a field of an error that couldn't be pickled, with the same repr
+    and str.
+    """
+
+    def __init__(self, obj):
+        self._repr = repr(obj)
+        self._str = str(obj)
+        if isinstance(obj, BaseException):
+            self.description = _describe_exception(obj)
+
+    def __repr__(self):
+        return self._repr
+
+    def __str__(self):
+        return self._str
+
+
+def _picklable(fields):
+    return tuple(
+        field if _is_plain_data(field) else Unpicklable(field) for field in fields
+    )
+
+
+_PLAIN_TYPES = (type(None), bool, float, complex, six.binary_type, six.text_type)
+_PLAIN_TYPES += six.integer_types
+_PLAIN_CONTAINERS = (list, tuple, set, frozenset)
+
+
+def _is_plain_data(obj):
+    """
+    Return whether `obj` is made only of builtin types of data, builtin exceptions
+    and SureErrors, which can be pickled.
+    """
+    objs = [obj]
+    seen = set()
+    while objs:
+        obj = objs.pop()
+        if type(obj) in _PLAIN_TYPES:
+            continue
+        elif id(obj) in seen:
+            # Pickle copes with containers that contain themselves
+            continue
+        seen.add(id(obj))
+        if type(obj) in _PLAIN_CONTAINERS:
+            objs.extend(obj)
+        elif type(obj) is dict:
+            objs.extend(obj.keys())
+            objs.extend(obj.values())
+        elif isinstance(obj, SureError):
+            # These pickle their own fields
+            continue
+        elif isinstance(obj, BaseException) and type(obj).__module__ in (
+            "builtins",
+            "exceptions",  # Python 2
+        ):
+            objs.extend(obj.args)
+        elif type(obj) is type and obj.__module__ in ("builtins", "__builtin__"):
+            continue
+        else:
+            return False
+    return True
@@ -0,0 +1,55 @@
+"""
+Decoding JSON and normalizing it with a schema in one step.
+
+    from sureberus import compile_schema, json as sure_json
+
+    compiled = compile_schema(myschema)
+    document = sure_json.loads(compiled, text)
+"""
+
+from __future__ import absolute_import
+
+import json
+import threading
+
+from .compiler import CompiledSchema, compile_schema
+
+__all__ = ["loads", "load"]
+
+# The schemas compiled by `loads`, keyed by the id of the schema. The schemas are
+# kept in the entries, so that their ids can't be reused by other objects.
+_compiled = {}
+_compiled_lock = threading.Lock()
+_COMPILED_CACHE_SIZE = 64
+
+
+def loads(schema, s, allow_unknown=False):
+    """
+    Decode a JSON document and normalize it with a schema.
+
+    The schema should be a CompiledSchema. Other schemas are compiled the first
+    time they're used, and the compiled schema is reused as long as the same schema
+    object is passed, so they must not be modified after that.
+    """
+    if not isinstance(schema, CompiledSchema):
+        schema = _compile(schema)
+    # Normalizing a copy of the decoded value is faster than normalizing it in
+    # place, since compiled schemas can only avoid keeping track of the stack when
+    # they copy.
+    return schema.normalize(json.loads(s), allow_unknown=allow_unknown)
+
+
+def _compile(schema):
+    entry = _compiled.get(id(schema))
+    if entry is None or entry[0] is not schema:
+        compiled = compile_schema(schema)
+        with _compiled_lock:
+            if len(_compiled) >= _COMPILED_CACHE_SIZE:
+                _compiled.clear()
+            _compiled[id(schema)] = entry = (schema, compiled)
+    return entry[1]
+
+
+def load(schema, fp, allow_unknown=False):
+    """Like `loads`, but reads the JSON document from a file."""
+    return loads(schema, fp.read(), allow_unknown=allow_unknown)
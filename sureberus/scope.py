@@ -0,0 +1,77 @@
+try:
+    from collections.abc import Mapping
+except ImportError:  # Python 2
+    from collections import Mapping
+
+from .constants import _marker
+
+# Scopes deeper than this are flattened into a single layer when they're extended,
+# to keep lookups fast.
+_MAX_DEPTH = 8
+
+
+class Scope(Mapping):
+    """
+    An immutable mapping made of layers of dicts, where later layers take precedence
+    over earlier ones. Adding a layer with `new_child` doesn't copy anything, which
+    makes it cheap to add registries and tags to a Context.
+
+    The dicts that make up a Scope must not be mutated.
+    """
+
+    __slots__ = ("_mapping", "_parent", "_depth", "_flat")
+
+    def __init__(self, mapping=None, parent=None):
+        self._mapping = {} if mapping is None else mapping
+        self._parent = parent
+        self._depth = 1 if parent is None else parent._depth + 1
+        self._flat = self._mapping if parent is None else None
+
+    def new_child(self, mapping):
+        """Return a new Scope with `mapping` layered on top of this one."""
+        if self._depth >= _MAX_DEPTH:
+            flat = self.flatten().copy()
+            flat.update(mapping)
+            return Scope(flat)
+        return Scope(mapping, self)
+
+    def flatten(self):
+        """Return a dict with the contents of this Scope."""
+        if self._flat is None:
+            flat = self._parent.flatten().copy()
+            flat.update(self._mapping)
+            self._flat = flat
+        return self._flat
+
+    def get(self, key, default=None):
+        scope = self
+        while scope is not None:
+            mapping = scope._mapping
+            if key in mapping:
+                return mapping[key]
+            scope = scope._parent
+        return default
+
+    def __getitem__(self, key):
+        value = self.get(key, _marker)
+        if value is _marker:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return self.get(key, _marker) is not _marker
+
+    def __iter__(self):
+        return iter(self.flatten())
+
+    def __len__(self):
+        return len(self.flatten())
+
+    def __repr__(self):
+        return "Scope({!r})".format(self.flatten())
+
+
+def as_scope(mapping):
+    if isinstance(mapping, Scope):
+        return mapping
+    return Scope(mapping)
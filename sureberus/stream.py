@@ -0,0 +1,519 @@
+"""
+Normalizing JSON documents that are too big to fit in memory.
+
+    from sureberus.stream import normalize_stream
+
+    with open("export.json") as src, open("normalized.json", "w") as dest:
+        normalize_stream(schema, src, dest)
+
+The document is read incrementally, as a stream of events:
+
+    ("start_map", None), ("map_key", key), ("end_map", None),
+    ("start_array", None), ("end_array", None), ("value", value)
+
+Values that are smaller than the size of a chunk of the file are decoded and
+normalized as usual. Bigger dicts and lists are normalized without being built,
+as long as their schema only has directives that can be applied to them one
+field or element at a time. Anything else is built and normalized as usual.
+"""
+
+import codecs
+import json
+import re
+
+from . import (
+    _NORMALIZE,
+    _get_default,
+    _get_normalizer,
+    _normalize_schema,
+    _resolve_field_schema,
+)
+from . import errors as E
+from .compiler import CompiledSchema, compile_schema
+from .constants import _marker
+
+__all__ = ["tokenize", "normalize_events", "normalize_stream"]
+
+START_MAP = "start_map"
+MAP_KEY = "map_key"
+END_MAP = "end_map"
+START_ARRAY = "start_array"
+END_ARRAY = "end_array"
+VALUE = "value"
+
+_CHUNK_SIZE = 64 * 1024
+
+# Directives that only change the context, and so can be applied before a dict or
+# list has been read
+_CONTEXT_DIRECTIVES = frozenset(
+    [
+        "registry",
+        "default_registry",
+        "coerce_registry",
+        "validator_registry",
+        "modify_context_registry",
+        "allow_unknown",
+        "metadata",
+    ]
+)
+# Directives about a value that are applied by the dict that it's a field of, or
+# that don't apply to dicts and lists
+_FIELD_DIRECTIVES = frozenset(
+    ["nullable", "required", "excludes", "default", "default_copy"]
+)
+
+
+def tokenize(fp, chunk_size=_CHUNK_SIZE):
+    """
+    Yield the events of the JSON document in a file, reading it `chunk_size`
+    characters at a time.
+    """
+    reader = _Reader(fp, chunk_size)
+    for event in _Streamer(reader, small_values=False).copy():
+        yield event
+    reader.end()
+
+
+def normalize_events(schema, fp, allow_unknown=False, chunk_size=_CHUNK_SIZE):
+    """
+    Normalize the JSON document in a file with a schema, which is compiled (unless
+    it's already a CompiledSchema), yielding the events of the normalized document.
+
+    If the document is invalid, the `SureError` is raised after some of the events
+    have already been yielded.
+    """
+    for event, value in _normalize(schema, fp, allow_unknown, chunk_size):
+        if event is VALUE and isinstance(value, (dict, list)):
+            for event in _value_events(value):
+                yield event
+        else:
+            yield (event, value)
+
+
+def normalize_stream(schema, fp, out, allow_unknown=False, chunk_size=_CHUNK_SIZE):
+    """
+    Normalize the JSON document in a file with a schema, like `normalize_events`,
+    writing the normalized document to the file `out` as JSON.
+
+    If the document is invalid, the `SureError` is raised after some of the
+    normalized document has already been written.
+    """
+    write = out.write
+    dumps = json.dumps
+    need_comma = after_key = False
+    for event, value in _normalize(schema, fp, allow_unknown, chunk_size):
+        if event is END_MAP or event is END_ARRAY:
+            write("}" if event is END_MAP else "]")
+            need_comma = True
+            continue
+        if need_comma and not after_key:
+            write(",")
+        after_key = False
+        if event is MAP_KEY:
+            write(dumps(value))
+            write(":")
+            after_key = True
+        elif event is START_MAP or event is START_ARRAY:
+            write("{" if event is START_MAP else "[")
+            need_comma = False
+        else:
+            write(dumps(value))
+            need_comma = True
+
+
+def _normalize(schema, fp, allow_unknown, chunk_size):
+    if not isinstance(schema, CompiledSchema):
+        schema = compile_schema(schema)
+    ctx = schema._contexts[(bool(allow_unknown), _NORMALIZE)]
+    reader = _Reader(fp, chunk_size)
+    for event in _Streamer(reader).normalize(schema.schema, ctx):
+        yield event
+    reader.end()
+
+
+def _value_events(value):
+    if isinstance(value, dict):
+        yield (START_MAP, None)
+        for key, field_value in value.items():
+            yield (MAP_KEY, key)
+            for event in _value_events(field_value):
+                yield event
+        yield (END_MAP, None)
+    elif isinstance(value, list):
+        yield (START_ARRAY, None)
+        for element in value:
+            for event in _value_events(element):
+                yield event
+        yield (END_ARRAY, None)
+    else:
+        yield (VALUE, value)
+
+
+class _Streamer(object):
+    """
+    Normalizes the values read by a `_Reader`, yielding events. Dicts and lists are
+    yielded as a single VALUE event when they were built in order to normalize
+    them.
+    """
+
+    def __init__(self, reader, small_values=True):
+        self._reader = reader
+        # Whether values smaller than a chunk are decoded all at once
+        self._small_values = small_values
+
+    def normalize(self, schema, ctx):
+        """
+        Normalize the next value with a schema. Returns the value as it was read, if
+        it had to be built, or `_marker` if it was normalized without being built.
+        """
+        reader = self._reader
+        char = reader.peek()
+        if char == "{" or char == "[":
+            value = reader.read_small_value()
+            if value is _marker:
+                plan = _stream_plan(schema, char, ctx)
+                if plan is not None:
+                    building, ctx = plan
+                    if char == "{":
+                        yield from self._dict(building, ctx)
+                    else:
+                        yield from self._list(building, ctx)
+                    return _marker
+                value = reader.read_value()
+        else:
+            value = reader.read_value()
+        yield (VALUE, _normalize_schema(schema, value, ctx))
+        return value
+
+    def copy(self):
+        """Yield the next value as it is."""
+        reader = self._reader
+        char = reader.peek()
+        if char == "{" or char == "[":
+            value = reader.read_small_value() if self._small_values else _marker
+            if value is _marker:
+                if char == "{":
+                    yield from self._dict(None, None)
+                else:
+                    yield from self._list(None, None)
+                return
+        else:
+            value = reader.read_value()
+        yield (VALUE, value)
+
+    def _list(self, elements, ctx):
+        reader = self._reader
+        reader.expect("[")
+        yield (START_ARRAY, None)
+        if reader.peek() == "]":
+            reader.expect("]")
+        else:
+            index = 0
+            while True:
+                if elements is None:
+                    yield from self.copy()
+                else:
+                    yield from self.normalize(elements, ctx.push_stack(index))
+                index += 1
+                if reader.next_delimiter("]"):
+                    break
+        yield (END_ARRAY, None)
+
+    def _dict(self, fields, ctx):
+        """
+        Normalize a dict field by field, like `_normalize_dict`.
+
+        Errors are raised once the whole dict has been read, so that the same error
+        is raised as `_normalize_dict` would raise, which checks for unknown fields
+        first and then checks the fields in the order of the schema. The value in
+        errors about the dict only has the fields that were built.
+        """
+        reader = self._reader
+        reader.expect("{")
+        yield (START_MAP, None)
+        if fields is not None:
+            order = dict((key, index) for index, key in enumerate(fields))
+        read = {}
+        present = set()
+        errors = {}
+        unknown = set()
+        # The position in the schema of the first invalid field. Nothing more is
+        # yielded once a field is invalid, and only the fields before it in the
+        # schema are still normalized, in case they're invalid too.
+        failed = None
+        if reader.peek() == "}":
+            reader.expect("}")
+        else:
+            while True:
+                key = reader.read_key()
+                present.add(key)
+                valid = failed is None and not unknown
+                if fields is None:
+                    yield (MAP_KEY, key)
+                    yield from self.copy()
+                elif key in fields:
+                    if unknown or (failed is not None and order[key] > failed):
+                        _silently(self.copy())
+                    else:
+                        depth = reader.depth
+                        events = self.normalize(fields[key], ctx.push_stack(key))
+                        try:
+                            if valid:
+                                yield (MAP_KEY, key)
+                                value = yield from events
+                            else:
+                                value = _silently(events)
+                        except (_MalformedDocument, json.JSONDecodeError):
+                            raise
+                        except Exception as e:
+                            # Not only SureErrors: `_normalize_dict` would only get
+                            # to this field after checking for unknown fields and
+                            # the fields before it.
+                            reader.skip_to(depth)
+                            errors[key] = e
+                            if failed is None or order[key] < failed:
+                                failed = order[key]
+                        else:
+                            if value is not _marker:
+                                read[key] = value
+                elif ctx.allow_unknown:
+                    if valid:
+                        yield (MAP_KEY, key)
+                        yield from self.copy()
+                    else:
+                        _silently(self.copy())
+                else:
+                    unknown.add(key)
+                    _silently(self.copy())
+                if reader.next_delimiter("}"):
+                    break
+        if fields is not None:
+            yield from self._finish_dict(fields, read, present, errors, unknown, ctx)
+        yield (END_MAP, None)
+
+    def _finish_dict(self, fields, read, present, errors, unknown, ctx):
+        if unknown:
+            raise E.UnknownFields(read, unknown, stack=ctx.stack)
+        defaults = []
+        for key, key_schema in fields.items():
+            if key not in present:
+                default = _get_default(key, key_schema, read, ctx)
+                if default is _marker:
+                    if key_schema.get("required", False):
+                        raise E.DictFieldNotFound(key, value=read, stack=ctx.stack)
+                    continue
+                defaults.append(
+                    (key, _normalize_schema(key_schema, default, ctx.push_stack(key)))
+                )
+            elif key in errors:
+                raise errors[key]
+            excludes = key_schema.get("excludes", [])
+            if not isinstance(excludes, list):
+                excludes = [excludes]
+            for excluded_field in excludes:
+                if excluded_field in present:
+                    raise E.DisallowedField(key, excluded_field, ctx.stack)
+        for key, value in defaults:
+            yield (MAP_KEY, key)
+            yield (VALUE, value)
+
+
+def _silently(events):
+    """Run a generator of events without yielding them, returning what it returns."""
+    while True:
+        try:
+            next(events)
+        except StopIteration as e:
+            return e.value
+
+
+def _stream_plan(schema, char, ctx):
+    """
+    Find out whether a dict (if `char` is "{") or list (if it's "[") can be
+    normalized with a schema without building it. Returns None if it can't, and
+    otherwise the fields or element schema to normalize its contents with (or None
+    if they're kept as they are), and the context to normalize them in.
+    """
+    if isinstance(schema, str):
+        schema = ctx.find_schema(schema)
+    normalizer = _get_normalizer(schema, ctx)
+    building = None
+    for method, directive_value in normalizer.directives:
+        name = method.sureberus_directive["directive"]
+        if name in _CONTEXT_DIRECTIVES:
+            _, ctx = method(normalizer, None, directive_value, ctx)
+        elif name == "schema_ref":
+            merged = normalizer._schema_ref_normalizer(directive_value, ctx)
+            return _stream_plan(merged.schema, char, ctx)
+        elif name == "type":
+            if directive_value != ("dict" if char == "{" else "list"):
+                return None
+        elif name == "fields" or name == "elements":
+            if name != ("fields" if char == "{" else "elements"):
+                return None
+            building = directive_value
+        elif name == "schema":
+            building = directive_value
+        elif name not in _FIELD_DIRECTIVES:
+            return None
+    if building is not None and char == "{":
+        fields = {}
+        for key, key_schema in building.items():
+            key_schema = _resolve_field_schema(key_schema, ctx, normalizer._cache)
+            if "rename" in key_schema or "default_setter" in key_schema:
+                # Renamed fields can replace other fields, and `default_setter`
+                # functions are given the whole dict.
+                return None
+            fields[key] = key_schema
+        building = fields
+    return building, ctx
+
+
+# The whitespace that JSON allows between tokens
+_WHITESPACE = re.compile(r"[ \t\n\r]*")
+# The characters that numbers are made of
+_NUMBER_CHARS = re.compile(r"[-+.eE0-9]*")
+
+
+class _MalformedDocument(ValueError):
+    """Raised by `_Reader` when the document isn't valid JSON."""
+
+
+class _Reader(object):
+    """
+    Reads the tokens of a JSON document from a file, keeping no more than about
+    a chunk of it in memory, unless a single value that's bigger than that is
+    decoded.
+    """
+
+    def __init__(self, fp, chunk_size):
+        self._fp = fp
+        self._chunk_size = chunk_size
+        self._decoder = None
+        self._buffer = ""
+        self._pos = 0
+        # The offset in the document of the start of the buffer
+        self._offset = 0
+        self._eof = False
+        # How many dicts and lists that have been started haven't been ended
+        self.depth = 0
+        self._raw_decode = json.JSONDecoder().raw_decode
+
+    def _fill(self, size):
+        """Read more of the document. Returns False at the end of the file."""
+        data = self._fp.read(size)
+        if isinstance(data, bytes):
+            if self._decoder is None:
+                self._decoder = codecs.getincrementaldecoder("utf-8")()
+            data = self._decoder.decode(data, final=not data)
+        if not data:
+            self._eof = True
+            return False
+        pos = self._pos
+        self._offset += pos
+        self._buffer = self._buffer[pos:] + data
+        self._pos = 0
+        return True
+
+    def _error(self, message, pos=None):
+        if pos is None:
+            pos = self._pos
+        return _MalformedDocument("{} at offset {}".format(message, self._offset + pos))
+
+    def peek(self):
+        """Skip whitespace and return the next character, or "" at the end."""
+        while True:
+            self._pos = _WHITESPACE.match(self._buffer, self._pos).end()
+            if self._pos < len(self._buffer):
+                return self._buffer[self._pos]
+            if not self._fill(self._chunk_size):
+                return ""
+
+    def next_char(self):
+        char = self.peek()
+        if not char:
+            raise self._error("Unexpected end of document")
+        self._pos += 1
+        return char
+
+    def next_delimiter(self, end):
+        """Read a comma or `end`, returning whether it was `end`."""
+        char = self.next_char()
+        if char == end:
+            self.depth -= 1
+            return True
+        if char != ",":
+            raise self._error("Expecting ',' delimiter", self._pos - 1)
+        return False
+
+    def expect(self, char):
+        if self.next_char() != char:
+            raise self._error("Expecting {!r}".format(char), self._pos - 1)
+        if char == "{" or char == "[":
+            self.depth += 1
+        elif char == "}" or char == "]":
+            self.depth -= 1
+
+    def skip_to(self, depth):
+        """
+        Skip the rest of the dicts and lists that were started after there were
+        `depth` of them.
+        """
+        while self.depth > depth:
+            char = self.peek()
+            if char in "{[}]":
+                self.expect(char)
+            elif char in ",:":
+                self._pos += 1
+            else:
+                self.read_value()
+
+    def read_key(self):
+        if self.peek() != '"':
+            raise self._error("Expecting property name enclosed in double quotes")
+        key = self.read_value()
+        self.expect(":")
+        return key
+
+    def read_value(self):
+        """Decode the next value, however big it is."""
+        self.peek()
+        while True:
+            # A number at the end of the buffer might continue in the file.
+            if self._eof or _NUMBER_CHARS.match(self._buffer, self._pos).end() < len(
+                self._buffer
+            ):
+                try:
+                    value, self._pos = self._raw_decode(self._buffer, self._pos)
+                    return value
+                except ValueError as e:
+                    if self._eof:
+                        raise self._error(
+                            getattr(e, "msg", str(e)), getattr(e, "pos", None)
+                        )
+            self._fill(max(self._chunk_size, len(self._buffer) - self._pos))
+
+    def read_small_value(self):
+        """
+        Decode the next value if it's shorter than a chunk, and otherwise return
+        `_marker` without reading it.
+        """
+        while True:
+            try:
+                value, end = self._raw_decode(self._buffer, self._pos)
+            except ValueError:
+                # It's either incomplete or invalid, in which case the error will
+                # be found when it's read token by token.
+                if self._eof:
+                    return _marker
+            else:
+                self._pos = end
+                return value
+            if len(self._buffer) - self._pos >= self._chunk_size:
+                return _marker
+            self._fill(self._chunk_size)
+
+    def end(self):
+        """Check that there's nothing after the document."""
+        if self.peek():
+            raise self._error("Extra data")
@@ -1,9 +1,12 @@
+import json
 import pickle
+import sys
 import tempfile
 from copy import deepcopy
 
 import pytest
 
+import sureberus
 from sureberus import normalize_dict, normalize_schema
 from sureberus import schema as S
 from sureberus import errors as E
@@ -1418,3 +1421,1713 @@ def test_pickling():
 
     newerror = pickle.loads(pickle.dumps(error))
     assert str(newerror) == str(error)
+
+
+def _recursive_ints():
+    return {
+        "registry": {"ints": S.List(schema={"anyof": [S.Integer(), "ints"]})},
+        "schema_ref": "ints",
+    }
+
+
+def _coerce_plus_one(x):
+    return x + 1
+
+
+def _failing_validator(field, value, error):
+    if value == "bad":
+        error(field, "no bad values")
+
+
+# Pairs of schemas and values, used to verify that compiled schemas normalize values
+# (or raise errors) exactly like normalize_schema.
+engine_cases = [
+    (S.Dict(fields={"id": S.Integer(), "name": S.String(default="")}), {"id": 3}),
+    (S.Dict(fields={"id": S.Integer()}), {"id": "3"}),
+    (S.Dict(fields={"id": S.Integer()}), {}),
+    (S.Dict(fields={"id": S.Integer()}), {"id": 3, "extra": 4}),
+    (S.Dict(fields={"id": S.Integer()}), "not a dict"),
+    (S.Dict(allow_unknown=True, fields={"id": S.Integer()}), {"id": 3, "extra": 4}),
+    (S.List(elements=S.Dict(fields={"x": S.Integer(coerce=int)})), [{"x": "1"}]),
+    (S.List(elements=S.Dict(fields={"x": S.Integer(coerce=int)})), [{"x": "one"}]),
+    (S.List(schema=S.Integer()), [1, "two"]),
+    ({"schema": {"type": "integer"}}, [33]),
+    ({"schema": {"x": {"type": "integer"}}}, {"x": 33}),
+    ({"schema": {"x": {"type": "integer"}}}, "neither"),
+    (_recursive_ints(), [1, [2, [3]]]),
+    (_recursive_ints(), [1, ["two"]]),
+    (wki_schema, {"type": "bar", "bar_sibling": 37}),
+    (wki_schema, {"type": "baz"}),
+    (wki_schema_fields, {"type": "foo", "bar_sibling": 37}),
+    (wke_schema_fields, {"image": "foo", "width": 3}),
+    (wke_schema, {"image": "foo", "width": 3, "pattern": {}, "color": "red"}),
+    ({"anyof": [S.Integer(), S.String()]}, "three"),
+    ({"anyof": [S.Integer(), S.String()]}, 3.5),
+    ({"oneof": [{"maxlength": 3}, S.List()]}, [0]),
+    ({"nullable": True, "anyof": [S.Integer(), S.String()]}, None),
+    (S.Float(min=2.1, max=3.9), 3),
+    (S.Float(min=2.1, max=3.9), 4),
+    (S.Float(min=2.1, max=3.9), 1),
+    (S.String(regex=r"\d+"), "3000"),
+    (S.String(regex=r"\d+"), "30a"),
+    ({"regex": "foo"}, 3),
+    ({"maxlength": 3, "minlength": 2}, "abcd"),
+    ({"maxlength": 3, "minlength": 2}, "a"),
+    (S.String(allowed=["2", "3"]), "4"),
+    (S.Boolean(), 1),
+    (S.Integer(nullable=True), None),
+    (S.Dict(schema={"foo": {"rename": "moo", "coerce": str}}), {"foo": 2}),
+    (
+        S.Dict(
+            schema={
+                "foo": {"rename": "moo", "coerce": str},
+                "moo": {"rename": "foo", "coerce": str},
+            },
+            allow_unknown=True,
+        ),
+        {"foo": 1, "moo": 2},
+    ),
+    (
+        S.Dict(allow_unknown=True, schema={"foo": {"rename": "moo", "coerce": str}}),
+        {"moo": 1},
+    ),
+    (S.Dict(schema={"x": S.String(excludes="other")}), {"x": "a", "other": "b"}),
+    (S.Dict(fields={"foo": {"default_copy": []}}), {}),
+    (
+        S.Dict(
+            default_registry={"inc": lambda doc: doc["required"] + 1},
+            schema={
+                "required": S.Integer(),
+                "incremented": S.Integer(default_setter="inc"),
+            },
+        ),
+        {"required": 3},
+    ),
+    (
+        S.Dict(
+            schema={"key": S.String(required=False, default_setter=lambda x: 1 / 0)}
+        ),
+        {},
+    ),
+    (
+        S.Dict(schema={"key": S.String(required=False, default_setter="missing")}),
+        {},
+    ),
+    ({"coerce_registry": {"inc": _coerce_plus_one}, "coerce": "inc"}, 100),
+    ({"coerce": "to_list"}, 100),
+    ({"coerce": "not registered"}, 100),
+    ({"coerce": lambda x: 1 / 0}, 100),
+    ({"coerce_post": "to_set", "type": "integer"}, 100),
+    ({"validator": _failing_validator}, "bad"),
+    (S.Dict(fields={"v": {"validator": _failing_validator}}), {"v": "bad"}),
+    (
+        {"validator_registry": {"check": _failing_validator}, "validator": "check"},
+        "bad",
+    ),
+    (S.Dict(allow_unknown=True, keyschema=S.String(coerce=str)), {31: 4}),
+    (S.Dict(allow_unknown=True, valueschema=S.Integer(coerce=int)), {"a": "4"}),
+    (
+        {
+            "registry": {"requiredfield": S.String(required=True)},
+            "type": "dict",
+            "schema": {
+                "non_required": {"schema_ref": "requiredfield", "required": False},
+                "required": "requiredfield",
+            },
+        },
+        {"non_required": "yy"},
+    ),
+    (
+        {
+            "registry": {
+                "first": {"schema_ref": "second"},
+                "second": {"schema_ref": "third"},
+                "third": S.Dict(fields={"a": {"default": 0}}),
+            },
+            "schema_ref": "first",
+        },
+        {},
+    ),
+    (
+        {
+            "registry": {
+                "schema1": S.String(),
+                "referred": {
+                    "type": "dict",
+                    "registry": {"schema2": S.String()},
+                    "fields": {"s1field": "schema1", "s2field": "schema2"},
+                },
+            },
+            "schema_ref": "referred",
+        },
+        {"s1field": "foo", "s2field": "bar"},
+    ),
+    (
+        {
+            "registry": {"shadowed": S.Integer()},
+            "type": "dict",
+            "fields": {
+                "outer": "shadowed",
+                "inner": {
+                    "registry": {"shadowed": S.String()},
+                    "type": "list",
+                    "elements": "shadowed",
+                },
+            },
+        },
+        {"outer": 1, "inner": ["a", 2]},
+    ),
+    (
+        S.Dict(
+            set_tag={"tag_name": "my_tag", "key": "type"},
+            schema={
+                "type": S.String(),
+                "otherthing": {
+                    "choose_schema": S.when_tag_is(
+                        "my_tag", {"B": S.Boolean(), "S": S.String()}
+                    )
+                },
+            },
+        ),
+        {"type": "B", "otherthing": "foo"},
+    ),
+    (
+        S.Dict(
+            modify_context=lambda v, c: c.set_tag("my_tag", v["type"]),
+            schema={
+                "type": S.String(),
+                "otherthing": {
+                    "choose_schema": {
+                        "function": lambda v, c: (
+                            S.Boolean() if c.get_tag("my_tag") == "bool" else S.String()
+                        )
+                    }
+                },
+            },
+        ),
+        {"type": "bool", "otherthing": True},
+    ),
+    (
+        {
+            "type": "dict",
+            "set_tag": "app_id",
+            "fields": {
+                "app_id": {"type": "string"},
+                "url": {"coerce_with_context": lambda v, c: c.get_tag("app_id") + v},
+            },
+        },
+        {"app_id": "myapp/", "url": "logo.png"},
+    ),
+    (
+        {"choose_schema": {"when_type_is": {"integer": {}, "list": S.List()}}},
+        "hi",
+    ),
+    (
+        {
+            "choose_schema": {
+                "when_type_is": {"integer": {}, "boolean": {"coerce": str}}
+            }
+        },
+        True,
+    ),
+]
+
+
+def test_context_stack():
+    """The stack is kept as linked frames, and only turned into a tuple on demand."""
+    ctx = sureberus.INIT_CONTEXT.push_stack("a").push_stack(0)
+    deeper = ctx.push_stack("b")
+    assert ctx._frame._stack is None
+    assert deeper.stack == ("a", 0, "b")
+    assert ctx.stack == ("a", 0)
+    assert sureberus.INIT_CONTEXT.stack == ()
+
+
+def test_context_scopes():
+    """Registries and tags are layered on top of each other without copying them."""
+    from sureberus.scope import Scope
+
+    first = {"a": 1, "b": 2}
+    ctx = sureberus.INIT_CONTEXT.register_schemas(first).set_tag("t", 1)
+    for n in range(20):
+        ctx = ctx.register_schemas({"b": n, n: n}).set_tag("t", n)
+    assert isinstance(ctx.schema_registry, Scope)
+    assert ctx.find_schema("a") == 1
+    assert ctx.find_schema("b") == 19
+    assert ctx.get_tag("t") == 19
+    expected = {n: n for n in range(20)}
+    expected.update(a=1, b=19)
+    assert dict(ctx.schema_registry) == expected
+    assert ctx.tags == {"t": 19}
+    assert first == {"a": 1, "b": 2}
+    assert sureberus.INIT_CONTEXT.tags == {}
+    with pytest.raises(E.TagNotFound) as ei:
+        ctx.get_tag("nope")
+    assert str(ei.value).startswith(
+        "<At root: Tag 'nope' not found (current tags: dict_keys(['t']))"
+    )
+    # Contexts can still be created with plain dicts
+    assert sureberus.Context(allow_unknown=False, tags={"x": 1}).get_tag("x") == 1
+
+
+def test_context_evolve():
+    """Contexts can be changed with attr.evolve, as modify_context functions did."""
+    import attr
+
+    def allow(value, ctx):
+        return attr.evolve(ctx, allow_unknown=True)
+
+    schema = S.Dict(
+        modify_context=allow,
+        fields={"x": S.Dict(fields={"y": S.Integer(max=1)})},
+    )
+    assert normalize_schema(schema, {"x": {"y": 1, "z": 2}, "w": 3}) == {
+        "x": {"y": 1, "z": 2},
+        "w": 3,
+    }
+    with pytest.raises(E.OutOfBounds) as ei:
+        normalize_schema(schema, {"x": {"y": 2}})
+    assert ei.value.stack == ("x", "y")
+
+    ctx = sureberus.INIT_CONTEXT.push_stack("a").set_tag("t", 1)
+    evolved = attr.evolve(ctx, tags={"u": 2})
+    assert evolved.stack == ("a",)
+    assert evolved.get_tag("u") == 2
+    assert evolved.resolve_coerce("to_list") is ctx.resolve_coerce("to_list")
+    assert attr.evolve(ctx, stack=("b", 0)).stack == ("b", 0)
+    ctx = sureberus.Context(allow_unknown=True, stack=("c",))
+    assert (ctx.allow_unknown, ctx.stack) == (True, ("c",))
+
+
+def test_deep_stack():
+    schema = {"registry": {"nested": S.List(elements="nested")}, "schema_ref": "nested"}
+    value = []
+    inner = value
+    for _ in range(200):
+        inner.append([])
+        inner = inner[0]
+    inner.append(3)
+    with pytest.raises(E.BadType) as ei:
+        normalize_schema(schema, value)
+    assert ei.value.stack == (0,) * 201
+
+
+engines = ["interpreter", "codegen"]
+
+
+def _outcome(f, *args, **kwargs):
+    try:
+        return ("result", f(*args, **kwargs))
+    except E.SureError as e:
+        return ("error", type(e), e.stack, str(e))
+    except Exception as e:
+        return ("exception", type(e))
+
+
+@pytest.mark.parametrize("engine", engines)
+@pytest.mark.parametrize("schema, value", engine_cases)
+def test_compile_schema(engine, schema, value):
+    try:
+        sureberus.check_schema(schema)
+    except E.SchemaError:
+        # Compare what happens at runtime instead
+        check = False
+    else:
+        check = True
+    compiled = sureberus.compile_schema(schema, engine=engine, check=check)
+    expected = _outcome(normalize_schema, deepcopy(schema), deepcopy(value))
+    assert _outcome(compiled.normalize, deepcopy(value)) == expected
+    # Compiled schemas can be used over and over
+    assert _outcome(compiled.normalize, deepcopy(value)) == expected
+
+
+@pytest.mark.parametrize("engine", engines)
+@pytest.mark.parametrize("schema, value", engine_cases)
+def test_normalize_inplace(engine, schema, value):
+    """Normalizing in place has the same result as normalizing a copy."""
+    expected = _outcome(normalize_schema, deepcopy(schema), deepcopy(value))
+    assert (
+        _outcome(normalize_schema, deepcopy(schema), deepcopy(value), inplace=True)
+        == expected
+    )
+    try:
+        sureberus.check_schema(schema)
+    except E.SchemaError:
+        return
+    compiled = sureberus.compile_schema(schema, engine=engine)
+    assert _outcome(compiled.normalize, deepcopy(value), inplace=True) == expected
+
+
+@pytest.mark.parametrize("engine", engines)
+def test_normalize_inplace_returns_value(engine):
+    """Normalizing in place modifies and returns the given containers."""
+    schema = S.Dict(
+        fields={
+            "things": S.List(
+                elements=S.Dict(
+                    fields={"x": S.Integer(coerce=int), "y": S.Integer(default=0)}
+                )
+            ),
+            "names": S.Dict(
+                keyschema=S.String(coerce=str.lower), valueschema=S.String(coerce=str)
+            ),
+            "either": {
+                "anyof": [S.Dict(fields={"a": S.Integer()}), S.Dict(fields={"b": {}})]
+            },
+            "renamed": {"rename": "new_name", "required": False},
+        }
+    )
+    value = {
+        "things": [{"x": "1"}, {"x": 2, "y": 3}],
+        "names": {"A": 1},
+        "either": {"b": 1},
+        "renamed": 5,
+    }
+    things = value["things"]
+    first = things[0]
+    names = value["names"]
+    either = value["either"]
+    expected = normalize_schema(schema, deepcopy(value))
+    compiled = sureberus.compile_schema(schema, engine=engine)
+    result = compiled.normalize(value, inplace=True)
+    assert result is value
+    assert result == expected
+    assert value["things"] is things
+    assert things[0] is first
+    assert first == {"x": 1, "y": 0}
+    assert value["names"] is names
+    assert names == {"a": "1"}
+    assert value["either"] is either
+
+
+def test_normalize_inplace_excludes():
+    """Defaults filled in while normalizing in place aren't excluded."""
+    schema = S.Dict(
+        fields={"a": S.Integer(default=1), "b": S.Integer(excludes="a", required=False)}
+    )
+    assert normalize_schema(schema, {"b": 2}, inplace=True) == {"a": 1, "b": 2}
+    with pytest.raises(E.DisallowedField):
+        normalize_schema(schema, {"a": 1, "b": 2}, inplace=True)
+
+
+def _validation_outcome(f, *args):
+    outcome = _outcome(f, *args)
+    return ("valid",) if outcome[0] == "result" else outcome
+
+
+@pytest.mark.parametrize("engine", engines)
+@pytest.mark.parametrize("schema, value", engine_cases)
+def test_validate(engine, schema, value):
+    """Validating a value fails in the same way as normalizing it."""
+    expected = _validation_outcome(normalize_schema, deepcopy(schema), deepcopy(value))
+    assert (
+        _validation_outcome(sureberus.validate, deepcopy(schema), deepcopy(value))
+        == expected
+    )
+    assert sureberus.is_valid(deepcopy(schema), deepcopy(value)) == (
+        expected == ("valid",)
+    )
+    try:
+        sureberus.check_schema(schema)
+    except E.SchemaError:
+        return
+    compiled = sureberus.compile_schema(schema, engine=engine)
+    assert _validation_outcome(compiled.validate, deepcopy(value)) == expected
+    assert compiled.is_valid(deepcopy(value)) == (expected == ("valid",))
+
+
+def test_validate_doesnt_build_values(monkeypatch):
+    """Validating doesn't build new containers or copy defaults."""
+    import sureberus as sb
+
+    schema = S.Dict(
+        fields={
+            "things": S.List(elements=S.Dict(fields={"x": S.Integer()})),
+            "tags": S.List(default_copy=[], required=False),
+            "names": S.Dict(keyschema=S.String(), valueschema=S.String()),
+        }
+    )
+    value = {"things": [{"x": 1}, {"x": 2}], "names": {"a": "b"}}
+    built = []
+    original = sb._normalize_dict
+    monkeypatch.setattr(
+        sb, "_normalize_dict", lambda *args: built.append(args) or original(*args)
+    )
+    monkeypatch.setattr(sb, "deepcopy", lambda x: built.append(x) or x)
+    assert sureberus.validate(schema, value) is None
+    assert sureberus.compile_schema(schema).validate(value) is None
+    assert built == []
+    assert normalize_schema(schema, value)["tags"] == []
+    assert built
+
+
+def test_validate_uses_built_values():
+    """Directives that look at the normalized value still get to see it."""
+    seen = []
+
+    def validator(field, value, error):
+        seen.append(value)
+
+    schema = S.Dict(
+        fields={"x": S.Integer(default=1), "y": {"rename": "z", "required": False}},
+        validator=validator,
+    )
+    sureberus.validate(schema, {"y": 2})
+    assert seen == [{"x": 1, "z": 2}]
+    del seen[:]
+    sureberus.validate(
+        {"anyof": [S.Dict(fields={"x": S.Integer(default=1)})], "validator": validator},
+        {},
+    )
+    assert seen == [{"x": 1}]
+    with pytest.raises(E.UnknownFields):
+        sureberus.validate(schema, {"z": 2})
+
+
+@pytest.mark.parametrize("engine", engines)
+def test_compile_schema_allow_unknown(engine):
+    compiled = sureberus.compile_schema(S.Dict(fields={"id": S.Integer()}), engine)
+    assert compiled.normalize({"id": 3, "x": 4}, allow_unknown=True) == {
+        "id": 3,
+        "x": 4,
+    }
+    with pytest.raises(E.UnknownFields):
+        compiled.normalize({"id": 3, "x": 4})
+
+
+def test_compile_schema_reuses_normalizers(monkeypatch):
+    """Normalizing with a compiled schema doesn't set up its schema nodes again."""
+    compiled = sureberus.compile_schema(
+        S.Dict(fields={"things": S.List(elements=S.Dict(fields={"x": S.Integer()}))})
+    )
+    created = []
+
+    class CountingNormalizer(sureberus.Normalizer):
+        def __attrs_post_init__(self):
+            created.append(self.schema)
+            super(CountingNormalizer, self).__attrs_post_init__()
+
+    monkeypatch.setattr(sureberus, "Normalizer", CountingNormalizer)
+    assert compiled.normalize({"things": [{"x": 1}, {"x": 2}]}) == {
+        "things": [{"x": 1}, {"x": 2}]
+    }
+    assert created == []
+
+
+def test_compile_schema_caches_schema_ref(monkeypatch):
+    """
+    Schemas merged for `schema_ref` are reused, but a name that is shadowed by a
+    nested registry still refers to the right schema.
+    """
+    merges = []
+    merge_schemas = sureberus._merge_schemas
+
+    def counting_merge_schemas(schema1, schema2):
+        merges.append(schema1)
+        return merge_schemas(schema1, schema2)
+
+    monkeypatch.setattr(sureberus, "_merge_schemas", counting_merge_schemas)
+    thing = S.Dict(fields={"x": {"schema_ref": "num", "default": 0}})
+    compiled = sureberus.compile_schema(
+        S.Dict(
+            registry={"num": S.Integer(max=10)},
+            fields={
+                "a": S.List(elements={"schema_ref": "num"}),
+                "b": thing,
+                "c": S.Dict(registry={"num": S.String()}, fields={"x": thing}),
+            },
+        )
+    )
+    value = {"a": [1, 2, 3], "b": {}, "c": {"x": {"x": "str"}}}
+    for _ in range(3):
+        assert compiled.normalize(value) == {
+            "a": [1, 2, 3],
+            "b": {"x": 0},
+            "c": {"x": {"x": "str"}},
+        }
+    assert len(merges) == 3
+    with pytest.raises(E.BadType) as ei:
+        compiled.normalize({"a": [], "b": {}, "c": {"x": {"x": 1}}})
+    assert ei.value.stack == ("c", "x", "x")
+    with pytest.raises(E.OutOfBounds):
+        compiled.normalize({"a": [], "b": {"x": 11}, "c": {"x": {}}})
+
+
+@pytest.mark.parametrize("engine", engines)
+def test_compile_schema_dispatch_tables(engine, monkeypatch):
+    """The schemas for `when_key_is` and `when_key_exists` choices are made once."""
+    merges = []
+
+    def counting(method):
+        def merge(self, directive_name, directive_value, subschema):
+            merges.append(subschema)
+            return method(self, directive_name, directive_value, subschema)
+
+        return merge
+
+    for name in ("_merge_key_is_choice", "_merge_key_exists_choice"):
+        method = getattr(sureberus.Normalizer, name)
+        monkeypatch.setattr(sureberus.Normalizer, name, counting(method))
+    choices = {
+        "event{}".format(n): S.Dict(fields={"n": S.Integer(max=n)})
+        for n in range(60)
+    }
+    compiled = sureberus.compile_schema(
+        S.Dict(
+            fields={
+                "events": S.List(
+                    elements=S.Dict(
+                        choose_schema={
+                            "when_key_is": {"key": "kind", "choices": choices}
+                        }
+                    )
+                ),
+                "payload": S.Dict(
+                    choose_schema={
+                        "when_key_exists": {
+                            "a": S.Dict(fields={"a": S.String()}),
+                            "b": S.Dict(fields={"b": S.Integer()}),
+                        }
+                    }
+                ),
+            }
+        ),
+        engine=engine,
+    )
+    events = [{"kind": "event{}".format(n % 60), "n": n % 60} for n in range(600)]
+    value = {"events": events, "payload": {"b": 1}}
+    assert compiled.normalize(value) == value
+    assert len(merges) == 61
+    assert compiled.normalize(value) == value
+    assert len(merges) == 61
+    with pytest.raises(E.OutOfBounds) as ei:
+        compiled.normalize(
+            {"events": [{"kind": "event3", "n": 4}], "payload": {"b": 1}}
+        )
+    assert ei.value.stack == ("events", 0, "n")
+    with pytest.raises(E.DisallowedValue) as ei:
+        compiled.normalize({"events": [{"kind": "nope"}], "payload": {"b": 1}})
+    assert ei.value.stack == ("events", 0, "kind")
+    with pytest.raises(E.DisallowedField) as ei:
+        compiled.normalize({"events": [], "payload": {"b": 1, "a": "x"}})
+    assert (ei.value.field, ei.value.excluded) == ("a", "b")
+
+
+class _MyStr(str):
+    pass
+
+
+@pytest.mark.parametrize(
+    "choices",
+    [
+        {"integer": {"coerce": str}, "boolean": {"coerce": int}},
+        {"boolean": {"coerce": int}, "float": {"coerce": float}},
+        {"number": {}, "string": {"coerce": len}, "list": {"elements": "string"}},
+        {"none": {"default": 3}, "dict": {"allow_unknown": True}, "set": {}},
+    ],
+)
+def test_compile_schema_when_type_is(choices):
+    """Choices made by type are remembered, following the same precedence."""
+    schema = S.List(
+        registry={"string": S.String()},
+        elements={"choose_schema": {"when_type_is": choices}},
+    )
+    compiled = sureberus.compile_schema(schema)
+    for value in [
+        [True, 1, False, 2.5, None, _MyStr("abc"), "de", {"a": 1}, set(), ["x"]],
+        [False, 3, _MyStr("x"), 1.0],
+    ]:
+        for element in value:
+            single = [element]
+            expected = _outcome(normalize_schema, schema, single)
+            assert _outcome(compiled.normalize, single) == expected
+            assert _outcome(compiled.normalize, single) == expected
+
+
+def test_multi_doesnt_copy_or_modify_value(monkeypatch):
+    """`anyof` and `oneof` rules are tried on the value itself, which is untouched."""
+    monkeypatch.setattr(sureberus, "deepcopy", None, raising=False)
+    schema = {
+        "anyof": [
+            S.Dict(keyschema=S.String(coerce=str.upper), valueschema=S.String()),
+            S.Dict(keyschema=S.String(coerce=str.upper), valueschema=S.Integer()),
+        ]
+    }
+    value = {"a": 1, "b": 2}
+    assert normalize_schema(schema, value) == {"A": 1, "B": 2}
+    assert value == {"a": 1, "b": 2}
+    with pytest.raises(E.NoneMatched) as ei:
+        normalize_schema(schema, {"a": None})
+    assert ei.value.value == {"a": None}
+    oneof = {"oneof": [S.List(coerce=list), S.List(elements=S.Integer())]}
+    value = [1, 2]
+    with pytest.raises(E.MoreThanOneMatched) as ei:
+        normalize_schema(oneof, value)
+    assert ei.value.value is value
+
+
+def test_multi_only_tries_rules_that_could_match(monkeypatch):
+    """
+    Rules that can be ruled out by `type`, `allowed` or required fields are skipped.
+    """
+    shapes = [
+        S.Dict(
+            fields={"kind": S.String(allowed=["kind{}".format(n)]), "n": S.Integer()}
+        )
+        for n in range(20)
+    ]
+    shapes.append(S.Dict(fields={"other": S.Integer()}))
+    shapes.append(S.String(coerce=str.strip))
+    schema = S.List(elements={"anyof": shapes})
+    tried = []
+    normalize = sureberus.Normalizer.normalize
+
+    def counting_normalize(self, value, ctx):
+        if "anyof" not in self.schema:
+            tried.append(self.schema)
+        return normalize(self, value, ctx)
+
+    monkeypatch.setattr(sureberus.Normalizer, "normalize", counting_normalize)
+    compiled = sureberus.compile_schema(schema)
+    for normalize_value in [compiled.normalize, lambda v: normalize_schema(schema, v)]:
+        del tried[:]
+        assert normalize_value([{"kind": "kind15", "n": 1}]) == [
+            {"kind": "kind15", "n": 1}
+        ]
+        assert [s.get("fields", {}).get("kind") for s in tried[1:]] == [
+            shapes[15]["fields"]["kind"],
+            None,  # the "kind" field
+            None,  # the "n" field
+        ]
+        del tried[:]
+        assert normalize_value([{"other": 1}]) == [{"other": 1}]
+        assert len(tried) == 1 + 1 + 1
+        assert normalize_value([" 5 "]) == ["5"]
+
+    with pytest.raises(E.NoneMatched) as ei:
+        compiled.normalize([{"kind": "kind15", "n": "x"}])
+    # All of the rules are tried to report the error
+    assert len(ei.value.errors) == len(shapes)
+    assert [type(e) for e in ei.value.errors[:16]] == [E.DisallowedValue] * 15 + [
+        E.BadType
+    ]
+
+
+def test_oneof_skipping_rules():
+    schema = {
+        "oneof": [
+            S.Integer(max=10),
+            S.Integer(min=5),
+            S.String(),
+            S.Dict(fields={"a": S.Integer()}),
+        ]
+    }
+    assert normalize_schema(schema, 3) == 3
+    assert normalize_schema(schema, "x") == "x"
+    assert normalize_schema(schema, {"a": 1}) == {"a": 1}
+    with pytest.raises(E.MoreThanOneMatched):
+        normalize_schema(schema, 7)
+    with pytest.raises(E.NoneMatched) as ei:
+        normalize_schema(schema, {})
+    assert len(ei.value.errors) == 4
+
+
+def test_adaptive_anyof(monkeypatch):
+    """Rules of an `anyof` can be tried in the order in which they tend to match."""
+    shapes = [
+        S.Dict(fields={"kind": S.String(allowed=[n]), "n": S.Integer()})
+        for n in "abcdefghij"
+    ]
+    schema = S.List(elements={"anyof": shapes})
+    compiled = sureberus.compile_schema(schema, adaptive_anyof=True)
+    checked = []
+    could_match = sureberus.Normalizer.could_match
+
+    def counting_could_match(self, value):
+        checked.append(self.schema)
+        return could_match(self, value)
+
+    monkeypatch.setattr(sureberus.Normalizer, "could_match", counting_could_match)
+    value = [{"kind": "j", "n": 1}] * 10
+    assert compiled.normalize(value) == value
+    assert len(checked) == 10 + 9
+    with pytest.raises(E.NoneMatched) as ei:
+        compiled.normalize([{"kind": "z", "n": 1}])
+    assert len(ei.value.errors) == 10
+
+
+@pytest.mark.parametrize("mode, expected", [(True, "first"), ("always", "second")])
+def test_adaptive_anyof_order(mode, expected):
+    """Only `adaptive_anyof="always"` reorders rules that could both match."""
+    schema = {
+        "anyof": [
+            {"type": "integer", "coerce_post": lambda v: ("first", v)},
+            {"coerce_post": lambda v: ("second", v)},
+        ]
+    }
+    compiled = sureberus.compile_schema(schema, adaptive_anyof=mode)
+    for _ in range(3):
+        assert compiled.normalize("x") == ("second", "x")
+    assert compiled.normalize(5) == (expected, 5)
+
+
+def test_adaptive_anyof_invalid():
+    with pytest.raises(ValueError):
+        sureberus.compile_schema({}, adaptive_anyof="sometimes")
+
+
+@pytest.mark.parametrize("engine", engines)
+def test_compile_schema_stackless(engine):
+    """
+    Schemas that don't look at the Context are normalized without keeping track of
+    the stack, but errors still have the right stack.
+    """
+    schema = S.Dict(
+        registry={"num": S.Integer()},
+        fields={"nums": S.List(elements={"schema_ref": "num"})},
+    )
+    compiled = sureberus.compile_schema(schema, engine=engine)
+    assert compiled._stackless_contexts is not None
+    assert compiled.normalize({"nums": [1, 2]}) == {"nums": [1, 2]}
+    with pytest.raises(E.BadType) as ei:
+        compiled.normalize({"nums": [1, "2"]})
+    assert ei.value.stack == ("nums", 1)
+
+
+@pytest.mark.parametrize(
+    "field_schema",
+    [
+        {"validator": _failing_validator},
+        {"coerce_with_context": lambda v, ctx: v},
+        S.Dict(set_tag="x", choose_schema={"when_tag_is": {"tag": "x", "choices": {}}}),
+    ],
+)
+def test_compile_schema_uses_context(field_schema):
+    compiled = sureberus.compile_schema(S.Dict(fields={"x": field_schema}))
+    assert compiled._stackless_contexts is None
+
+
+def test_compile_schema_unknown_directives():
+    """Unknown directives are found when the schema is compiled."""
+    with pytest.raises(E.UnknownSchemaDirectives) as ei:
+        sureberus.compile_schema(S.Dict(fields={"x": {"tpye": "integer"}}))
+    assert ei.value.directives == {"tpye"}
+
+
+@pytest.mark.parametrize(
+    "schema, error, path",
+    [
+        (
+            S.Dict(fields={"x": {"coerce": "nope"}}),
+            E.UnregisteredFunction,
+            ("fields", "x", "coerce"),
+        ),
+        (
+            S.Dict(fields={"x": S.Integer(default_setter="nope")}),
+            E.UnregisteredFunction,
+            ("fields", "x", "default_setter"),
+        ),
+        (S.List(elements="thing"), E.SchemaNotFound, ("elements",)),
+        (
+            S.Dict(anyof=[S.Dict(), {"schema_ref": "thing"}]),
+            E.SchemaNotFound,
+            ("anyof", 1, "schema_ref"),
+        ),
+        (
+            {
+                "choose_schema": {
+                    "when_key_is": {"key": "k", "choices": {"a": {"validator": "v"}}}
+                }
+            },
+            E.UnregisteredFunction,
+            ("choose_schema", "when_key_is", "choices", "a", "validator"),
+        ),
+        (
+            {"choose_schema": {"when_key_was": {}}},
+            E.InvalidDirective,
+            ("choose_schema",),
+        ),
+        ({"type": "str"}, E.InvalidDirective, ("type",)),
+        ({"type": {"type": "string"}}, E.InvalidDirective, ("type",)),
+        (
+            {"schema": {"type": {"bad": 1}}},
+            E.InvalidDirective,
+            ("schema", "type"),
+        ),
+        ({"regex": "(unclosed"}, E.InvalidDirective, ("regex",)),
+        (S.Dict(fields={"x": 3}), E.InvalidDirective, ("fields", "x")),
+    ],
+)
+def test_check_schema(schema, error, path):
+    with pytest.raises(error) as ei:
+        sureberus.check_schema(schema)
+    assert ei.value.path == path
+    with pytest.raises(error):
+        sureberus.compile_schema(schema)
+
+
+def test_check_schema_registries():
+    """Names are resolved using the registries in effect where they're used."""
+    sureberus.check_schema(
+        {
+            "registry": {
+                "node": S.Dict(
+                    fields={"children": S.List(required=False, elements="node")}
+                )
+            },
+            "coerce_registry": {"inc": _coerce_plus_one},
+            "type": "dict",
+            "fields": {
+                "root": "node",
+                "n": {"coerce": "inc", "default_setter": "list"},
+                "dynamic": {"modify_context": lambda v, ctx: ctx, "validator": "later"},
+                "function": {"choose_schema": {"function": lambda v, ctx: {}}},
+            },
+        }
+    )
+    with pytest.raises(E.SchemaNotFound):
+        sureberus.check_schema(S.Dict(fields={"a": {"registry": {"x": {}}}, "b": "x"}))
+
+
+@pytest.mark.parametrize("engine", engines)
+def test_compile_schema_ambiguous_schema(engine):
+    """
+    Without a `type`, a `schema` whose keys are all directives may still be a dict
+    of fields.
+    """
+    schema = {"schema": {"type": {"type": "string"}}}
+    sureberus.check_schema(schema)
+    compiled = sureberus.compile_schema(schema, engine=engine)
+    assert compiled.normalize({"type": "x"}) == normalize_schema(schema, {"type": "x"})
+    with pytest.raises(E.BadType) as ei:
+        compiled.normalize({"type": 1})
+    assert ei.value.stack == ("type",)
+
+
+def test_compile_command(tmp_path):
+    """`sureberus compile` writes a module which normalizes values with the schema."""
+    import importlib
+    from sureberus import cli
+
+    (tmp_path / "schema.yaml").write_text(
+        u"""
+type: dict
+coerce_registry:
+  plus_one: "test_sure:_coerce_plus_one"
+registry:
+  name: {type: string, regex: "[a-z]+"}
+fields:
+  n: {type: integer, coerce: plus_one, min: 2}
+  name: {schema_ref: name, default: "anonymous"}
+  tags: {type: list, elements: {type: string}, default_setter: list}
+  either: {anyof: [{type: integer}, {type: string}], required: false}
+"""
+    )
+    cli.main(
+        [
+            "compile",
+            str(tmp_path / "schema.yaml"),
+            "-o",
+            str(tmp_path / "generated_schema.py"),
+        ]
+    )
+    schema = cli.load_schema(str(tmp_path / "schema.yaml"))
+    assert schema["coerce_registry"]["plus_one"] is _coerce_plus_one
+
+    sys.path.insert(0, str(tmp_path))
+    try:
+        generated = importlib.import_module("generated_schema")
+    finally:
+        sys.path.remove(str(tmp_path))
+    assert generated.normalize({"n": 1}) == {"n": 2, "name": "anonymous", "tags": []}
+    assert generated.normalize({"n": 1, "either": "x"}) == normalize_schema(
+        schema, {"n": 1, "either": "x"}
+    )
+    with pytest.raises(E.RegexMismatch) as ei:
+        generated.normalize({"n": 1, "name": "Bob"})
+    assert ei.value.stack == ("name",)
+    with pytest.raises(E.UnknownFields):
+        generated.normalize({"n": 1, "extra": 0})
+    assert generated.normalize({"n": 1, "extra": 0}, allow_unknown=True)["extra"] == 0
+
+
+def test_validate_command(tmp_path, capsys):
+    """`sureberus validate` normalizes documents and reports the invalid ones."""
+    from sureberus import cli
+
+    (tmp_path / "schema.json").write_text(
+        u'{"type": "dict", "fields": {"x": {"type": "integer", "default": 0}}}'
+    )
+    (tmp_path / "a.jsonl").write_text(u'{"x": 1}\n{"x": "a"}\n{}\n')
+    (tmp_path / "b.json").write_text(u'{\n  "y": 2\n}')
+    status = cli.main(
+        [
+            "validate",
+            str(tmp_path / "schema.json"),
+            str(tmp_path / "a.jsonl"),
+            str(tmp_path / "b.json"),
+            "-o",
+            str(tmp_path / "out.jsonl"),
+            "-e",
+            str(tmp_path / "errors.jsonl"),
+        ]
+    )
+    assert status == 1
+    assert (tmp_path / "out.jsonl").read_text() == u'{"x": 1}\n{"x": 0}\n'
+    errors = [
+        json.loads(line)
+        for line in (tmp_path / "errors.jsonl").read_text().splitlines()
+    ]
+    assert [(error["line"], error["error"]) for error in errors] == [
+        (2, "BadType"),
+        (None, "UnknownFields"),
+    ]
+    assert errors[1]["file"] == str(tmp_path / "b.json")
+    stats = capsys.readouterr().out
+    assert "4 documents (2 valid, 2 invalid)" in stats
+    assert "p99" in stats
+
+    (tmp_path / "c.jsonl").write_text(u'{"x": 1}\n')
+    status = cli.main(
+        ["validate", str(tmp_path / "schema.json"), str(tmp_path / "c.jsonl")]
+    )
+    assert status == 0
+
+
+def test_validate_command_unserializable(tmp_path):
+    """Documents that can't be written as JSON are reported as invalid."""
+    from sureberus import cli
+
+    (tmp_path / "schema.json").write_text(
+        u'{"type": "dict", "fields": {"x": {"coerce": "to_set"}}}'
+    )
+    (tmp_path / "a.jsonl").write_text(u'{"x": 1}\n{"y": 2}\n')
+    status = cli.main(
+        [
+            "validate",
+            str(tmp_path / "schema.json"),
+            str(tmp_path / "a.jsonl"),
+            "-o",
+            str(tmp_path / "out.jsonl"),
+            "-e",
+            str(tmp_path / "errors.jsonl"),
+        ]
+    )
+    assert status == 1
+    assert (tmp_path / "out.jsonl").read_text() == u""
+    errors = [
+        json.loads(line)
+        for line in (tmp_path / "errors.jsonl").read_text().splitlines()
+    ]
+    assert [(error["line"], error["error"]) for error in errors] == [
+        (1, "TypeError"),
+        (2, "UnknownFields"),
+    ]
+
+
+def test_compile_command_builtin_method(tmp_path):
+    """Functions loaded by import path are imported by that path."""
+    from sureberus import cli
+
+    (tmp_path / "schema.json").write_text(
+        u'{"type": "string", "coerce_registry": {"upper": "builtins:str.upper"},'
+        u' "coerce": "upper"}'
+    )
+    cli.main(
+        ["compile", str(tmp_path / "schema.json"), "-o", str(tmp_path / "out.py")]
+    )
+    namespace = {}
+    exec((tmp_path / "out.py").read_text(), namespace)
+    assert namespace["normalize"]("abc") == "ABC"
+
+
+def test_generate_module_stable_order():
+    """Generated modules don't depend on hash randomization."""
+    import os
+    import subprocess
+
+    script = (
+        "from sureberus import codegen, schema as S\n"
+        "fields = {k: S.Integer() for k in 'abcdefghij'}\n"
+        "print(codegen.generate_module(S.Dict(fields=fields)))\n"
+    )
+    sources = set()
+    for seed in ("1", "2", "3"):
+        env = dict(os.environ, PYTHONHASHSEED=seed)
+        sources.add(
+            subprocess.check_output([sys.executable, "-c", script], env=env)
+        )
+    assert len(sources) == 1
+
+
+def test_generate_module_unimportable_function():
+    """Functions in a schema written to a module must be importable."""
+    from sureberus import codegen
+
+    with pytest.raises(ValueError):
+        codegen.generate_module({"coerce": lambda x: x})
+
+
+def test_normalize_many():
+    """Invalid values in a batch are reported without stopping the batch."""
+    values = [{"x": 1}, {"x": "a"}, {}, {"x": "b"}, {"x": 2, "y": 3}]
+    batch = sureberus.normalize_many(S.Dict(fields={"x": S.Integer()}), values)
+    assert batch.summary.total == 0
+    assert next(batch) == (0, {"x": 1})
+    assert batch.summary.total == 1
+    results = list(batch)
+    assert [index for index, result in results] == [1, 2, 3, 4]
+    assert isinstance(results[0][1], E.BadType)
+    assert results[0][1].stack == ("x",)
+    assert isinstance(results[1][1], E.DictFieldNotFound)
+    assert isinstance(results[2][1], E.BadType)
+    assert isinstance(results[3][1], E.UnknownFields)
+    assert batch.summary.total == 5
+    assert batch.summary.valid == 1
+    assert batch.summary.invalid == 4
+    assert batch.summary.error_counts == {
+        E.BadType: 2,
+        E.DictFieldNotFound: 1,
+        E.UnknownFields: 1,
+    }
+
+
+def test_normalize_many_compiled():
+    """normalize_many takes compiled schemas and normalize's options."""
+    compiled = sureberus.compile_schema(S.Dict(fields={"x": S.Integer()}))
+    values = [{"x": 1, "y": 2}]
+    assert list(
+        sureberus.normalize_many(compiled, values, allow_unknown=True, inplace=True)
+    ) == [(0, {"x": 1, "y": 2})]
+    assert list(sureberus.normalize_many(compiled, values))[0][1].stack == ()
+
+
+def test_json_loads(tmp_path):
+    """sureberus.json decodes JSON documents and normalizes them."""
+    from sureberus import json as sure_json
+
+    schema = S.Dict(fields={"x": S.Integer(), "y": S.List(default_setter="list")})
+    assert sure_json.loads(schema, '{"x": 1}') == {"x": 1, "y": []}
+    compiled = sureberus.compile_schema(schema)
+    assert sure_json.loads(compiled, '{"x": 1, "z": 2}', allow_unknown=True) == {
+        "x": 1,
+        "y": [],
+        "z": 2,
+    }
+    with pytest.raises(E.BadType):
+        sure_json.loads(compiled, '{"x": "1"}')
+    with pytest.raises(ValueError):
+        sure_json.loads(compiled, '{"x": ')
+    (tmp_path / "doc.json").write_text(u'{"x": 2}')
+    with open(str(tmp_path / "doc.json")) as f:
+        assert sure_json.load(schema, f) == {"x": 2, "y": []}
+
+
+def test_json_loads_compiles_once(monkeypatch):
+    """Schemas that aren't compiled are compiled once for all of their documents."""
+    from sureberus import json as sure_json
+
+    compiled = []
+    compile_schema = sure_json.compile_schema
+    monkeypatch.setattr(
+        sure_json,
+        "compile_schema",
+        lambda schema: compiled.append(schema) or compile_schema(schema),
+    )
+    schema = S.Dict(fields={"x": S.Integer()})
+    for i in range(3):
+        assert sure_json.loads(schema, '{"x": %d}' % i) == {"x": i}
+    assert compiled == [schema]
+    other = S.Dict(fields={"x": S.Integer()})
+    sure_json.loads(other, '{"x": 1}')
+    assert len(compiled) == 2
+
+
+@pytest.mark.parametrize("workers", [None, 2])
+def test_normalize_jsonl(tmp_path, workers):
+    """JSON Lines files are normalized line by line."""
+    path = tmp_path / "values.jsonl"
+    path.write_bytes(
+        b'{"x": 1}\n'
+        b"\n"
+        b"{not json\n"
+        b'{"x": "a"}\n'
+        b'{"x": 2, "y": [3]}\n'
+        b"[1, 2\n"
+        b'{"x": 4}'
+    )
+    valid_path = tmp_path / "valid.jsonl"
+    invalid_path = tmp_path / "invalid.jsonl"
+    batch = sureberus.normalize_jsonl(
+        S.Dict(fields={"x": S.Integer(), "z": S.Integer(default=0)}),
+        str(path),
+        allow_unknown=True,
+        workers=workers,
+        valid_path=str(valid_path),
+        invalid_path=str(invalid_path),
+    )
+    results = list(batch)
+    assert [line_number for line_number, result in results] == [1, 3, 4, 5, 6, 7]
+    assert results[0][1] == {"x": 1, "z": 0}
+    assert isinstance(results[1][1], ValueError)
+    assert isinstance(results[2][1], E.BadType)
+    assert results[3][1] == {"x": 2, "y": [3], "z": 0}
+    assert isinstance(results[4][1], ValueError)
+    assert results[5][1] == {"x": 4, "z": 0}
+    assert batch.summary.total == 6
+    assert batch.summary.valid == 3
+    assert [json.loads(line) for line in valid_path.read_text().splitlines()] == [
+        {"x": 1, "z": 0},
+        {"x": 2, "y": [3], "z": 0},
+        {"x": 4, "z": 0},
+    ]
+    assert invalid_path.read_bytes() == b'{not json\n{"x": "a"}\n[1, 2\n'
+
+
+def test_normalize_jsonl_empty(tmp_path):
+    path = tmp_path / "values.jsonl"
+    path.write_bytes(b"")
+    assert list(sureberus.normalize_jsonl(S.Integer(), str(path))) == []
+
+
+def test_normalize_many_workers():
+    """Values can be normalized in worker processes."""
+    schema = S.Dict(fields={"x": S.Integer(coerce="plus_one")})
+    schema["coerce_registry"] = {"plus_one": _coerce_plus_one}
+    values = [{"x": i} if i % 3 else {"x": str(i)} for i in range(50)]
+    batch = sureberus.normalize_many(schema, values, workers=2)
+    results = list(batch)
+
+    def _comparable(results):
+        return [
+            (index, str(result) if isinstance(result, E.SureError) else result)
+            for index, result in results
+        ]
+
+    assert _comparable(results) == _comparable(sureberus.normalize_many(schema, values))
+    assert [index for index, result in results] == list(range(50))
+    assert batch.summary.total == 50
+    assert batch.summary.error_counts == {E.CoerceUnexpectedError: 17}
+    assert results[3][1].stack == ("x",)
+
+
+@pytest.mark.parametrize("engine", engines)
+def test_pickle_compiled_schema(engine):
+    """Compiled schemas are pickled as their schema and options."""
+    schema = S.Dict(fields={"x": S.Integer(coerce=_coerce_plus_one)})
+    compiled = sureberus.compile_schema(schema, engine=engine, adaptive_anyof=True)
+    unpickled = pickle.loads(pickle.dumps(compiled))
+    assert unpickled == compiled
+    assert unpickled.normalize({"x": 1}) == {"x": 2}
+
+
+def test_pickle_errors():
+    """Errors made of plain data are pickled with their fields."""
+    with pytest.raises(E.NoneMatched) as ei:
+        normalize_schema(
+            S.Dict(fields={"x": {"anyof": [S.Integer(), S.List()]}}), {"x": "a"}
+        )
+    error = pickle.loads(pickle.dumps(ei.value))
+    assert type(error) is E.NoneMatched
+    assert error == ei.value
+    assert error.stack == ("x",)
+    assert type(error.errors[0]) is E.BadType
+
+    with pytest.raises(E.CoerceUnexpectedError) as ei:
+        normalize_schema(S.Integer(coerce=int), "a")
+    error = pickle.loads(pickle.dumps(ei.value))
+    assert type(error.exception) is ValueError
+    assert str(error) == str(ei.value)
+
+
+class _CustomError(E.SureError):
+    fmt = "custom {value!r}"
+
+    def __init__(self, value, stack):
+        self.value = value
+        self.stack = stack
+
+
+def test_pickle_errors_unpicklable_fields():
+    """
+    Errors keep their type when their fields aren't plain data, which are replaced
+    by stand-ins with the same repr and str.
+    """
+    import datetime
+
+    date = datetime.date(2020, 1, 2)
+    with pytest.raises(E.NoneMatched) as ei:
+        normalize_schema(
+            S.Dict(fields={"x": {"anyof": [S.Integer(), S.List()]}}), {"x": date}
+        )
+    error = pickle.loads(pickle.dumps(ei.value))
+    assert type(error) is E.NoneMatched
+    assert str(error) == str(ei.value)
+    assert type(error.errors[0]) is E.BadType
+    assert isinstance(error.errors[0].value, E.Unpicklable)
+    assert repr(error.errors[0].value) == repr(date)
+
+    class Boom(Exception):
+        pass
+
+    def fail(field, value, error):
+        raise Boom(object())
+
+    with pytest.raises(E.ValidatorUnexpectedError) as ei:
+        normalize_schema(S.Integer(validator=fail), 1)
+    error = pickle.loads(pickle.dumps(ei.value))
+    assert type(error) is E.ValidatorUnexpectedError
+    assert str(error) == str(ei.value)
+
+    error = pickle.loads(pickle.dumps(_CustomError(date, ("x",))))
+    assert type(error) is _CustomError
+    assert str(error) == str(_CustomError(date, ("x",)))
+
+    batch = sureberus.normalize_many(S.Integer(), [1, date], workers=2)
+    assert type(list(batch)[1][1]) is E.BadType
+    assert batch.summary.error_counts == {E.BadType: 1}
+
+
+class _MessageError(E.SureError):
+    def __init__(self, value, stack):
+        super(_MessageError, self).__init__("bad value")
+        self.value = value
+        self.stack = stack
+
+    def __str__(self):
+        return "bad value {!r}".format(self.value)
+
+
+def _raise_message_error(value):
+    raise _MessageError(value, ())
+
+
+def test_pickle_errors_other_constructor():
+    """Errors which can't be rebuilt from their args are unpickled as Exceptions."""
+    error = pickle.loads(pickle.dumps(_MessageError(1, ())))
+    assert type(error) is Exception
+    assert str(error) == "bad value 1"
+
+    batch = sureberus.normalize_many({"coerce": _raise_message_error}, [1], workers=2)
+    [(index, error)] = list(batch)
+    assert type(error) is Exception
+    assert str(error) == "bad value 1"
+
+
+def test_compile_schema_elements_workers():
+    """The elements of big lists can be normalized in worker processes."""
+    schema = S.Dict(
+        registry={"thing": S.Dict(fields={"x": S.Integer(coerce="plus_one")})},
+        coerce_registry={"plus_one": _coerce_plus_one},
+        fields={"things": S.List(elements="thing"), "n": S.Integer()},
+    )
+    values = {"things": [{"x": i} for i in range(100)], "n": 1}
+    expected = normalize_schema(schema, deepcopy(values))
+    with sureberus.compile_schema(
+        schema, elements_workers=2, elements_threshold=10
+    ) as compiled:
+        assert compiled.normalize(deepcopy(values)) == expected
+        inplace = deepcopy(values)
+        things = inplace["things"]
+        assert compiled.normalize(inplace, inplace=True) is inplace
+        assert inplace == expected
+        assert inplace["things"] is things
+        compiled.validate(values)
+
+        invalid = deepcopy(values)
+        invalid["things"][37]["x"] = "a"
+        invalid["things"][80]["x"] = None
+        with pytest.raises(E.CoerceUnexpectedError) as ei:
+            compiled.normalize(invalid)
+        assert ei.value.stack == ("things", 37, "x")
+        assert not compiled.is_valid(invalid)
+    assert compiled._pool is None
+
+
+@pytest.mark.parametrize("engine", engines)
+def test_compile_schema_threads(engine):
+    """A compiled schema can be used from many threads at once."""
+    import threading
+
+    schema = S.Dict(
+        registry={
+            "point": S.Dict(fields={"x": S.Integer(), "y": S.Integer(default=0)}),
+            "shape": {
+                "anyof": [
+                    S.Dict(fields={"kind": S.String(allowed=["circle"]), "r": "num"}),
+                    S.Dict(fields={"kind": S.String(allowed=["line"]), "to": "point"}),
+                ]
+            },
+            "num": {"anyof": [S.Integer(), S.Float()]},
+        },
+        fields={
+            "shapes": S.List(elements="shape"),
+            "at": {"schema_ref": "point", "required": False},
+            "names": S.Dict(keyschema=S.String(coerce=str.lower), required=False),
+        },
+    )
+    values = []
+    for i in range(200):
+        value = {
+            "shapes": [
+                {"kind": "circle", "r": i * 0.5},
+                {"kind": "line", "to": {"x": i}},
+            ]
+        }
+        if i % 3 == 0:
+            value["at"] = {"x": i, "y": "bad" if i % 9 == 0 else i}
+        if i % 4 == 0:
+            value["names"] = {"A{}".format(i): i}
+        values.append(value)
+    expected = [_outcome(normalize_schema, schema, deepcopy(value)) for value in values]
+    compiled = sureberus.compile_schema(schema, engine=engine, adaptive_anyof=True)
+    failures = []
+
+    def normalize_all():
+        for value, outcome in zip(values, expected):
+            if _outcome(compiled.normalize, deepcopy(value)) != outcome:
+                failures.append(value)
+
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+        threads = [threading.Thread(target=normalize_all) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        sys.setswitchinterval(interval)
+    assert failures == []
+
+
+def test_normalize_schema_async():
+    """Coroutine functions in a schema are awaited."""
+    import asyncio
+    from sureberus.aio import normalize_schema_async
+
+    async def double(value):
+        await asyncio.sleep(0)
+        return value * 2
+
+    async def check_even(field, value, error):
+        await asyncio.sleep(0)
+        if value % 2:
+            error(field, "must be even")
+
+    async def default_list(doc):
+        return []
+
+    schema = S.Dict(
+        fields={
+            "x": S.Integer(coerce=double, validator=check_even),
+            "y": S.Integer(coerce=int, coerce_post=double),
+            "z": {"default_setter": default_list},
+            "points": S.List(elements=S.Dict(fields={"n": S.Integer(coerce=double)})),
+        }
+    )
+    value = {"x": 1, "y": "2", "points": [{"n": 1}, {"n": 2}]}
+    result = asyncio.run(normalize_schema_async(schema, value))
+    assert result == {"x": 2, "y": 4, "z": [], "points": [{"n": 2}, {"n": 4}]}
+
+    with pytest.raises(E.CustomValidatorError) as ei:
+        asyncio.run(
+            normalize_schema_async(
+                S.Dict(fields={"x": S.Integer(validator=check_even)}), {"x": 1}
+            )
+        )
+    assert ei.value.stack == ("x",)
+
+
+def test_normalize_schema_async_concurrent():
+    """Sibling fields are normalized concurrently, and errors are raised in order."""
+    import asyncio
+    from sureberus.aio import normalize_schema_async
+
+    order = []
+
+    def delayed(name, delay, fail=False):
+        async def coerce(value):
+            order.append(("start", name))
+            await asyncio.sleep(delay)
+            order.append(("end", name))
+            if fail:
+                raise ValueError(name)
+            return value
+
+        return coerce
+
+    schema = S.Dict(
+        fields={
+            "a": {"coerce": delayed("a", 0.02)},
+            "b": {"coerce": delayed("b", 0.01)},
+            "c": S.Integer(),
+        }
+    )
+    assert asyncio.run(normalize_schema_async(schema, {"a": 1, "b": 2, "c": 3})) == {
+        "a": 1,
+        "b": 2,
+        "c": 3,
+    }
+    assert order == [("start", "a"), ("start", "b"), ("end", "b"), ("end", "a")]
+
+    schema = S.Dict(
+        fields={
+            "a": {"coerce": delayed("a", 0.02, fail=True)},
+            "b": {"coerce": delayed("b", 0.01, fail=True)},
+        }
+    )
+    with pytest.raises(E.CoerceUnexpectedError) as ei:
+        asyncio.run(normalize_schema_async(schema, {"a": 1, "b": 2}))
+    assert ei.value.stack == ("a",)
+
+
+def test_normalize_schema_async_checks_schemas_once(monkeypatch):
+    """Each subschema is checked for coroutine functions once per call."""
+    import asyncio
+    from sureberus import aio
+
+    async def double(value):
+        return value * 2
+
+    schema = S.Integer(coerce=double)
+    for _ in range(10):
+        schema = S.Dict(fields={"x": schema, "y": S.Integer()})
+    value = 1
+    for _ in range(10):
+        value = {"x": value, "y": 2}
+    checked = []
+    check_synchronous = aio._check_synchronous
+
+    def counting(schema):
+        checked.append(id(schema))
+        return check_synchronous(schema)
+
+    monkeypatch.setattr(aio, "_check_synchronous", counting)
+    result = asyncio.run(aio.normalize_schema_async(schema, value))
+    for _ in range(10):
+        assert result["y"] == 2
+        result = result["x"]
+    assert result == 2
+    assert len(checked) == len(set(checked))
+
+
+def test_normalize_schema_async_elements_in_batches(monkeypatch):
+    """The elements of a list are normalized a batch at a time."""
+    import asyncio
+    from sureberus import aio
+
+    monkeypatch.setattr(aio, "_GATHER_BATCH_SIZE", 4)
+    running = [0]
+    most = [0]
+
+    async def coerce(value):
+        running[0] += 1
+        most[0] = max(most[0], running[0])
+        await asyncio.sleep(0)
+        running[0] -= 1
+        if value == 9:
+            raise ValueError(value)
+        return value * 2
+
+    schema = S.List(elements={"coerce": coerce})
+    assert asyncio.run(aio.normalize_schema_async(schema, list(range(9)))) == [
+        i * 2 for i in range(9)
+    ]
+    assert most[0] == 4
+
+    with pytest.raises(E.CoerceUnexpectedError) as ei:
+        asyncio.run(aio.normalize_schema_async(schema, list(range(5, 20))))
+    assert ei.value.stack == (4,)
+
+
+@pytest.mark.parametrize("schema, value", engine_cases)
+def test_normalize_schema_async_like_normalize_schema(schema, value):
+    """normalize_schema_async behaves like normalize_schema."""
+    import asyncio
+    from sureberus.aio import normalize_schema_async
+
+    expected = _outcome(normalize_schema, deepcopy(schema), deepcopy(value))
+
+    def run():
+        return asyncio.run(normalize_schema_async(deepcopy(schema), deepcopy(value)))
+
+    assert _outcome(run) == expected
+
+
+def _stream_outcome(schema, value, chunk_size):
+    import io
+    from sureberus.stream import normalize_stream
+
+    out = io.StringIO()
+    try:
+        normalize_stream(
+            schema, io.StringIO(json.dumps(value)), out, chunk_size=chunk_size
+        )
+    except E.SureError as e:
+        return ("error", type(e), e.stack)
+    except Exception as e:
+        return ("exception", type(e))
+    return ("result", json.loads(out.getvalue()))
+
+
+_stream_cases = [
+    # Fields filled in with defaults exclude other fields too
+    (
+        S.Dict(fields={"a": {"default": 1, "excludes": "b"}, "b": S.Integer()}),
+        {"b": 2},
+    ),
+    # The fields are checked in the order of the schema, not of the document
+    (S.Dict(fields={"a": S.Integer(), "b": S.Integer()}), {"b": "x", "a": "y"}),
+    (
+        S.Dict(fields={"a": S.List(elements=S.Integer()), "b": S.Integer()}),
+        {"b": [1, 2], "a": [1, "x", 3]},
+    ),
+    (
+        S.Dict(fields={"a": S.Integer(), "b": S.Dict(fields={"c": S.Integer()})}),
+        {"b": {"c": "x"}, "a": 1, "d": 2},
+    ),
+    (S.Dict(fields={"a": S.Integer(), "b": S.Integer()}), {"b": "x"}),
+    # Unknown fields are reported before errors that aren't SureErrors, like
+    # comparing a string with `min`
+    (S.Dict(fields={"a": {"min": 1}}), {"a": "x", "z": 1}),
+    (S.Dict(fields={"a": S.Integer(), "b": {"min": 1}}), {"b": "x", "a": "y"}),
+]
+
+
+@pytest.mark.parametrize("chunk_size", [1, 1024])
+@pytest.mark.parametrize("schema, value", engine_cases + _stream_cases)
+def test_normalize_stream_like_normalize_schema(schema, value, chunk_size):
+    """
+    normalize_stream behaves like normalize_schema, whether dicts and lists are
+    normalized as they're read (with tiny chunks) or built first.
+    """
+    try:
+        sureberus.check_schema(schema)
+        if json.loads(json.dumps(value)) != value:
+            return
+    except (E.SchemaError, TypeError, ValueError):
+        return
+    expected = _outcome(normalize_schema, deepcopy(schema), deepcopy(value))
+    if expected[0] == "result":
+        try:
+            expected = ("result", json.loads(json.dumps(expected[1])))
+        except (TypeError, ValueError):
+            return
+    else:
+        expected = expected[:3]
+    assert _stream_outcome(deepcopy(schema), value, chunk_size) == expected
+
+
+def test_normalize_stream():
+    """Big documents are normalized as they're read, without being built."""
+    import io
+    from sureberus.stream import normalize_events, tokenize
+
+    schema = S.Dict(
+        registry={
+            "point": S.Dict(fields={"x": S.Integer(), "y": S.Integer(default=0)})
+        },
+        fields={
+            "name": S.String(),
+            "points": S.List(elements="point"),
+            "extra": S.Dict(
+                allow_unknown=True, fields={"a": S.Integer(required=False)}
+            ),
+            "n": S.Integer(default=3),
+        },
+    )
+    value = {
+        "name": "big",
+        "points": [{"x": i} for i in range(50)],
+        "extra": {"b": [1, {"c": None}]},
+    }
+    text = json.dumps(value)
+    assert list(tokenize(io.StringIO(text), chunk_size=3))[:6] == [
+        ("start_map", None),
+        ("map_key", "name"),
+        ("value", "big"),
+        ("map_key", "points"),
+        ("start_array", None),
+        ("start_map", None),
+    ]
+    expected = normalize_schema(schema, value)
+    assert _stream_outcome(schema, value, 16) == ("result", expected)
+    events = list(
+        normalize_events(schema, io.BytesIO(text.encode("utf-8")), chunk_size=16)
+    )
+    assert events[-3:] == [("map_key", "n"), ("value", 3), ("end_map", None)]
+
+    value["points"][30]["x"] = "30"
+    assert _stream_outcome(schema, value, 16) == (
+        "error",
+        E.BadType,
+        ("points", 30, "x"),
+    )
+    value["points"][30]["x"] = 30
+    del value["name"]
+    assert _stream_outcome(schema, value, 16) == ("error", E.DictFieldNotFound, ())
+
+
+@pytest.mark.parametrize(
+    "text", ['{"a": ', "[1, 2", '{"a" 1}', '{"a": 1 "b": 2}', "[1] 2", "", "[tru]"]
+)
+def test_tokenize_invalid(text):
+    import io
+    from sureberus.stream import tokenize
+
+    with pytest.raises(ValueError):
+        list(tokenize(io.StringIO(text), chunk_size=2))
+
+
+@pytest.mark.parametrize("ordered", [True, False])
+def test_normalize_aiter(ordered):
+    """Values from an async iterable are normalized with bounded concurrency."""
+    import asyncio
+    from sureberus.aio import normalize_aiter
+
+    read = []
+    results = []
+
+    async def values():
+        for i in range(20):
+            read.append(i)
+            yield {"x": i} if i % 5 else {"x": str(i)}
+
+    async def consume():
+        async for index, result in normalize_aiter(
+            S.Dict(fields={"x": S.Integer()}), values(), concurrency=3, ordered=ordered
+        ):
+            # Values are only read a few ahead of the results
+            assert len(read) <= len(results) + 4
+            results.append((index, result))
+
+    asyncio.run(consume())
+    if ordered:
+        assert [index for index, result in results] == list(range(20))
+    results.sort(key=lambda result: result[0])
+    for index, result in results:
+        if index % 5:
+            assert result == {"x": index}
+        else:
+            assert isinstance(result, E.BadType)
+            assert result.stack == ("x",)
+
+
+@pytest.mark.parametrize("concurrency", [0, -1])
+def test_normalize_aiter_bad_concurrency(concurrency):
+    import asyncio
+    from sureberus.aio import normalize_aiter
+
+    async def values():
+        yield 1
+
+    async def consume():
+        async for result in normalize_aiter(
+            S.Integer(), values(), concurrency=concurrency
+        ):
+            pass
+
+    with pytest.raises(ValueError) as ei:
+        asyncio.run(consume())
+    assert str(ei.value) == "concurrency must be at least 1"